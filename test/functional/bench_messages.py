@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# Copyright (c) 2018 The Cascoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Measure the memory and time taken by test framework message objects.
+
+Deserializes a number of transactions, block headers and invs (like a test
+keeping a large mempool or many blocks in memory would), and builds
+transactions as objects and in a TxBatch. Prints the memory allocated per
+object, as measured with tracemalloc, and the time taken to create them.
+Also times the parsing of a 1 MB block from a BufferReader and from a
+BytesIO. Run it before and after changing the classes in
+test_framework/messages.py or test_framework/txbatch.py to see the effect."""
+
+import argparse
+import gc
+from io import BytesIO
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from test_framework.messages import (
+    BufferReader,
+    CBlock,
+    CBlockHeader,
+    CInv,
+    COutPoint,
+    CTransaction,
+    CTxIn,
+    CTxOut,
+    ser_compact_size,
+)
+from test_framework.script import CScript, OP_TRUE
+from test_framework.txbatch import TxBatch
+
+def make_tx(i, inputs, outputs):
+    tx = CTransaction()
+    for n in range(inputs):
+        tx.vin.append(CTxIn(COutPoint(i * 1000 + n, n), b"\x51" * 72, 0xffffffff))
+    for n in range(outputs):
+        tx.vout.append(CTxOut(1000 + n, CScript([OP_TRUE])))
+    return tx.serialize()
+
+def measure(name, count, create, build=None):
+    """Print the memory allocated per object and the time taken to create count objects.
+
+    Objects are created with create(i), or all at once with build(count).
+    They're created twice: once timed, and once with tracemalloc (which
+    slows allocations down) to measure their memory."""
+    if build is None:
+        build = lambda count: [create(i) for i in range(count)]
+    gc.collect()
+    start = time.perf_counter()
+    objects = build(count)
+    elapsed = time.perf_counter() - start
+    del objects
+    gc.collect()
+    tracemalloc.start()
+    objects = build(count)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("%-26s %8d objects %8.0f bytes each %8.2f us each" % (name, count, size / count, elapsed / count * 1e6))
+    del objects
+
+def measure_parse(name, data, reader, runs):
+    """Print the best time out of runs taken to deserialize a CBlock from reader(data)."""
+    best = None
+    for i in range(runs):
+        gc.collect()
+        start = time.perf_counter()
+        CBlock().deserialize(reader(data))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print("%-26s %8d bytes   %8.2f ms" % (name, len(data), best * 1e3))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=100000, help='number of objects of each kind (default: %(default)s)')
+    parser.add_argument('--runs', type=int, default=5, help='number of times the block is parsed (default: %(default)s)')
+    args = parser.parse_args()
+
+    template = make_tx(0, 2, 2)
+    def deserialize_tx(i):
+        tx = CTransaction()
+        tx.deserialize(BufferReader(template))
+        return tx
+    measure("CTransaction (2-in 2-out)", args.count, deserialize_tx)
+
+    header = CBlockHeader().serialize()
+    def deserialize_header(i):
+        h = CBlockHeader()
+        h.deserialize(BufferReader(header))
+        return h
+    measure("CBlockHeader", args.count, deserialize_header)
+
+    measure("CInv", args.count, lambda i: CInv(1, i))
+    measure("COutPoint", args.count, lambda i: COutPoint(i, 0))
+
+    # Building 1-in 1-out transactions and their txids, as objects and in a
+    # TxBatch (whose memory includes the serialized transactions)
+    script = CScript([OP_TRUE])
+    def build_tx(i):
+        tx = CTransaction()
+        tx.vin.append(CTxIn(COutPoint(i, 0), b""))
+        tx.vout.append(CTxOut(1000, script))
+        tx.rehash()
+        return tx
+    measure("CTransaction (1-in 1-out)", args.count, build_tx)
+    def build_batch(count):
+        batch = TxBatch()
+        for i in range(count):
+            batch.add_spend(i, 0, 1000, script)
+        batch.serialize()
+        return batch
+    measure("TxBatch (1-in 1-out)", args.count, None, build_batch)
+
+    # A 1 MB block of 1-in 2-out transactions with signature-sized scriptSigs
+    txs = []
+    size = 0
+    while size < 1000000:
+        txs.append(make_tx(len(txs), 1, 2))
+        size += len(txs[-1])
+    block = CBlockHeader().serialize() + ser_compact_size(len(txs)) + b"".join(txs)
+    measure_parse("CBlock (BufferReader)", block, BufferReader, args.runs)
+    measure_parse("CBlock (BytesIO)", block, BytesIO, args.runs)
+
+if __name__ == '__main__':
+    main()
@@ -36,21 +36,19 @@ class CBrokenBlock(CBlock):
         self.vtx = copy.deepcopy(base_block.vtx)
         self.hashMerkleRoot = self.calc_merkle_root()
 
-    def serialize(self, with_witness=False):
-        r = b""
-        r += super(CBlock, self).serialize()
-        r += struct.pack("<BQ", 255, len(self.vtx))
+    def serialize_into(self, w, with_witness=False):
+        super(CBlock, self).serialize_into(w)
+        w += struct.pack("<BQ", 255, len(self.vtx))
         for tx in self.vtx:
             if with_witness:
-                r += tx.serialize_with_witness()
+                w += tx.serialize_with_witness()
             else:
-                r += tx.serialize_without_witness()
-        return r
+                w += tx.serialize_without_witness()
 
     def normal_serialize(self):
-        r = b""
-        r += super(CBrokenBlock, self).serialize()
-        return r
+        w = bytearray()
+        super(CBrokenBlock, self).serialize_into(w)
+        return bytes(w)
 
 class FullBlockTest(ComparisonTestFramework):
     # Can either run this test as 1 node with expected answers, or two and compare them.
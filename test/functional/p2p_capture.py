@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# Copyright (c) 2018 The Cascoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Test capturing P2P traffic and replaying it into another node.
+
+Setup: two nodes, not connected to each other.
+
+1. Send a chain of blocks to node0 over a captured connection.
+
+2. Check that the capture holds the handshake in both directions and the
+   blocks as they were sent.
+
+3. Replay the messages sent to node0 into node1, with a small send queue
+   limit so that the replay has to wait for the queue to drain. Node1 should
+   reach the same tip as node0.
+"""
+import os
+
+from test_framework.blocktools import create_block, create_coinbase
+from test_framework.mininode import (
+    P2PInterface,
+    msg_block,
+    network_thread_join,
+    network_thread_start,
+)
+from test_framework.p2pcapture import RECEIVED, SENT, CaptureReader, CaptureWriter, replay_capture
+from test_framework.test_framework import BitcoinTestFramework
+from test_framework.util import assert_equal
+
+class P2PCaptureTest(BitcoinTestFramework):
+    def set_test_params(self):
+        self.setup_clean_chain = True
+        self.num_nodes = 2
+
+    def setup_network(self):
+        # Don't connect the nodes, node1 only gets the blocks from the replay
+        self.setup_nodes()
+
+    def run_test(self):
+        path = os.path.join(self.options.tmpdir, "node0.cap")
+        capture = CaptureWriter(path)
+        self.nodes[0].add_p2p_connection(P2PInterface(), capture=capture)
+        network_thread_start()
+        self.nodes[0].p2p.wait_for_verack()
+
+        self.log.info("Send blocks to node0 over a captured connection")
+        tip = int(self.nodes[0].getbestblockhash(), 16)
+        block_time = self.nodes[0].getblock(self.nodes[0].getbestblockhash())['time'] + 1
+        blocks = []
+        for height in range(1, 201):
+            block = create_block(tip, create_coinbase(height), block_time)
+            block.solve()
+            self.nodes[0].p2p.send_message(msg_block(block))
+            blocks.append(block)
+            tip = block.sha256
+            block_time += 1
+        self.nodes[0].p2p.sync_with_ping()
+        assert_equal(self.nodes[0].getbestblockhash(), blocks[-1].hash)
+
+        self.nodes[0].disconnect_p2ps()
+        network_thread_join()
+        capture.close()
+
+        self.log.info("Check the captured messages")
+        reader = CaptureReader(path)
+        sent = [m for m in reader if m.direction == SENT]
+        received = [m for m in reader if m.direction == RECEIVED]
+        assert_equal(sent[0].command, b"version")
+        assert_equal(received[0].command, b"version")
+        assert b"verack" in [m.command for m in sent]
+        assert b"verack" in [m.command for m in received]
+        assert_equal([m.payload for m in sent if m.command == b"block"], [b.serialize() for b in blocks])
+        assert_equal(reader.find_time(0), 0)
+        assert_equal(reader.find_time(reader[-1].time + 1), len(reader))
+
+        self.log.info("Replay the messages sent to node0 into node1")
+        self.nodes[1].add_p2p_connection(P2PInterface())
+        network_thread_start()
+        self.nodes[1].p2p.wait_for_verack()
+        skip = (b"version", b"verack", b"ping", b"pong")
+        count = replay_capture(self.nodes[1].p2p, reader, skip=skip, max_pending=10000)
+        assert_equal(count, len([m for m in sent if m.command not in skip]))
+        # The payloads were copied out of the capture, so it can be closed
+        # while they're still queued
+        reader.close()
+        self.nodes[1].p2p.sync_with_ping()
+        assert_equal(self.nodes[1].getbestblockhash(), blocks[-1].hash)
+
+if __name__ == '__main__':
+    P2PCaptureTest().main()
@@ -12,6 +12,7 @@ from test_framework.mininode import *
 from test_framework.test_framework import BitcoinTestFramework
 from test_framework.util import *
 from test_framework.blocktools import create_block, create_coinbase, add_witness_commitment
+from test_framework.compactblocks import PartiallyDownloadedBlock, TxPool
 from test_framework.script import CScript, OP_TRUE
 
 VB_TOP_BITS = 0x20000000
@@ -283,6 +284,10 @@ class CompactBlocksTest(BitcoinTestFramework):
         # Make sure we will receive a fast-announce compact block
         self.request_cb_announcements(test_node, node, version)
 
+        # Keep the transactions the block will be built from, to reconstruct
+        # it from the compact block
+        pool = TxPool(FromHex(CTransaction(), node.getrawtransaction(txid)) for txid in node.getrawmempool())
+
         # Now mine a block, and look at the resulting compact block.
         test_node.clear_block_announcement()
         block_hash = int(node.generate(1)[0], 16)
@@ -302,6 +307,9 @@ class CompactBlocksTest(BitcoinTestFramework):
             assert("cmpctblock" in test_node.last_message)
             # Convert the on-the-wire representation to absolute indexes
             header_and_shortids = HeaderAndShortIDs(test_node.last_message["cmpctblock"].header_and_shortids)
+        header_and_shortids.use_witness = (version == 2)
+        # All the transactions are in the pool
+        self.check_compactblock_reconstruction(test_node, version, header_and_shortids, pool, block, [])
         self.check_compactblock_construction_from_block(version, header_and_shortids, block_hash, block)
 
         # Now fetch the compact block using a normal non-announce getdata
@@ -318,8 +326,35 @@ class CompactBlocksTest(BitcoinTestFramework):
             assert("cmpctblock" in test_node.last_message)
             # Convert the on-the-wire representation to absolute indexes
             header_and_shortids = HeaderAndShortIDs(test_node.last_message["cmpctblock"].header_and_shortids)
+        header_and_shortids.use_witness = (version == 2)
+        # Reconstruct it again without every other transaction, which have
+        # to be requested with getblocktxn
+        for tx in block.vtx[1::2]:
+            pool.remove(tx.sha256)
+        self.check_compactblock_reconstruction(test_node, version, header_and_shortids, pool, block, list(range(1, len(block.vtx), 2)))
         self.check_compactblock_construction_from_block(version, header_and_shortids, block_hash, block)
 
+    # Reconstruct block from a compact block and the transactions in pool,
+    # and check that the transactions at missing_indexes are requested from
+    # the node (and that it sends them).
+    def check_compactblock_reconstruction(self, test_node, version, header_and_shortids, pool, block, missing_indexes):
+        partial = PartiallyDownloadedBlock(header_and_shortids, pool)
+        assert_equal(partial.missing, missing_indexes)
+        if partial.missing:
+            with mininode_lock:
+                test_node.last_message.pop("blocktxn", None)
+            msg = msg_getblocktxn()
+            msg.block_txn_request = partial.get_request()
+            test_node.send_message(msg)
+            wait_until(lambda: "blocktxn" in test_node.last_message, timeout=10, lock=mininode_lock)
+            with mininode_lock:
+                reconstructed = partial.fill_block(test_node.last_message["blocktxn"].block_transactions)
+        else:
+            reconstructed = partial.fill_block()
+        assert(reconstructed is not None)
+        with_witness = (version == 2)
+        assert_equal(reconstructed.serialize(with_witness), block.serialize(with_witness))
+
     def check_compactblock_construction_from_block(self, version, header_and_shortids, block_hash, block):
         # Check that we got the right block!
         header_and_shortids.header.calc_sha256()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# Copyright (c) 2018 The Cascoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Benchmark relay capacity with many P2P peers.
+
+Open --peers mininode connections to a node and have a LoadGenerator send
+them a mix of tx, inv, headers, getdata, cmpctblock and ping messages at the
+rates given with --rates (messages per second over all peers) for
+--duration seconds. The transactions spend anyone-can-spend outputs created
+beforehand, so they are all valid.
+
+Report the achieved send rates, ping round trip time percentiles and the
+rate at which the node accepted the transactions into its mempool. Check
+that all transactions were accepted and all pings answered."""
+
+import math
+import time
+
+from test_framework.blocktools import create_block, create_coinbase
+from test_framework.messages import (
+    CBlock,
+    COutPoint,
+    CTransaction,
+    CTxIn,
+    CTxOut,
+    FromHex,
+    ToHex,
+)
+from test_framework.mininode import network_thread_start
+from test_framework.p2pload import LOAD_COMMANDS, LoadGenerator, LoadPeer
+from test_framework.script import CScript, OP_TRUE
+from test_framework.test_framework import BitcoinTestFramework
+from test_framework.txbatch import TxBatch
+from test_framework.util import assert_equal, wait_until
+
+# Number of outputs of each transaction splitting a coinbase
+OUTPUTS_PER_SPLIT = 1000
+# Fee paid by each load transaction, in satoshis
+TX_FEE = 10000
+
+class P2PLoadTest(BitcoinTestFramework):
+    def add_options(self, parser):
+        parser.add_option("--peers", dest="peers", default=50, type="int",
+                          help="Number of P2P connections to open (default: %default)")
+        parser.add_option("--duration", dest="duration", default=10, type="float",
+                          help="Seconds to send load for (default: %default)")
+        parser.add_option("--rates", dest="rates",
+                          default="tx=100,inv=100,headers=10,getdata=10,cmpctblock=10,ping=50",
+                          help="Comma-separated command=rate pairs, in messages per second over all peers (commands: %s; default: %%default)" % ", ".join(LOAD_COMMANDS))
+
+    def set_test_params(self):
+        self.setup_clean_chain = True
+        self.num_nodes = 1
+
+    def setup_network(self):
+        self.extra_args = [["-maxconnections=%d" % (self.options.peers + 10)]]
+        self.setup_nodes()
+
+    def parse_rates(self):
+        rates = {}
+        for pair in self.options.rates.split(","):
+            command, rate = pair.split("=")
+            rates[command.strip()] = float(rate)
+        return rates
+
+    def submit_block(self, txs=()):
+        node = self.nodes[0]
+        tip = node.getbestblockhash()
+        height = node.getblockcount() + 1
+        mtp = node.getblockheader(tip)['mediantime']
+        block = create_block(int(tip, 16), create_coinbase(height), mtp + 1)
+        block.vtx.extend(txs)
+        block.hashMerkleRoot = block.calc_merkle_root()
+        block.rehash()
+        block.solve()
+        node.submitblock(ToHex(block))
+        assert_equal(node.getbestblockhash(), block.hash)
+        return block
+
+    def make_txs(self, count):
+        """Return an iterator of count valid transactions, each spending an anyone-can-spend output."""
+        node = self.nodes[0]
+        coinbases = [self.submit_block().vtx[0] for _ in range(math.ceil(count / OUTPUTS_PER_SPLIT))]
+        node.generate(100)
+
+        splits = []
+        for coinbase in coinbases:
+            split = CTransaction()
+            split.vin.append(CTxIn(COutPoint(coinbase.sha256, 0), b""))
+            value = (coinbase.vout[0].nValue - TX_FEE) // OUTPUTS_PER_SPLIT
+            split.vout = [CTxOut(value, CScript([OP_TRUE])) for _ in range(OUTPUTS_PER_SPLIT)]
+            split.rehash()
+            splits.append(split)
+        self.submit_block(splits)
+
+        batch = TxBatch()
+        script = CScript([OP_TRUE])
+        for split in splits:
+            for i, out in enumerate(split.vout[:count - len(batch)]):
+                batch.add_spend(split.sha256, i, out.nValue - TX_FEE, script)
+        # The transactions are decoded into CTransactions as they're sent
+        return batch.transactions()
+
+    def run_test(self):
+        node = self.nodes[0]
+        rates = self.parse_rates()
+        duration = self.options.duration
+
+        self.log.info("Creating transactions to send")
+        txs = self.make_txs(int(rates.get("tx", 0) * duration))
+        blocks = [FromHex(CBlock(), node.getblock(node.getblockhash(h), False))
+                  for h in range(max(1, node.getblockcount() - 20), node.getblockcount() + 1)]
+        for block in blocks:
+            block.rehash()
+
+        self.log.info("Connecting %d peers" % self.options.peers)
+        peers = [node.add_p2p_connection(LoadPeer()) for _ in range(self.options.peers)]
+        network_thread_start()
+        for peer in peers:
+            peer.wait_for_verack()
+
+        self.log.info("Sending load for %.1f s: %s" % (duration, self.options.rates))
+        generator = LoadGenerator(peers, rates, txs, blocks)
+        start = time.time()
+        report = generator.run(duration)
+
+        # Time until the node has accepted all sent transactions
+        sent_txs = report.sent.get("tx", 0)
+        wait_until(lambda: node.getmempoolinfo()['size'] >= sent_txs, timeout=120)
+        accept_time = time.time() - start
+        self.log.info("Load report:\n%s" % report)
+        if sent_txs:
+            self.log.info("Node accepted %d transactions in %.1f s (%.1f tx/s)" % (sent_txs, accept_time, sent_txs / accept_time))
+
+        assert_equal(node.getmempoolinfo()['size'], sent_txs)
+        assert_equal(len(report.ping_times), report.sent.get("ping", 0))
+        assert_equal(len(node.getpeerinfo()), self.options.peers)
+
+if __name__ == '__main__':
+    P2PLoadTest().main()
@@ -113,6 +113,15 @@ def sign_P2PK_witness_input(script, txTo, inIdx, hashtype, value, key):
     txTo.wit.vtxinwit[inIdx].scriptWitness.stack = [signature, script]
     txTo.rehash()
 
+# Add signatures for P2PK witness programs to all inputs of a transaction,
+# with a hashtype and value for each input.
+def sign_P2PK_witness_inputs(script, txTo, hashtypes, values, key):
+    tx_hashes = SegwitVersion1SignatureHashes(txTo, [(script, hashtype, value) for hashtype, value in zip(hashtypes, values)])
+    for inIdx, (tx_hash, hashtype) in enumerate(zip(tx_hashes, hashtypes)):
+        signature = key.sign(tx_hash) + chr(hashtype).encode('latin-1')
+        txTo.wit.vtxinwit[inIdx].scriptWitness.stack = [signature, script]
+    txTo.rehash()
+
 
 class SegWitTest(BitcoinTestFramework):
     def set_test_params(self):
@@ -1333,15 +1342,17 @@ class SegWitTest(BitcoinTestFramework):
             split_value = total_value // num_outputs
             for i in range(num_outputs):
                 tx.vout.append(CTxOut(split_value, scriptPubKey))
+            hashtypes = []
             for i in range(num_inputs):
                 # Now try to sign each input, using a random hashtype.
                 anyonecanpay = 0
                 if random.randint(0, 1):
                     anyonecanpay = SIGHASH_ANYONECANPAY
                 hashtype = random.randint(1, 3) | anyonecanpay
-                sign_P2PK_witness_input(witness_program, tx, i, hashtype, temp_utxos[i].nValue, key)
+                hashtypes.append(hashtype)
                 if (hashtype == SIGHASH_SINGLE and i >= num_outputs):
                     used_sighash_single_out_of_bounds = True
+            sign_P2PK_witness_inputs(witness_program, tx, hashtypes, [u.nValue for u in temp_utxos[:num_inputs]], key)
             tx.rehash()
             for i in range(num_outputs):
                 temp_utxos.append(UTXO(tx.sha256, i, split_value))
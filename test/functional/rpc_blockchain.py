@@ -11,6 +11,7 @@ Test the following RPCs:
     - getbestblockhash
     - getblockhash
     - getblockheader
+    - getblock
     - getchaintxstats
     - getnetworkhashps
     - verifychain
@@ -22,6 +23,7 @@ from decimal import Decimal
 import http.client
 import subprocess
 
+from test_framework.messages import LazyBlock
 from test_framework.test_framework import BitcoinTestFramework
 from test_framework.util import (
     assert_equal,
@@ -31,6 +33,7 @@ from test_framework.util import (
     assert_raises_rpc_error,
     assert_is_hex_string,
     assert_is_hash_string,
+    hex_str_to_bytes,
 )
 
 class BlockchainTest(BitcoinTestFramework):
@@ -43,6 +46,7 @@ class BlockchainTest(BitcoinTestFramework):
         self._test_getchaintxstats()
         self._test_gettxoutsetinfo()
         self._test_getblockheader()
+        self._test_getblock()
         self._test_getdifficulty()
         self._test_getnetworkhashps()
         self._test_stopatheight()
@@ -196,6 +200,20 @@ class BlockchainTest(BitcoinTestFramework):
         assert isinstance(int(header['versionHex'], 16), int)
         assert isinstance(header['difficulty'], Decimal)
 
+    def _test_getblock(self):
+        node = self.nodes[0]
+
+        # The serialized block matches the verbose one. Its transactions
+        # are only scanned for their txids, not decoded.
+        for height in (1, 100, 200):
+            blockhash = node.getblockhash(height)
+            block = node.getblock(blockhash)
+            raw_block = LazyBlock(hex_str_to_bytes(node.getblock(blockhash, False)))
+            assert_equal(raw_block.header.hash, blockhash)
+            assert_equal(raw_block.header.hashMerkleRoot, int(block['merkleroot'], 16))
+            assert_equal(len(raw_block.buf), block['size'])
+            assert_equal(["%064x" % txid for txid in raw_block.txids()], block['tx'])
+
     def _test_getdifficulty(self):
         difficulty = self.nodes[0].getdifficulty()
         # 1 hash in 2 should be valid, so difficulty should be 1/2**31
@@ -4,6 +4,7 @@
 # file COPYING or http://www.opensource.org/licenses/mit-license.php.
 """Test gettxoutproof and verifytxoutproof RPCs."""
 
+from test_framework.messages import CBlock, CMerkleBlock, FromHex, ToHex
 from test_framework.test_framework import BitcoinTestFramework
 from test_framework.util import *
 
@@ -22,6 +23,16 @@ class MerkleBlockTest(BitcoinTestFramework):
 
         self.sync_all()
 
+    def check_proof(self, proof, blockhash, txids):
+        """Check a gettxoutproof result against the partial merkle tree built by the framework."""
+        block = FromHex(CBlock(), self.nodes[0].getblock(blockhash, False))
+        merkle_block = CMerkleBlock()
+        merkle_block.initialize_from_block(block, [int(txid, 16) for txid in txids])
+        assert_equal(ToHex(merkle_block), proof)
+        root, matches = FromHex(CMerkleBlock(), proof).txn.extract_matches()
+        assert_equal(root, block.hashMerkleRoot)
+        assert_equal(sorted("%064x" % txid for _, txid in matches), sorted(txids))
+
     def run_test(self):
         self.log.info("Mining blocks...")
         self.nodes[0].generate(105)
@@ -52,6 +63,8 @@ class MerkleBlockTest(BitcoinTestFramework):
         assert_equal(self.nodes[2].verifytxoutproof(self.nodes[2].gettxoutproof([txid1])), [txid1])
         assert_equal(self.nodes[2].verifytxoutproof(self.nodes[2].gettxoutproof([txid1, txid2])), txlist)
         assert_equal(self.nodes[2].verifytxoutproof(self.nodes[2].gettxoutproof([txid1, txid2], blockhash)), txlist)
+        self.check_proof(self.nodes[2].gettxoutproof([txid1]), blockhash, [txid1])
+        self.check_proof(self.nodes[2].gettxoutproof([txid1, txid2]), blockhash, [txid1, txid2])
 
         txin_spent = self.nodes[1].listunspent(1).pop()
         tx3 = self.nodes[1].createrawtransaction([txin_spent], {self.nodes[0].getnewaddress(): 49.98})
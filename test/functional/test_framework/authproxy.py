@@ -31,14 +31,21 @@ ServiceProxy class:
 - sends Basic HTTP authentication headers
 - parses all JSON numbers that look like floats as Decimal
 - uses standard Python json lib
+
+RPCClient builds on AuthServiceProxy to make calls from several threads at
+once: it keeps a pool of keep-alive connections to one server, returns a
+future for each call and sends calls that queue up behind busy connections
+together as JSON-RPC batches.
 """
 
 import base64
+from concurrent.futures import Future, ThreadPoolExecutor
 import decimal
 import http.client
 import json
 import logging
 import socket
+import threading
 import time
 import urllib.parse
 
@@ -178,3 +185,121 @@ class AuthServiceProxy():
 
     def __truediv__(self, relative_uri):
         return AuthServiceProxy("{}/{}".format(self.__service_url, relative_uri), self._service_name, connection=self.__conn)
+
+def new_http_connection(service_url, timeout=HTTP_TIMEOUT):
+    """Return an (unconnected) HTTP(S)Connection for an RPC service URL."""
+    url = urllib.parse.urlparse(service_url)
+    port = 80 if url.port is None else url.port
+    if url.scheme == 'https':
+        return http.client.HTTPSConnection(url.hostname, port, timeout=timeout)
+    return http.client.HTTPConnection(url.hostname, port, timeout=timeout)
+
+class RPCClient():
+    """Thread-safe, pipelining JSON-RPC client for one server.
+
+    Calls are queued and sent by a pool of up to max_connections worker
+    threads, each with its own keep-alive connection. A worker sends
+    everything that's queued when it becomes free (up to max_batch_size
+    requests) as one JSON-RPC batch, so calls that are made while all
+    connections are busy get coalesced, while a lone call is sent straight
+    away.
+
+    submit() and call_async() return concurrent.futures.Future objects,
+    whose result() is the RPC's result or raises JSONRPCException. As with
+    AuthServiceProxy, attribute access names an RPC, but calling it returns a
+    future:
+
+        client = RPCClient(node.url)
+        futures = [client.getblockhash(h) for h in range(200)]
+        hashes = [f.result() for f in futures]
+    """
+
+    def __init__(self, service_url, *, max_connections=4, max_batch_size=500, timeout=HTTP_TIMEOUT, ensure_ascii=True):
+        self.service_url = service_url
+        self.max_batch_size = max_batch_size
+        self.timeout = timeout
+        self.ensure_ascii = ensure_ascii
+        self._lock = threading.Lock()
+        self._pending = []
+        self._local = threading.local()
+        self._connections = []
+        self._executor = ThreadPoolExecutor(max_connections)
+
+    def __getattr__(self, name):
+        if name.startswith('__') and name.endswith('__'):
+            # Python internal stuff
+            raise AttributeError
+        return lambda *args, **argsn: self.call_async(name, *args, **argsn)
+
+    def call_async(self, method, *args, **argsn):
+        """Queue an RPC call and return a future for its result."""
+        if args and argsn:
+            raise ValueError('Cannot handle both named and positional arguments')
+        return self.submit({'version': '1.1', 'method': method, 'params': args or argsn, 'id': None})
+
+    def call(self, method, *args, **argsn):
+        """Make an RPC call and wait for its result."""
+        return self.call_async(method, *args, **argsn).result()
+
+    def submit(self, request):
+        """Queue a JSON-RPC request object (such as AuthServiceProxy.get_request() returns).
+
+        Returns a future for its result. The request's id is replaced when
+        it's sent."""
+        future = Future()
+        with self._lock:
+            self._pending.append((request, future))
+        self._executor.submit(self._send_pending)
+        return future
+
+    def close(self):
+        """Wait for queued calls to complete, then close all connections."""
+        self._executor.shutdown()
+        for conn in self._connections:
+            conn.close()
+        self._connections = []
+
+    def _proxy(self):
+        # One AuthServiceProxy (and connection) per worker thread
+        proxy = getattr(self._local, 'proxy', None)
+        if proxy is None:
+            conn = new_http_connection(self.service_url, self.timeout)
+            with self._lock:
+                self._connections.append(conn)
+            proxy = AuthServiceProxy(self.service_url, connection=conn, ensure_ascii=self.ensure_ascii)
+            self._local.proxy = proxy
+        return proxy
+
+    def _send_pending(self):
+        with self._lock:
+            batch = self._pending[:self.max_batch_size]
+            del self._pending[:self.max_batch_size]
+        if not batch:
+            # Already sent along with an earlier call
+            return
+        # Requests are numbered within the batch, since callers may have
+        # taken their ids from different counters.
+        requests = [dict(request, id=i) for i, (request, future) in enumerate(batch)]
+        try:
+            response = self._proxy().batch(requests)
+        except Exception as e:
+            for request, future in batch:
+                future.set_exception(e)
+            return
+        if not isinstance(response, list):
+            # The whole batch was rejected
+            e = JSONRPCException(response.get('error') or {
+                'code': -342, 'message': 'unexpected JSON-RPC batch response'})
+            for request, future in batch:
+                future.set_exception(e)
+            return
+        results = {r.get('id'): r for r in response}
+        for i, (request, future) in enumerate(batch):
+            r = results.get(i)
+            if r is not None and r.get('error') is not None:
+                future.set_exception(JSONRPCException(r['error']))
+            elif r is None or 'result' not in r:
+                future.set_exception(JSONRPCException({
+                    'code': -343, 'message': 'missing JSON-RPC result'}))
+            else:
+                future.set_result(r['result'])
@@ -2,14 +2,186 @@
 # Copyright (c) 2015-2017 The Bitcoin Core developers
 # Distributed under the MIT software license, see the accompanying
 # file COPYING or http://www.opensource.org/licenses/mit-license.php.
-"""BlockStore and TxStore helper classes."""
+"""BlockStore and TxStore helper classes.
+
+Serialized blocks and transactions are kept in append-only record files
+(modeled on the node's blk?????.dat files) with an in-memory index, and block
+headers in a separate in-memory header index. Answering getheaders and
+getdata, and building locators, never deserializes a stored block."""
 
 from .mininode import *
-from io import BytesIO
-import dbm.dumb as dbmd
+import mmap
+import os
+import random
+import tempfile
+import unittest
 
 logger = logging.getLogger("TestFramework.blockstore")
 
+class RecordFile():
+    """Append-only file of serialized objects, indexed by hash in memory.
+
+    Each record is the network magic, the 32-byte hash of the object, the
+    length of the data as a uint32 and the data itself. A length of
+    ERASED_LENGTH (with no data) marks the hash as erased. Records are never
+    rewritten; reads go through an mmap of the file, which is re-created
+    when a record beyond its end is read. An existing file is re-indexed
+    when opened.
+
+    The P2P message headers of records sent with get_message() are cached,
+    so that data sent many times is only checksummed once."""
+
+    HEADER = struct.Struct("<4s32sI")
+    ERASED_LENGTH = 0xffffffff
+
+    def __init__(self, path):
+        self.magic = MAGIC_BYTES["regtest"]
+        self.file = open(path, 'a+b')
+        self.map = None
+        # hash -> (offset of data, length of data)
+        self.index = {}
+        # hash -> {(command, network): P2P message header}
+        self.message_headers = {}
+        self._load()
+
+    def _load(self):
+        size = self.file.seek(0, os.SEEK_END)
+        pos = 0
+        while pos + self.HEADER.size <= size:
+            magic, key, length = self.HEADER.unpack(self._read(pos, self.HEADER.size))
+            if magic != self.magic:
+                raise ValueError("%s: bad record magic at offset %d" % (self.file.name, pos))
+            pos += self.HEADER.size
+            h = uint256_from_str(key)
+            if length == self.ERASED_LENGTH:
+                self.index.pop(h, None)
+                continue
+            if pos + length > size:
+                # Torn write at the end of the file
+                break
+            self.index[h] = (pos, length)
+            pos += length
+
+    def _read(self, offset, length):
+        if self.map is None or offset + length > len(self.map):
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.map[offset:offset + length]
+
+    def _append(self, h, data, length):
+        offset = self.file.seek(0, os.SEEK_END) + self.HEADER.size
+        self.file.write(self.HEADER.pack(self.magic, ser_uint256(h), length))
+        self.file.write(data)
+        self.file.flush()
+        return offset
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+    def __contains__(self, h):
+        return h in self.index
+
+    # lookup an entry and return the item as raw bytes
+    def get(self, h):
+        try:
+            offset, length = self.index[h]
+        except KeyError:
+            return None
+        return self._read(offset, length)
+
+    def put(self, h, data):
+        self.index[h] = (self._append(h, data, len(data)), len(data))
+        self.message_headers.pop(h, None)
+
+    def erase(self, h):
+        del self.index[h]
+        self._append(h, b"", self.ERASED_LENGTH)
+        self.message_headers.pop(h, None)
+
+    def get_message(self, h, command, net="regtest"):
+        """Return the entry as a msg_generic and its frames for P2PConnection.send_message(), or None."""
+        data = self.get(h)
+        if data is None:
+            return None
+        message = msg_generic(command, data)
+        headers = self.message_headers.setdefault(h, {})
+        header = headers.get((command, net))
+        if header is None:
+            header = headers[(command, net)] = build_message(message, net)[0]
+        return (message, [header, data])
+
+def invert_lowest_one(n):
+    return n & (n - 1)
+
+def get_skip_height(height):
+    """Height of the ancestor a HeaderIndexEntry's skip pointer points to.
+
+    Same choice of heights as GetSkipHeight() in chain.cpp, which makes
+    get_ancestor() take O(log n) steps."""
+    if height < 2:
+        return 0
+    if height & 1:
+        return invert_lowest_one(invert_lowest_one(height - 1)) + 1
+    return invert_lowest_one(height)
+
+class HeaderIndexEntry():
+    """An entry in BlockStore's header index: a header and its place in the tree.
+
+    Like CBlockIndex, each entry points to its parent (prev) and to a more
+    distant ancestor (skip). height is counted from the oldest ancestor in
+    the index, since the store usually doesn't know the blocks the tested
+    chain is built on."""
+
+    def __init__(self, header, prev):
+        self.header = header
+        self.sha256 = header.sha256
+        self.hashPrevBlock = header.hashPrevBlock
+        # Entries whose prev is this one
+        self.children = []
+        # Cached result of BlockStore._data_floor()
+        self.data_floor = 0
+        self.data_floor_stamp = -1
+        self.set_prev(prev)
+
+    def set_prev(self, prev):
+        self.prev = prev
+        if prev is not None:
+            prev.children.append(self)
+        self.update_height()
+
+    def update_height(self):
+        """Recompute height and skip from prev, eg after prev's height changed."""
+        if self.prev is None:
+            self.height = 0
+            self.skip = None
+        else:
+            self.height = self.prev.height + 1
+            self.skip = self.prev.get_ancestor(get_skip_height(self.height))
+
+    def get_ancestor(self, height):
+        """Return this entry's ancestor at height, or None."""
+        if height > self.height or height < 0:
+            return None
+        walk = self
+        height_walk = self.height
+        while height_walk > height:
+            height_skip = get_skip_height(height_walk)
+            height_skip_prev = get_skip_height(height_walk - 1)
+            if walk.skip is not None and (height_skip == height or
+                    (height_skip > height and not (height_skip_prev < height_skip - 2 and
+                                                   height_skip_prev >= height))):
+                # Only follow skip if prev->skip isn't better than skip->prev.
+                walk = walk.skip
+                height_walk = height_skip
+            else:
+                walk = walk.prev
+                height_walk -= 1
+        return walk
+
 class BlockStore():
     """BlockStore helper class.
 
@@ -19,81 +191,120 @@ class BlockStore():
     """
 
     def __init__(self, datadir):
-        self.blockDB = dbmd.open(datadir + "/blocks", 'c')
+        self.blocks = RecordFile(datadir + "/blocks.dat")
         self.currentBlock = 0
-        self.headers_map = dict()
+        # hash -> HeaderIndexEntry
+        self.header_index = dict()
+        # hashPrevBlock -> entries added before their parent
+        self.orphan_headers = dict()
+        # Bumped whenever cached HeaderIndexEntry.data_floor values may be stale
+        self.data_floor_stamp = 0
 
     def close(self):
-        self.blockDB.close()
+        self.blocks.close()
 
     def erase(self, blockhash):
-        del self.blockDB[repr(blockhash)]
+        self.blocks.erase(blockhash)
+        self.data_floor_stamp += 1
 
     # lookup an entry and return the item as raw bytes
     def get(self, blockhash):
-        value = None
-        try:
-            value = self.blockDB[repr(blockhash)]
-        except KeyError:
-            return None
-        return value
+        return self.blocks.get(blockhash)
 
     # lookup an entry and return it as a CBlock
     def get_block(self, blockhash):
         ret = None
         serialized_block = self.get(blockhash)
         if serialized_block is not None:
-            f = BytesIO(serialized_block)
+            f = BufferReader(serialized_block)
             ret = CBlock()
             ret.deserialize(f)
             ret.calc_sha256()
         return ret
 
+    # lookup an entry and return it as a LazyBlock, which decodes
+    # transactions only as they're accessed
+    def get_lazy_block(self, blockhash):
+        serialized_block = self.get(blockhash)
+        if serialized_block is None:
+            return None
+        return LazyBlock(serialized_block)
+
     def get_header(self, blockhash):
         try:
-            return self.headers_map[blockhash]
+            return self.header_index[blockhash].header
         except KeyError:
             return None
 
-    # Note: this pulls full blocks out of the database just to retrieve
-    # the headers -- perhaps we could keep a separate data structure
-    # to avoid this overhead.
     def headers_for(self, locator, hash_stop, current_tip=None):
+        """Return a msg_headers for a getheaders(locator, hash_stop) from a peer.
+
+        The headers run from the last ancestor of current_tip in the locator
+        (or the oldest ancestor in the index) towards current_tip, at most
+        2000 of them, ending early at hash_stop."""
         if current_tip is None:
             current_tip = self.currentBlock
-        current_block_header = self.get_header(current_tip)
-        if current_block_header is None:
+        tip = self.header_index.get(current_tip)
+        if tip is None:
             return None
 
-        response = msg_headers()
-        headersList = [ current_block_header ]
+        start_height = 0
+        for h in locator.vHave:
+            entry = self.header_index.get(h)
+            if entry is not None and entry.height >= start_height and tip.get_ancestor(entry.height) is entry:
+                start_height = entry.height
         maxheaders = 2000
-        while (headersList[0].sha256 not in locator.vHave):
-            prevBlockHash = headersList[0].hashPrevBlock
-            prevBlockHeader = self.get_header(prevBlockHash)
-            if prevBlockHeader is not None:
-                headersList.insert(0, prevBlockHeader)
-            else:
-                break
-        headersList = headersList[:maxheaders] # truncate if we have too many
-        hashList = [x.sha256 for x in headersList]
-        index = len(headersList)
-        if (hash_stop in hashList):
-            index = hashList.index(hash_stop)+1
-        response.headers = headersList[:index]
+        end = tip.get_ancestor(min(tip.height, start_height + maxheaders - 1))
+        stop = self.header_index.get(hash_stop)
+        if stop is not None and start_height <= stop.height <= end.height and end.get_ancestor(stop.height) is stop:
+            end = stop
+
+        headersList = [None] * (end.height - start_height + 1)
+        walk = end
+        for i in range(len(headersList) - 1, -1, -1):
+            headersList[i] = walk.header
+            walk = walk.prev
+        response = msg_headers()
+        response.headers = headersList
         return response
 
     def add_block(self, block):
         block.calc_sha256()
-        try:
-            self.blockDB[repr(block.sha256)] = bytes(block.serialize())
-        except TypeError as e:
-            logger.exception("Unexpected error")
+        self.blocks.put(block.sha256, block.serialize())
         self.currentBlock = block.sha256
-        self.headers_map[block.sha256] = CBlockHeader(block)
+        self.add_header(CBlockHeader(block))
 
     def add_header(self, header):
-        self.headers_map[header.sha256] = header
+        entry = self.header_index.get(header.sha256)
+        if entry is not None:
+            entry.header = header
+            if entry.children:
+                # The block's data may have just been added
+                self.data_floor_stamp += 1
+            return
+        entry = HeaderIndexEntry(header, self.header_index.get(header.hashPrevBlock))
+        self.header_index[header.sha256] = entry
+        if entry.prev is None:
+            self.orphan_headers.setdefault(header.hashPrevBlock, []).append(entry)
+        self._connect_orphans(entry)
+
+    def _connect_orphans(self, entry):
+        """Link up headers that were added before entry, their parent."""
+        orphans = self.orphan_headers.pop(entry.sha256, None)
+        if orphans is None:
+            return
+        for orphan in orphans:
+            orphan.set_prev(entry)
+        # The orphans' descendants now have new heights. Parents are updated
+        # before their children, so that skip pointers are built on
+        # up-to-date ancestors.
+        stack = list(orphans)
+        while stack:
+            e = stack.pop()
+            for child in e.children:
+                child.update_height()
+                stack.append(child)
+        self.data_floor_stamp += 1
 
     # lookup the hashes in "inv", and return p2p messages for delivering
     # blocks found.
@@ -107,19 +318,52 @@ class BlockStore():
                     responses.append(msg_generic(b"block", data))
         return responses
 
+    # Like get_blocks(), but return (message, frames) pairs to pass to
+    # P2PConnection.send_message(), with the message headers cached.
+    def get_block_messages(self, inv, net="regtest"):
+        responses = []
+        for i in inv:
+            if (i.type == 2 or i.type == (2 | (1 << 30))): # MSG_BLOCK or MSG_WITNESS_BLOCK
+                response = self.blocks.get_message(i.hash, b"block", net)
+                if response is not None:
+                    responses.append(response)
+        return responses
+
+    def _data_floor(self, entry):
+        """Return the lowest height reachable from entry through parents whose data we have.
+
+        entry itself must have its data in the store. Results are cached on
+        the entries walked, until erase() or a block arriving out of order
+        changes which blocks have data."""
+        path = []
+        e = entry
+        while e.data_floor_stamp != self.data_floor_stamp:
+            path.append(e)
+            if e.prev is None or e.hashPrevBlock not in self.blocks:
+                floor = e.height
+                break
+            e = e.prev
+        else:
+            floor = e.data_floor
+        for e in path:
+            e.data_floor = floor
+            e.data_floor_stamp = self.data_floor_stamp
+        return floor
+
+    # Walk back from current_tip through the header index, only following
+    # blocks whose data we have.
     def get_locator(self, current_tip=None):
         if current_tip is None:
             current_tip = self.currentBlock
         r = []
         counter = 0
         step = 1
-        lastBlock = self.get_block(current_tip)
+        lastBlock = self.header_index.get(current_tip) if current_tip in self.blocks else None
+        if lastBlock is not None:
+            floor = self._data_floor(lastBlock)
         while lastBlock is not None:
             r.append(lastBlock.hashPrevBlock)
-            for i in range(step):
-                lastBlock = self.get_block(lastBlock.hashPrevBlock)
-                if lastBlock is None:
-                    break
+            lastBlock = lastBlock.get_ancestor(lastBlock.height - step) if lastBlock.height - step >= floor else None
             counter += 1
             if counter > 10:
                 step *= 2
@@ -129,26 +373,18 @@ class BlockStore():
 
 class TxStore():
     def __init__(self, datadir):
-        self.txDB = dbmd.open(datadir + "/transactions", 'c')
+        self.txs = RecordFile(datadir + "/transactions.dat")
 
     def close(self):
-        self.txDB.close()
+        self.txs.close()
 
     # lookup an entry and return the item as raw bytes
     def get(self, txhash):
-        value = None
-        try:
-            value = self.txDB[repr(txhash)]
-        except KeyError:
-            return None
-        return value
+        return self.txs.get(txhash)
 
     def add_transaction(self, tx):
         tx.calc_sha256()
-        try:
-            self.txDB[repr(tx.sha256)] = bytes(tx.serialize())
-        except TypeError as e:
-            logger.exception("Unexpected error")
+        self.txs.put(tx.sha256, tx.serialize())
 
     def get_transactions(self, inv):
         responses = []
@@ -158,3 +394,110 @@ class TxStore():
                 if tx is not None:
                     responses.append(msg_generic(b"tx", tx))
         return responses
+
+    # Like get_transactions(), but return (message, frames) pairs to pass to
+    # P2PConnection.send_message(), with the message headers cached.
+    def get_transaction_messages(self, inv, net="regtest"):
+        responses = []
+        for i in inv:
+            if (i.type == 1 or i.type == (1 | (1 << 30))): # MSG_TX or MSG_WITNESS_TX
+                response = self.txs.get_message(i.hash, b"tx", net)
+                if response is not None:
+                    responses.append(response)
+        return responses
+
+
+class TestFrameworkBlockStore(unittest.TestCase):
+    def setUp(self):
+        self.datadir = tempfile.TemporaryDirectory()
+        self.store = BlockStore(self.datadir.name)
+
+    def tearDown(self):
+        self.store.close()
+        self.datadir.cleanup()
+
+    def make_chain(self, length, prev=0, time=1500000000):
+        headers = []
+        for i in range(length):
+            header = CBlockHeader()
+            header.hashPrevBlock = prev
+            header.nTime = time + i
+            header.calc_sha256()
+            headers.append(header)
+            prev = header.sha256
+        return headers
+
+    def check_index(self, headers):
+        """Check heights and ancestors of a chain of headers against a walk of the prev pointers."""
+        entries = [self.store.header_index[h.sha256] for h in headers]
+        for height, entry in enumerate(entries):
+            self.assertEqual(entry.height, height)
+            self.assertIs(entry.prev, entries[height - 1] if height else None)
+            if entry.skip is not None:
+                self.assertIs(entry.skip, entries[get_skip_height(height)])
+        rng = random.Random(1)
+        for _ in range(1000):
+            entry = rng.choice(entries)
+            height = rng.randrange(entry.height + 1)
+            self.assertIs(entry.get_ancestor(height), entries[height])
+        self.assertIsNone(entries[-1].get_ancestor(len(entries)))
+        self.assertIsNone(entries[-1].get_ancestor(-1))
+
+    def test_long_chain(self):
+        headers = self.make_chain(5000)
+        for header in headers:
+            self.store.add_header(header)
+        self.check_index(headers)
+
+    def test_deep_chain(self):
+        # Deep enough for get_ancestor() to depend on the skip pointers
+        length = 100000
+        headers = self.make_chain(length)
+        for header in headers:
+            self.store.add_block(CBlock(header))
+        self.check_index(headers)
+
+        locator = CBlockLocator()
+        locator.vHave = [headers[97000].sha256, headers[5].sha256]
+        response = self.store.headers_for(locator, 0, headers[-1].sha256)
+        self.assertEqual([h.sha256 for h in response.headers], [h.sha256 for h in headers[97000:99000]])
+        response = self.store.headers_for(locator, headers[97500].sha256, headers[-1].sha256)
+        self.assertEqual([h.sha256 for h in response.headers], [h.sha256 for h in headers[97000:97501]])
+
+        # The locator steps back one block at a time, then exponentially
+        heights = []
+        height = length - 1
+        step = 1
+        while height >= 0:
+            heights.append(height)
+            height -= step
+            if len(heights) > 10:
+                step *= 2
+        locator = self.store.get_locator(headers[-1].sha256)
+        self.assertEqual(locator.vHave, [headers[h].hashPrevBlock for h in heights])
+
+    def test_headers_out_of_order(self):
+        headers = self.make_chain(5000)
+        shuffled = list(headers)
+        random.Random(2).shuffle(shuffled)
+        for header in shuffled:
+            self.store.add_header(header)
+        self.assertEqual(self.store.orphan_headers, {headers[0].hashPrevBlock: [self.store.header_index[headers[0].sha256]]})
+        self.check_index(headers)
+
+    def test_headers_for(self):
+        headers = self.make_chain(3000)
+        fork = self.make_chain(10, headers[1000].sha256, time=1600000000)
+        for header in headers + fork:
+            self.store.add_header(header)
+        locator = CBlockLocator()
+        locator.vHave = [fork[-1].sha256, headers[500].sha256]
+        response = self.store.headers_for(locator, 0, headers[-1].sha256)
+        # Starts at the last locator entry on the tip's chain, at most 2000 headers
+        self.assertEqual([h.sha256 for h in response.headers], [h.sha256 for h in headers[500:2500]])
+        response = self.store.headers_for(locator, headers[600].sha256, headers[-1].sha256)
+        self.assertEqual([h.sha256 for h in response.headers], [h.sha256 for h in headers[500:601]])
+        # No locator entry on the tip's chain: start at the oldest header
+        locator.vHave = [headers[1005].sha256]
+        response = self.store.headers_for(locator, 0, fork[-1].sha256)
+        self.assertEqual([h.sha256 for h in response.headers], [h.sha256 for h in headers[:1001] + fork])
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# Copyright (c) 2018 The Cascoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Receiving side of BIP 152 compact blocks.
+
+TxPool holds the transactions a compact block can be reconstructed from,
+like the node's mempool. PartiallyDownloadedBlock (named after its
+counterpart in blockencodings.cpp) matches the short IDs of a compact block
+against a TxPool, computing the short IDs of the whole pool in one batch.
+The HeaderAndShortIDs must say whether the short IDs are of wtxids (version
+2 compact blocks) or txids (version 1), which the P2P message doesn't tell:
+
+    header_and_shortids = HeaderAndShortIDs(message.header_and_shortids)
+    header_and_shortids.use_witness = (version == 2)
+    partial = PartiallyDownloadedBlock(header_and_shortids, pool)
+    if partial.missing:
+        request = msg_getblocktxn()
+        request.block_txn_request = partial.get_request()
+        peer.send_message(request)
+        # ... and once the blocktxn message arrives:
+        block = partial.fill_block(message.block_transactions)
+    else:
+        block = partial.fill_block()
+
+Like the node, a short ID matching several pool transactions is requested
+instead of guessed, a compact block repeating a short ID can't be
+reconstructed, and fill_block() returns None if a short ID collision put
+a wrong transaction in the block (the full block should then be
+requested)."""
+
+import unittest
+
+from .messages import (
+    BlockTransactions,
+    BlockTransactionsRequest,
+    CBlock,
+    COutPoint,
+    CTransaction,
+    CTxIn,
+    CTxInWitness,
+    CTxOut,
+    HeaderAndShortIDs,
+    calculate_shortid,
+    calculate_shortids,
+)
+
+class TxPool():
+    """Transactions indexed by txid, with their txids and wtxids listed for batch hashing."""
+
+    def __init__(self, txs=()):
+        # txid -> CTransaction
+        self.txs = {}
+        # (transactions, txids, wtxids) of self.txs, or None if it has changed
+        self.lists = None
+        for tx in txs:
+            self.add(tx)
+
+    def __len__(self):
+        return len(self.txs)
+
+    def __contains__(self, txid):
+        return txid in self.txs
+
+    def add(self, tx):
+        tx.calc_sha256()
+        self.txs[tx.sha256] = tx
+        self.lists = None
+
+    def remove(self, txid):
+        if self.txs.pop(txid, None) is not None:
+            self.lists = None
+
+    def remove_block(self, block):
+        """Remove the transactions of a block, as the node's mempool does when it's connected."""
+        for tx in block.vtx:
+            tx.calc_sha256()
+            self.remove(tx.sha256)
+
+    def hashes(self, use_witness):
+        """Return the transactions of the pool and their txids (or wtxids), in the same order."""
+        if self.lists is None:
+            txs = list(self.txs.values())
+            self.lists = (txs, [tx.sha256 for tx in txs], None)
+        txs, txids, wtxids = self.lists
+        if not use_witness:
+            return txs, txids
+        if wtxids is None:
+            wtxids = [tx.calc_sha256(with_witness=True) for tx in txs]
+            self.lists = (txs, txids, wtxids)
+        return txs, wtxids
+
+class PartiallyDownloadedBlock():
+    """A block being reconstructed from a HeaderAndShortIDs and a TxPool.
+
+    txn_available has an entry per transaction of the block: the
+    transaction if it was prefilled or found in the pool, None otherwise.
+    missing lists the indexes of the None entries. The counts of prefilled
+    and pool transactions are kept to measure reconstruction rates."""
+
+    def __init__(self, header_and_shortids, pool):
+        self.header = header_and_shortids.header
+        self.header.calc_sha256()
+        self.use_witness = header_and_shortids.use_witness
+        shortids = header_and_shortids.shortids
+        prefilled = header_and_shortids.prefilled_txn
+        if not shortids and not prefilled:
+            raise ValueError("Compact block has no transactions")
+        if len(set(shortids)) != len(shortids):
+            raise ValueError("Compact block has duplicate short IDs")
+
+        self.txn_available = [None] * (len(shortids) + len(prefilled))
+        for p in prefilled:
+            if p.index >= len(self.txn_available) or self.txn_available[p.index] is not None:
+                raise ValueError("Compact block has invalid prefilled transaction index %d" % p.index)
+            self.txn_available[p.index] = p.tx
+        self.prefilled_count = len(prefilled)
+
+        # short ID -> index in the block
+        shortid_index = {}
+        indexes = iter(i for i, tx in enumerate(self.txn_available) if tx is None)
+        for shortid, i in zip(shortids, indexes):
+            shortid_index[shortid] = i
+
+        # Indexes matched by pool transactions (even if they were reset
+        # because another one matched too)
+        matched = set()
+        self.pool_count = 0
+        [k0, k1] = header_and_shortids.get_siphash_keys()
+        txs, hashes = pool.hashes(self.use_witness)
+        for tx, shortid in zip(txs, calculate_shortids(k0, k1, hashes)):
+            i = shortid_index.get(shortid)
+            if i is None:
+                continue
+            if i not in matched:
+                matched.add(i)
+                self.txn_available[i] = tx
+                self.pool_count += 1
+            elif self.txn_available[i] is not None:
+                # Several pool transactions match the short ID: request it
+                self.txn_available[i] = None
+                self.pool_count -= 1
+
+        self.missing = [i for i, tx in enumerate(self.txn_available) if tx is None]
+
+    def get_request(self):
+        """Return a BlockTransactionsRequest for the missing transactions."""
+        request = BlockTransactionsRequest(self.header.sha256)
+        request.from_absolute(self.missing)
+        return request
+
+    def fill_block(self, block_transactions=None):
+        """Return the reconstructed CBlock, given the BlockTransactions answering get_request().
+
+        Return None if the block's merkle root doesn't match, which means a
+        short ID collision put a wrong transaction in the block."""
+        if block_transactions is None:
+            block_transactions = BlockTransactions(self.header.sha256, [])
+        if block_transactions.blockhash != self.header.sha256:
+            raise ValueError("BlockTransactions for block %064x, not %064x" % (block_transactions.blockhash, self.header.sha256))
+        if len(block_transactions.transactions) != len(self.missing):
+            raise ValueError("Got %d missing transactions, expected %d" % (len(block_transactions.transactions), len(self.missing)))
+        block = CBlock(self.header)
+        block.vtx = list(self.txn_available)
+        for i, tx in zip(self.missing, block_transactions.transactions):
+            block.vtx[i] = tx
+        if block.calc_merkle_root() != block.hashMerkleRoot:
+            return None
+        return block
+
+
+class TestFrameworkCompactBlocks(unittest.TestCase):
+    def make_tx(self, n, witness=False):
+        tx = CTransaction()
+        tx.vin = [CTxIn(COutPoint(n, 0))]
+        tx.vout = [CTxOut(n, b"\x51")]
+        if witness:
+            tx.wit.vtxinwit = [CTxInWitness()]
+            tx.wit.vtxinwit[0].scriptWitness.stack = [bytes([n & 0xff])]
+        tx.rehash()
+        return tx
+
+    def make_block(self, count):
+        block = CBlock()
+        block.nTime = 1500000000
+        block.vtx = [self.make_tx(i, witness=i % 2 == 1) for i in range(count)]
+        block.hashMerkleRoot = block.calc_merkle_root()
+        block.rehash()
+        return block
+
+    def test_calculate_shortids(self):
+        hashes = [self.make_tx(i).sha256 for i in range(100)]
+        k0, k1 = 0x0706050403020100, 0x0F0E0D0C0B0A0908
+        self.assertEqual(calculate_shortids(k0, k1, hashes), [calculate_shortid(k0, k1, h) for h in hashes])
+
+    def test_reconstruct(self):
+        block = self.make_block(50)
+        for use_witness in (False, True):
+            compact = HeaderAndShortIDs()
+            compact.initialize_from_block(block, nonce=7, use_witness=use_witness)
+            # The pool misses every fifth transaction, and has unrelated ones
+            pool = TxPool([tx for i, tx in enumerate(block.vtx) if i % 5 != 0] +
+                          [self.make_tx(i) for i in range(1000, 1100)])
+            partial = PartiallyDownloadedBlock(compact, pool)
+            missing = list(range(5, 50, 5))
+            self.assertEqual(partial.missing, missing)
+            self.assertEqual(partial.prefilled_count, 1)
+            self.assertEqual(partial.pool_count, 40)
+            request = partial.get_request()
+            self.assertEqual(request.blockhash, block.sha256)
+            self.assertEqual(request.to_absolute(), missing)
+            filled = partial.fill_block(BlockTransactions(block.sha256, [block.vtx[i] for i in missing]))
+            self.assertEqual(filled.serialize(), block.serialize())
+
+            # Everything in the pool: nothing to request
+            pool = TxPool(block.vtx[1:])
+            partial = PartiallyDownloadedBlock(compact, pool)
+            self.assertEqual(partial.missing, [])
+            self.assertEqual(partial.fill_block().serialize(), block.serialize())
+
+            # A wrong transaction for a missing one doesn't fill the block
+            partial = PartiallyDownloadedBlock(compact, TxPool())
+            self.assertEqual(partial.missing, list(range(1, 50)))
+            wrong = [block.vtx[i] for i in partial.missing]
+            wrong[0] = self.make_tx(2000)
+            self.assertIsNone(partial.fill_block(BlockTransactions(block.sha256, wrong)))
+
+    def test_invalid(self):
+        block = self.make_block(3)
+        compact = HeaderAndShortIDs()
+        compact.initialize_from_block(block)
+        compact.shortids[1] = compact.shortids[0]
+        self.assertRaises(ValueError, PartiallyDownloadedBlock, compact, TxPool())
+        compact.initialize_from_block(block)
+        compact.prefilled_txn[0].index = 5
+        self.assertRaises(ValueError, PartiallyDownloadedBlock, compact, TxPool())
@@ -41,6 +41,11 @@ class RejectResult():
 
 class TestNode(P2PInterface):
 
+    # Tests push thousands of blocks and transactions through each TestNode:
+    # only log one in ten of them (and of the getdata requests for them), and
+    # none of the pings used for synchronization.
+    message_log_intervals = {b"block": 10, b"tx": 10, b"getdata": 10, b"ping": 0, b"pong": 0}
+
     def __init__(self, block_store, tx_store):
         super().__init__()
         self.bestblockhash = None
@@ -72,8 +77,10 @@ class TestNode(P2PInterface):
             self.send_message(response)
 
     def on_getdata(self, message):
-        [self.send_message(r) for r in self.block_store.get_blocks(message.inv)]
-        [self.send_message(r) for r in self.tx_store.get_transactions(message.inv)]
+        for r, frames in self.block_store.get_block_messages(message.inv, self.network):
+            self.send_message(r, frames=frames)
+        for r, frames in self.tx_store.get_transaction_messages(message.inv, self.network):
+            self.send_message(r, frames=frames)
 
         for i in message.inv:
             if i.type == 1 or i.type == 1 | (1 << 30): # MSG_TX or MSG_WITNESS_TX
@@ -190,6 +197,18 @@ class TestManager():
             return all(node.received_ping_response(counter) for node in self.p2p_connections)
         wait_until(received_pongs, lock=mininode_lock)
 
+    # The send_* helpers below send the same message to every connection,
+    # serializing it only once.
+    def send_pings(self, nonce):
+        with mininode_lock:
+            for c in self.p2p_connections:
+                c.pingMap[nonce] = True
+        broadcast_message(self.p2p_connections, msg_ping(nonce))
+
+    def send_inv(self, obj):
+        mtype = 2 if isinstance(obj, CBlock) else 1
+        broadcast_message(self.p2p_connections, msg_inv([CInv(mtype, obj.sha256)]))
+
     # sync_blocks: Wait for all connections to request the blockhash given
     # then send get_headers to find out the tip of each node, and synchronize
     # the response by using a ping (and waiting for pong with same nonce).
@@ -207,7 +226,7 @@ class TestManager():
         [ c.send_getheaders() for c in self.p2p_connections ]
 
         # Send ping and wait for response -- synchronization hack
-        [ c.send_ping(self.ping_counter) for c in self.p2p_connections ]
+        self.send_pings(self.ping_counter)
         self.wait_for_pings(self.ping_counter)
         self.ping_counter += 1
 
@@ -224,10 +243,13 @@ class TestManager():
         wait_until(transaction_requested, attempts=20*num_events, lock=mininode_lock)
 
         # Get the mempool
-        [ c.send_mempool() for c in self.p2p_connections ]
+        with mininode_lock:
+            for c in self.p2p_connections:
+                c.lastInv = []
+        broadcast_message(self.p2p_connections, msg_mempool())
 
         # Send ping and wait for response -- synchronization hack
-        [ c.send_ping(self.ping_counter) for c in self.p2p_connections ]
+        self.send_pings(self.ping_counter)
         self.wait_for_pings(self.ping_counter)
         self.ping_counter += 1
 
@@ -283,6 +305,13 @@ class TestManager():
             return True
 
     def run(self):
+        try:
+            self._run_tests()
+        finally:
+            self.block_store.close()
+            self.tx_store.close()
+
+    def _run_tests(self):
         # Wait until verack is received
         self.wait_for_verack()
 
@@ -321,27 +350,31 @@ class TestManager():
                     first_block_with_hash = True
                     if self.block_store.get(block.sha256) is not None:
                         first_block_with_hash = False
+                    block_message = msg_block(block)
+                    block_frames = {}
                     with mininode_lock:
                         self.block_store.add_block(block)
+                        requested = []
                         for c in self.p2p_connections:
                             if first_block_with_hash and block.sha256 in c.block_request_map and c.block_request_map[block.sha256] == True:
                                 # There was a previous request for this block hash
                                 # Most likely, we delivered a header for this block
                                 # but never had the block to respond to the getdata
-                                c.send_message(msg_block(block))
+                                requested.append(c)
                             else:
                                 c.block_request_map[block.sha256] = False
+                        broadcast_message(requested, block_message, frames=block_frames)
                     # Either send inv's to each node and sync, or add
                     # to invqueue for later inv'ing.
                     if (test_instance.sync_every_block):
                         # if we expect success, send inv and sync every block
                         # if we expect failure, just push the block and see what happens.
                         if outcome == True:
-                            [ c.send_inv(block) for c in self.p2p_connections ]
+                            self.send_inv(block)
                             self.sync_blocks(block.sha256, 1)
                         else:
-                            [ c.send_message(msg_block(block)) for c in self.p2p_connections ]
-                            [ c.send_ping(self.ping_counter) for c in self.p2p_connections ]
+                            broadcast_message(self.p2p_connections, block_message, frames=block_frames)
+                            self.send_pings(self.ping_counter)
                             self.wait_for_pings(self.ping_counter)
                             self.ping_counter += 1
                         if (not self.check_results(tip, outcome)):
@@ -351,7 +384,7 @@ class TestManager():
                 elif isinstance(b_or_t, CBlockHeader):
                     block_header = b_or_t
                     self.block_store.add_header(block_header)
-                    [ c.send_header(block_header) for c in self.p2p_connections ]
+                    broadcast_message(self.p2p_connections, msg_headers([block_header]))
 
                 else:  # Tx test runner
                     assert(isinstance(b_or_t, CTransaction))
@@ -364,7 +397,7 @@ class TestManager():
                             c.tx_request_map[tx.sha256] = False
                     # Again, either inv to all nodes or save for later
                     if (test_instance.sync_every_tx):
-                        [ c.send_inv(tx) for c in self.p2p_connections ]
+                        self.send_inv(tx)
                         self.sync_transaction(tx.sha256, 1)
                         if (not self.check_mempool(tx.sha256, outcome)):
                             raise AssertionError("Test failed at test %d" % test_number)
@@ -372,20 +405,20 @@ class TestManager():
                         invqueue.append(CInv(1, tx.sha256))
                 # Ensure we're not overflowing the inv queue
                 if len(invqueue) == MAX_INV_SZ:
-                    [ c.send_message(msg_inv(invqueue)) for c in self.p2p_connections ]
+                    broadcast_message(self.p2p_connections, msg_inv(invqueue))
                     invqueue = []
 
             # Do final sync if we weren't syncing on every block or every tx.
             if (not test_instance.sync_every_block and block is not None):
                 if len(invqueue) > 0:
-                    [ c.send_message(msg_inv(invqueue)) for c in self.p2p_connections ]
+                    broadcast_message(self.p2p_connections, msg_inv(invqueue))
                     invqueue = []
                 self.sync_blocks(block.sha256, len(test_instance.blocks_and_transactions))
                 if (not self.check_results(tip, block_outcome)):
                     raise AssertionError("Block test failed at test %d" % test_number)
             if (not test_instance.sync_every_tx and tx is not None):
                 if len(invqueue) > 0:
-                    [ c.send_message(msg_inv(invqueue)) for c in self.p2p_connections ]
+                    broadcast_message(self.p2p_connections, msg_inv(invqueue))
                     invqueue = []
                 self.sync_transaction(tx.sha256, len(test_instance.blocks_and_transactions))
                 if (not self.check_mempool(tx.sha256, tx_outcome)):
@@ -393,5 +426,3 @@ class TestManager():
 
         [ c.disconnect_node() for c in self.p2p_connections ]
         self.wait_for_disconnections()
-        self.block_store.close()
-        self.tx_store.close()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# Copyright (c) 2018 The Cascoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Merkle trees of transaction hashes, as computed by consensus/merkle.cpp.
+
+MerkleTree keeps every level of the tree, so that changing or appending a
+few leaves only rehashes the nodes on their paths to the root. It also
+produces merkle branches and the bits and hashes of partial merkle trees
+(see CPartialMerkleTree in messages.py, and merkleblock.cpp).
+
+Hashes are 32-byte strings in serialization order (ser_uint256()). Like the
+node, the tree of an odd number of nodes pairs the last one with itself, and
+the root of an empty tree is zero."""
+
+import hashlib
+import random
+import unittest
+
+def hash256(s):
+    return hashlib.sha256(hashlib.sha256(s).digest()).digest()
+
+def branch_root(leaf, branch, index):
+    """Return the root given by a merkle branch of the leaf at index."""
+    h = leaf
+    for sibling in branch:
+        if index & 1:
+            h = hash256(sibling + h)
+        else:
+            h = hash256(h + sibling)
+        index >>= 1
+    return h
+
+class MerkleTree():
+    """Merkle tree of a list of hashes, with all its levels cached.
+
+    levels[0] holds the leaves and levels[-1] the root (a single node, except
+    for an empty tree). Node j of level k + 1 is the hash of nodes 2j and
+    2j + 1 of level k, or of node 2j twice if it is the last one."""
+
+    def __init__(self, leaves=()):
+        self.levels = [[]]
+        self.update(leaves)
+
+    def __len__(self):
+        return len(self.levels[0])
+
+    def root(self):
+        if not self.levels[0]:
+            return b"\x00" * 32
+        return self.levels[-1][0]
+
+    def update(self, leaves):
+        """Make leaves the leaves of the tree, rehashing the paths of those that changed."""
+        leaves = list(leaves)
+        old = self.levels[0]
+        common = min(len(old), len(leaves))
+        if old[:common] == leaves[:common]:
+            dirty = set()
+        else:
+            dirty = {i for i in range(common) if old[i] != leaves[i]}
+        dirty.update(range(common, len(leaves)))
+        self.levels[0] = leaves
+        self._rehash(dirty, len(old) != len(leaves))
+
+    def set(self, index, leaf):
+        self.levels[0][index] = leaf
+        self._rehash({index}, False)
+
+    def append(self, leaf):
+        self.levels[0].append(leaf)
+        self._rehash({len(self.levels[0]) - 1}, True)
+
+    def _rehash(self, dirty, resized):
+        """Recompute the nodes above the dirty (changed) nodes of the leaf level.
+
+        resized tells whether the number of leaves changed, in which case the
+        last node of each level may have lost its sibling or gained one."""
+        k = 0
+        while len(self.levels[k]) > 1:
+            level = self.levels[k]
+            if k + 1 == len(self.levels):
+                self.levels.append([])
+            parents = self.levels[k + 1]
+            width = (len(level) + 1) // 2
+            parents_resized = len(parents) != width
+            del parents[width:]
+            parents.extend([None] * (width - len(parents)))
+            if resized:
+                dirty.add(len(level) - 1)
+            dirty = {i >> 1 for i in dirty}
+            last = len(level) - 1
+            for j in dirty:
+                left = level[2 * j]
+                parents[j] = hash256(left + (level[2 * j + 1] if 2 * j < last else left))
+            resized = parents_resized
+            k += 1
+        del self.levels[k + 1:]
+
+    def branch(self, index):
+        """Return the merkle branch of a leaf: the siblings of the nodes on its path to the root."""
+        branch = []
+        for level in self.levels[:-1]:
+            sibling = index ^ 1
+            branch.append(level[sibling] if sibling < len(level) else level[index])
+            index >>= 1
+        return branch
+
+    def partial(self, matches):
+        """Return the bits and hashes of the partial merkle tree of the matched leaves.
+
+        matches has a boolean per leaf. As in CPartialMerkleTree::TraverseAndBuild(),
+        the tree is walked depth first; every node gets a bit telling whether
+        it's the parent of a match, and the hash of every node which is a leaf
+        or not a parent of a match is included."""
+        if len(matches) != len(self):
+            raise ValueError("Got %d matches for %d leaves" % (len(matches), len(self)))
+        # Number of matches among the first i leaves, to find the parents of matches
+        matched = [0]
+        for m in matches:
+            matched.append(matched[-1] + bool(m))
+        height = len(self.levels) - 1
+        bits = []
+        hashes = []
+
+        def traverse(k, pos):
+            first = pos << k
+            last = min((pos + 1) << k, len(self))
+            parent_of_match = matched[last] > matched[first]
+            bits.append(parent_of_match)
+            if k == 0 or not parent_of_match:
+                hashes.append(self.levels[k][pos])
+            else:
+                traverse(k - 1, pos * 2)
+                if pos * 2 + 1 < len(self.levels[k - 1]):
+                    traverse(k - 1, pos * 2 + 1)
+
+        if len(self):
+            traverse(height, 0)
+        return bits, hashes
+
+
+class TestFrameworkMerkle(unittest.TestCase):
+    def naive_root(self, hashes):
+        # As computed by CBlock.get_merkle_root() before MerkleTree
+        if not hashes:
+            return b"\x00" * 32
+        while len(hashes) > 1:
+            newhashes = []
+            for i in range(0, len(hashes), 2):
+                i2 = min(i + 1, len(hashes) - 1)
+                newhashes.append(hash256(hashes[i] + hashes[i2]))
+            hashes = newhashes
+        return hashes[0]
+
+    def make_leaves(self, rng, count):
+        return [rng.getrandbits(256).to_bytes(32, 'little') for i in range(count)]
+
+    def test_root(self):
+        rng = random.Random(1)
+        for count in range(40):
+            leaves = self.make_leaves(rng, count)
+            self.assertEqual(MerkleTree(leaves).root(), self.naive_root(leaves))
+
+    def test_incremental(self):
+        rng = random.Random(2)
+        leaves = []
+        tree = MerkleTree()
+        for _ in range(300):
+            action = rng.randrange(4)
+            if action == 0:
+                leaves.append(self.make_leaves(rng, 1)[0])
+                tree.append(leaves[-1])
+            elif action == 1 and leaves:
+                i = rng.randrange(len(leaves))
+                leaves[i] = self.make_leaves(rng, 1)[0]
+                tree.set(i, leaves[i])
+            else:
+                # Shrink or grow, changing a few leaves
+                leaves = leaves[:rng.randrange(len(leaves) + 1)] + self.make_leaves(rng, rng.randrange(5))
+                for _ in range(rng.randrange(3)):
+                    if leaves:
+                        leaves[rng.randrange(len(leaves))] = self.make_leaves(rng, 1)[0]
+                tree.update(leaves)
+            self.assertEqual(tree.root(), self.naive_root(leaves))
+            self.assertEqual(tree.levels, MerkleTree(leaves).levels)
+
+    def test_branch(self):
+        rng = random.Random(3)
+        for count in (1, 2, 3, 7, 8, 33):
+            leaves = self.make_leaves(rng, count)
+            tree = MerkleTree(leaves)
+            for i, leaf in enumerate(leaves):
+                self.assertEqual(branch_root(leaf, tree.branch(i), i), tree.root())
+
+    def test_partial(self):
+        from .messages import CPartialMerkleTree, uint256_from_str
+        rng = random.Random(4)
+        for count in (1, 2, 3, 7, 8, 33):
+            leaves = self.make_leaves(rng, count)
+            tree = MerkleTree(leaves)
+            for _ in range(5):
+                matches = [rng.random() < 0.3 for i in range(count)]
+                partial = CPartialMerkleTree()
+                partial.initialize_from_tree(tree, matches)
+                root, matched = partial.extract_matches()
+                self.assertEqual(root, uint256_from_str(tree.root()))
+                self.assertEqual(matched, [(i, uint256_from_str(leaves[i])) for i in range(count) if matches[i]])
+        self.assertRaises(ValueError, tree.partial, [True])
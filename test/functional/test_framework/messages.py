@@ -13,8 +13,16 @@ CBlock, CTransaction, CBlockHeader, CTxIn, CTxOut, etc....:
 msg_block, msg_tx, msg_headers, etc.:
     data structures that represent network messages
 
-ser_*, deser_*: functions that handle serialization/deserialization."""
+ser_*, deser_*: functions that handle serialization/deserialization.
+
+Serializable objects have a serialize_into(w) method, which appends their
+serialization to the bytearray w, and a serialize() method returning it as
+bytes. Containers pass w down to their elements (ser_*_into() do the same for
+the basic types), so that a whole block or message is written into a single
+growing buffer instead of being concatenated from the serializations of its
+parts."""
 from codecs import encode
+from collections import namedtuple
 import copy
 import hashlib
 from io import BytesIO
@@ -22,9 +30,11 @@ import random
 import socket
 import struct
 import time
+import unittest
 
-import cascoin_scrypt
-from test_framework.siphash import siphash256
+from test_framework.merkle import MerkleTree
+from test_framework.powsolver import get_pow_hash, solve_header
+from test_framework.siphash import siphash256, siphash256_batch
 from test_framework.util import hex_str_to_bytes, bytes_to_hex_str
 
 MIN_VERSION_SUPPORTED = 60001
@@ -55,6 +65,55 @@ def ripemd160(s):
 def hash256(s):
     return sha256(sha256(s))
 
+# Precompiled structs for the fixed-size fields of the wire format
+_U8 = struct.Struct("<B")
+_U16 = struct.Struct("<H")
+_U32 = struct.Struct("<I")
+_I32 = struct.Struct("<i")
+_U64 = struct.Struct("<Q")
+_I64 = struct.Struct("<q")
+_I8 = struct.Struct("<b")
+_BOOL = struct.Struct("<?")
+_U16_BE = struct.Struct(">H")
+
+class BufferReader():
+    """Cursor over an in-memory buffer, used for zero-copy deserialization.
+
+    Provides the subset of the BytesIO interface used by the deserialize()
+    methods below (read() and tell()), and lets deser_struct() decode fixed-size
+    fields in place with struct.unpack_from() instead of slicing out a new
+    bytes object for every field. Any object with a read() method can still
+    be passed to deserialize()."""
+
+    def __init__(self, data, offset=0):
+        self.buf = memoryview(data)
+        self.pos = offset
+
+    def read(self, n=-1):
+        start = self.pos
+        end = len(self.buf) if n < 0 else min(start + n, len(self.buf))
+        self.pos = end
+        return self.buf[start:end].tobytes()
+
+    def read_view(self, n):
+        """Return the next n bytes as a memoryview into the buffer, without copying."""
+        start = self.pos
+        if start + n > len(self.buf):
+            raise struct.error("read of %d bytes past end of buffer" % n)
+        self.pos = start + n
+        return self.buf[start:start + n]
+
+    def tell(self):
+        return self.pos
+
+def deser_struct(f, s):
+    """Unpack the fixed-size struct s from the stream f."""
+    if f.__class__ is BufferReader:
+        r = s.unpack_from(f.buf, f.pos)
+        f.pos += s.size
+        return r
+    return s.unpack(f.read(s.size))
+
 def ser_compact_size(l):
     r = b""
     if l < 253:
@@ -67,37 +126,116 @@ def ser_compact_size(l):
         r = struct.pack("<BQ", 255, l)
     return r
 
+def ser_compact_size_into(w, l):
+    if l < 253:
+        w.append(l)
+    else:
+        w += ser_compact_size(l)
+
+# Helpers for the BufferReader fast paths. These take the buffer and an offset
+# and return the decoded value together with the offset just past it.
+def _read_compact_size(buf, pos):
+    nit = _U8.unpack_from(buf, pos)[0]
+    if nit < 253:
+        return nit, pos + 1
+    elif nit == 253:
+        return _U16.unpack_from(buf, pos + 1)[0], pos + 3
+    elif nit == 254:
+        return _U32.unpack_from(buf, pos + 1)[0], pos + 5
+    return _U64.unpack_from(buf, pos + 1)[0], pos + 9
+
+def _read_string(buf, pos):
+    nit, pos = _read_compact_size(buf, pos)
+    end = pos + nit
+    if end > len(buf):
+        raise struct.error("read of %d bytes past end of buffer" % nit)
+    return buf[pos:end].tobytes(), end
+
+def _read_txins(buf, pos):
+    nit, pos = _read_compact_size(buf, pos)
+    r = []
+    unpack_u32 = _U32.unpack_from
+    try:
+        for i in range(nit):
+            prevout = COutPoint(int.from_bytes(buf[pos:pos + 32], 'little'), unpack_u32(buf, pos + 32)[0])
+            n = buf[pos + 36]
+            if n < 253:
+                pos += 37
+                end = pos + n
+                scriptSig = buf[pos:end].tobytes()
+            else:
+                scriptSig, end = _read_string(buf, pos + 36)
+            r.append(CTxIn(prevout, scriptSig, unpack_u32(buf, end)[0]))
+            pos = end + 4
+    except IndexError:
+        raise struct.error("read past end of buffer")
+    return TrackedList(r), pos
+
+def _read_txouts(buf, pos):
+    nit, pos = _read_compact_size(buf, pos)
+    r = []
+    unpack_i64 = _I64.unpack_from
+    try:
+        for i in range(nit):
+            nValue = unpack_i64(buf, pos)[0]
+            n = buf[pos + 8]
+            if n < 253:
+                pos += 9 + n
+                scriptPubKey = buf[pos - n:pos].tobytes()
+            else:
+                scriptPubKey, pos = _read_string(buf, pos + 8)
+            r.append(CTxOut(nValue, scriptPubKey))
+    except IndexError:
+        raise struct.error("read past end of buffer")
+    if pos > len(buf):
+        raise struct.error("read past end of buffer")
+    return TrackedList(r), pos
+
 def deser_compact_size(f):
-    nit = struct.unpack("<B", f.read(1))[0]
+    if f.__class__ is BufferReader:
+        nit, f.pos = _read_compact_size(f.buf, f.pos)
+        return nit
+    nit = deser_struct(f, _U8)[0]
     if nit == 253:
-        nit = struct.unpack("<H", f.read(2))[0]
+        nit = deser_struct(f, _U16)[0]
     elif nit == 254:
-        nit = struct.unpack("<I", f.read(4))[0]
+        nit = deser_struct(f, _U32)[0]
     elif nit == 255:
-        nit = struct.unpack("<Q", f.read(8))[0]
+        nit = deser_struct(f, _U64)[0]
     return nit
 
 def deser_string(f):
+    if f.__class__ is BufferReader:
+        r, f.pos = _read_string(f.buf, f.pos)
+        return r
     nit = deser_compact_size(f)
     return f.read(nit)
 
 def ser_string(s):
     return ser_compact_size(len(s)) + s
 
+def ser_string_into(w, s):
+    ser_compact_size_into(w, len(s))
+    w += s
+
 def deser_uint256(f):
-    r = 0
-    for i in range(8):
-        t = struct.unpack("<I", f.read(4))[0]
-        r += t << (i * 32)
-    return r
+    if f.__class__ is BufferReader:
+        return int.from_bytes(f.read_view(32), 'little')
+    s = f.read(32)
+    if len(s) != 32:
+        raise struct.error("deser_uint256 requires 32 bytes")
+    return int.from_bytes(s, 'little')
+
 
+_UINT256_MASK = (1 << 256) - 1
 
+# Like the node, only the low 256 bits of u are serialized (negative values
+# as two's complement).
 def ser_uint256(u):
-    rs = b""
-    for i in range(8):
-        rs += struct.pack("<I", u & 0xFFFFFFFF)
-        u >>= 32
-    return rs
+    return (u & _UINT256_MASK).to_bytes(32, 'little')
+
+def ser_uint256_into(w, u):
+    w += (u & _UINT256_MASK).to_bytes(32, 'little')
 
 
 def uint256_from_str(s):
@@ -128,13 +266,18 @@ def deser_vector(f, c):
 # entries in the vector (we use this for serializing the vector of transactions
 # for a witness block).
 def ser_vector(l, ser_function_name=None):
-    r = ser_compact_size(len(l))
-    for i in l:
-        if ser_function_name:
-            r += getattr(i, ser_function_name)()
-        else:
-            r += i.serialize()
-    return r
+    w = bytearray()
+    ser_vector_into(w, l, ser_function_name)
+    return bytes(w)
+
+def ser_vector_into(w, l, ser_function_name=None):
+    ser_compact_size_into(w, len(l))
+    if ser_function_name:
+        for i in l:
+            w += getattr(i, ser_function_name)()
+    else:
+        for i in l:
+            i.serialize_into(w)
 
 
 def deser_uint256_vector(f):
@@ -147,10 +290,14 @@ def deser_uint256_vector(f):
 
 
 def ser_uint256_vector(l):
-    r = ser_compact_size(len(l))
+    w = bytearray()
+    ser_uint256_vector_into(w, l)
+    return bytes(w)
+
+def ser_uint256_vector_into(w, l):
+    ser_compact_size_into(w, len(l))
     for i in l:
-        r += ser_uint256(i)
-    return r
+        ser_uint256_into(w, i)
 
 
 def deser_string_vector(f):
@@ -163,15 +310,19 @@ def deser_string_vector(f):
 
 
 def ser_string_vector(l):
-    r = ser_compact_size(len(l))
+    w = bytearray()
+    ser_string_vector_into(w, l)
+    return bytes(w)
+
+def ser_string_vector_into(w, l):
+    ser_compact_size_into(w, len(l))
     for sv in l:
-        r += ser_string(sv)
-    return r
+        ser_string_into(w, sv)
 
 
 # Deserialize from a hex string representation (eg from RPC)
 def FromHex(obj, hex_string):
-    obj.deserialize(BytesIO(hex_str_to_bytes(hex_string)))
+    obj.deserialize(BufferReader(hex_str_to_bytes(hex_string)))
     return obj
 
 # Convert a binary-serializable object to hex (eg for submission via RPC)
@@ -181,6 +332,8 @@ def ToHex(obj):
 # Objects that map to bitcoind objects, which can be serialized/deserialized
 
 class CAddress():
+    __slots__ = ("nServices", "pchReserved", "ip", "port")
+
     def __init__(self):
         self.nServices = 1
         self.pchReserved = b"\x00" * 10 + b"\xff" * 2
@@ -188,18 +341,21 @@ class CAddress():
         self.port = 0
 
     def deserialize(self, f):
-        self.nServices = struct.unpack("<Q", f.read(8))[0]
+        self.nServices = deser_struct(f, _U64)[0]
         self.pchReserved = f.read(12)
         self.ip = socket.inet_ntoa(f.read(4))
-        self.port = struct.unpack(">H", f.read(2))[0]
+        self.port = deser_struct(f, _U16_BE)[0]
+
+    def serialize_into(self, w):
+        w += _U64.pack(self.nServices)
+        w += self.pchReserved
+        w += socket.inet_aton(self.ip)
+        w += _U16_BE.pack(self.port)
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<Q", self.nServices)
-        r += self.pchReserved
-        r += socket.inet_aton(self.ip)
-        r += struct.pack(">H", self.port)
-        return r
+        w = bytearray()
+        self.serialize_into(w)
+        return bytes(w)
 
     def __repr__(self):
         return "CAddress(nServices=%i ip=%s port=%i)" % (self.nServices,
@@ -208,6 +364,8 @@ class CAddress():
 MSG_WITNESS_FLAG = 1<<30
 
 class CInv():
+    __slots__ = ("type", "hash")
+
     typemap = {
         0: "Error",
         1: "TX",
@@ -222,14 +380,17 @@ class CInv():
         self.hash = h
 
     def deserialize(self, f):
-        self.type = struct.unpack("<i", f.read(4))[0]
+        self.type = deser_struct(f, _I32)[0]
         self.hash = deser_uint256(f)
 
+    def serialize_into(self, w):
+        w += _I32.pack(self.type)
+        ser_uint256_into(w, self.hash)
+
     def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.type)
-        r += ser_uint256(self.hash)
-        return r
+        w = bytearray()
+        self.serialize_into(w)
+        return bytes(w)
 
     def __repr__(self):
         return "CInv(type=%s hash=%064x)" \
@@ -242,92 +403,260 @@ class CBlockLocator():
         self.vHave = []
 
     def deserialize(self, f):
-        self.nVersion = struct.unpack("<i", f.read(4))[0]
+        self.nVersion = deser_struct(f, _I32)[0]
         self.vHave = deser_uint256_vector(f)
 
+    def serialize_into(self, w):
+        w += _I32.pack(self.nVersion)
+        ser_uint256_vector_into(w, self.vHave)
+
     def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += ser_uint256_vector(self.vHave)
-        return r
+        w = bytearray()
+        self.serialize_into(w)
+        return bytes(w)
 
     def __repr__(self):
         return "CBlockLocator(nVersion=%i vHave=%s)" \
             % (self.nVersion, repr(self.vHave))
 
 
-class COutPoint():
+# CTransaction caches its serializations and hashes. When it fills its
+# cache, it hands a _CacheToken to itself and to every object and vector it's
+# made of, and the cache stays valid as long as the token does. Modifying any
+# of these objects invalidates the tokens it holds, so only the transactions
+# it's part of are affected. An object can hold the tokens of several
+# transactions, when inputs, outputs or whole vectors are shared.
+class _CacheToken():
+    __slots__ = ("valid",)
+
+    def __init__(self):
+        self.valid = True
+
+_object_setattr = object.__setattr__
+
+def _add_owner(obj, token):
+    """Give token to obj (a TxComponent or TrackedList)."""
+    owners = obj._owners
+    if owners is None or owners.__class__ is _CacheToken and not owners.valid:
+        _object_setattr(obj, "_owners", token)
+    elif owners is not token:
+        if owners.__class__ is _CacheToken:
+            owners = [owners]
+        else:
+            owners = [t for t in owners if t.valid]
+        owners.append(token)
+        # Skips TxComponent.__setattr__, which would invalidate the tokens
+        _object_setattr(obj, "_owners", owners)
+
+def _invalidate_owners(owners):
+    if owners.__class__ is _CacheToken:
+        owners.valid = False
+    else:
+        for token in owners:
+            token.valid = False
+
+def _slot_setters(cls):
+    """Return the __set__ methods of the slots of a TxComponent class.
+
+    Constructors fill in new objects with them, which skips __setattr__ (and
+    is about as fast as writing to a __dict__)."""
+    return tuple(getattr(cls, name).__set__ for name in cls.__slots__)
+
+class TrackedList(list):
+    """A list that invalidates cached transaction serializations when modified.
+
+    Used for the vectors held by transactions and their components (vin, vout,
+    vtxinwit and witness stacks). Plain lists assigned to those attributes are
+    copied into a new TrackedList, so changes made afterwards through the
+    original list don't affect the transaction."""
+    __slots__ = ("_owners",)
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self._owners = None
+
+    def _modified(self):
+        owners = self._owners
+        if owners is not None:
+            self._owners = None
+            _invalidate_owners(owners)
+
+    def __setitem__(self, key, value):
+        self._modified()
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._modified()
+        super().__delitem__(key)
+
+    def __iadd__(self, other):
+        self._modified()
+        return super().__iadd__(other)
+
+    def __imul__(self, n):
+        self._modified()
+        return super().__imul__(n)
+
+    def append(self, x):
+        self._modified()
+        super().append(x)
+
+    def extend(self, iterable):
+        self._modified()
+        super().extend(iterable)
+
+    def insert(self, i, x):
+        self._modified()
+        super().insert(i, x)
+
+    def pop(self, *args):
+        self._modified()
+        return super().pop(*args)
+
+    def remove(self, x):
+        self._modified()
+        super().remove(x)
+
+    def clear(self):
+        self._modified()
+        super().clear()
+
+    def sort(self, *args, **kwargs):
+        self._modified()
+        super().sort(*args, **kwargs)
+
+    def reverse(self):
+        self._modified()
+        super().reverse()
+
+
+class TxComponent():
+    """Base class for the objects that make up a transaction.
+
+    Setting any attribute invalidates the cached serializations of the
+    transactions the object is part of. Plain lists are copied into a
+    TrackedList so that in-place changes are seen too (but, unlike with a
+    plain attribute, the transaction no longer shares the assigned list).
+
+    Constructors set their attributes with the setters from _slot_setters()
+    instead: a new object can't be part of any cached serialization yet.
+
+    The classes define __slots__, so that the hundreds of thousands of
+    transactions some tests keep in memory don't each carry a __dict__ per
+    component."""
+    __slots__ = ("_owners",)
+
+    def __setattr__(self, name, value):
+        owners = self._owners
+        if owners is not None:
+            _set_owners(self, None)
+            _invalidate_owners(owners)
+        if value.__class__ is list:
+            value = TrackedList(value)
+        object.__setattr__(self, name, value)
+
+_set_owners, = _slot_setters(TxComponent)
+
+
+class COutPoint(TxComponent):
+    __slots__ = ("hash", "n")
+
     def __init__(self, hash=0, n=0):
-        self.hash = hash
-        self.n = n
+        _set_owners(self, None)
+        _set_outpoint_hash(self, hash)
+        _set_outpoint_n(self, n)
 
     def deserialize(self, f):
         self.hash = deser_uint256(f)
-        self.n = struct.unpack("<I", f.read(4))[0]
+        self.n = deser_struct(f, _U32)[0]
+
+    def serialize_into(self, w):
+        ser_uint256_into(w, self.hash)
+        w += _U32.pack(self.n)
 
     def serialize(self):
-        r = b""
-        r += ser_uint256(self.hash)
-        r += struct.pack("<I", self.n)
-        return r
+        w = bytearray()
+        self.serialize_into(w)
+        return bytes(w)
 
     def __repr__(self):
         return "COutPoint(hash=%064x n=%i)" % (self.hash, self.n)
 
+_set_outpoint_hash, _set_outpoint_n = _slot_setters(COutPoint)
+
+
+class CTxIn(TxComponent):
+    __slots__ = ("prevout", "scriptSig", "nSequence")
 
-class CTxIn():
     def __init__(self, outpoint=None, scriptSig=b"", nSequence=0):
+        _set_owners(self, None)
         if outpoint is None:
-            self.prevout = COutPoint()
+            _set_txin_prevout(self, COutPoint())
         else:
-            self.prevout = outpoint
-        self.scriptSig = scriptSig
-        self.nSequence = nSequence
+            _set_txin_prevout(self, outpoint)
+        _set_txin_scriptSig(self, scriptSig)
+        _set_txin_nSequence(self, nSequence)
 
     def deserialize(self, f):
         self.prevout = COutPoint()
         self.prevout.deserialize(f)
         self.scriptSig = deser_string(f)
-        self.nSequence = struct.unpack("<I", f.read(4))[0]
+        self.nSequence = deser_struct(f, _U32)[0]
+
+    def serialize_into(self, w):
+        self.prevout.serialize_into(w)
+        ser_string_into(w, self.scriptSig)
+        w += _U32.pack(self.nSequence)
 
     def serialize(self):
-        r = b""
-        r += self.prevout.serialize()
-        r += ser_string(self.scriptSig)
-        r += struct.pack("<I", self.nSequence)
-        return r
+        w = bytearray()
+        self.serialize_into(w)
+        return bytes(w)
 
     def __repr__(self):
         return "CTxIn(prevout=%s scriptSig=%s nSequence=%i)" \
             % (repr(self.prevout), bytes_to_hex_str(self.scriptSig),
                self.nSequence)
 
+_set_txin_prevout, _set_txin_scriptSig, _set_txin_nSequence = _slot_setters(CTxIn)
+
+
+class CTxOut(TxComponent):
+    __slots__ = ("nValue", "scriptPubKey")
 
-class CTxOut():
     def __init__(self, nValue=0, scriptPubKey=b""):
-        self.nValue = nValue
-        self.scriptPubKey = scriptPubKey
+        _set_owners(self, None)
+        _set_txout_nValue(self, nValue)
+        _set_txout_scriptPubKey(self, scriptPubKey)
 
     def deserialize(self, f):
-        self.nValue = struct.unpack("<q", f.read(8))[0]
+        self.nValue = deser_struct(f, _I64)[0]
         self.scriptPubKey = deser_string(f)
 
+    def serialize_into(self, w):
+        w += _I64.pack(self.nValue)
+        ser_string_into(w, self.scriptPubKey)
+
     def serialize(self):
-        r = b""
-        r += struct.pack("<q", self.nValue)
-        r += ser_string(self.scriptPubKey)
-        return r
+        w = bytearray()
+        self.serialize_into(w)
+        return bytes(w)
 
     def __repr__(self):
         return "CTxOut(nValue=%i.%08i scriptPubKey=%s)" \
             % (self.nValue // COIN, self.nValue % COIN,
                bytes_to_hex_str(self.scriptPubKey))
 
+_set_txout_nValue, _set_txout_scriptPubKey = _slot_setters(CTxOut)
+
+
+class CScriptWitness(TxComponent):
+    __slots__ = ("stack",)
 
-class CScriptWitness():
     def __init__(self):
+        _set_owners(self, None)
         # stack is a vector of strings
-        self.stack = []
+        _set_scriptwitness_stack(self, TrackedList())
 
     def __repr__(self):
         return "CScriptWitness(%s)" % \
@@ -338,14 +667,22 @@ class CScriptWitness():
             return False
         return True
 
+_set_scriptwitness_stack, = _slot_setters(CScriptWitness)
+
+
+class CTxInWitness(TxComponent):
+    __slots__ = ("scriptWitness",)
 
-class CTxInWitness():
     def __init__(self):
-        self.scriptWitness = CScriptWitness()
+        _set_owners(self, None)
+        _set_txinwitness_scriptWitness(self, CScriptWitness())
 
     def deserialize(self, f):
         self.scriptWitness.stack = deser_string_vector(f)
 
+    def serialize_into(self, w):
+        ser_string_vector_into(w, self.scriptWitness.stack)
+
     def serialize(self):
         return ser_string_vector(self.scriptWitness.stack)
 
@@ -355,23 +692,31 @@ class CTxInWitness():
     def is_null(self):
         return self.scriptWitness.is_null()
 
+_set_txinwitness_scriptWitness, = _slot_setters(CTxInWitness)
+
+
+class CTxWitness(TxComponent):
+    __slots__ = ("vtxinwit",)
 
-class CTxWitness():
     def __init__(self):
-        self.vtxinwit = []
+        _set_owners(self, None)
+        _set_txwitness_vtxinwit(self, TrackedList())
 
     def deserialize(self, f):
         for i in range(len(self.vtxinwit)):
             self.vtxinwit[i].deserialize(f)
 
-    def serialize(self):
-        r = b""
+    def serialize_into(self, w):
         # This is different than the usual vector serialization --
         # we omit the length of the vector, which is required to be
         # the same length as the transaction's vin vector.
         for x in self.vtxinwit:
-            r += x.serialize()
-        return r
+            x.serialize_into(w)
+
+    def serialize(self):
+        w = bytearray()
+        self.serialize_into(w)
+        return bytes(w)
 
     def __repr__(self):
         return "CTxWitness(%s)" % \
@@ -383,32 +728,47 @@ class CTxWitness():
                 return False
         return True
 
+_set_txwitness_vtxinwit, = _slot_setters(CTxWitness)
+
+
+class CTransaction(TxComponent):
+    # Attributes that hold cached values rather than transaction data.
+    # Setting them doesn't invalidate the serialization cache.
+    _cache_attrs = frozenset(("sha256", "hash", "_cache", "_cache_token", "_sighash_cache"))
+    __slots__ = ("nVersion", "vin", "vout", "wit", "nLockTime",
+                 "sha256", "hash", "_cache", "_cache_token", "_sighash_cache")
 
-class CTransaction():
     def __init__(self, tx=None):
+        _set_owners(self, None)
+        _set_tx__cache(self, {})
+        _set_tx__cache_token(self, None)
+        # Serialized parts for script.SignatureHash(), which checks them itself
+        _set_tx__sighash_cache(self, {})
         if tx is None:
-            self.nVersion = 1
-            self.vin = []
-            self.vout = []
-            self.wit = CTxWitness()
-            self.nLockTime = 0
-            self.sha256 = None
-            self.hash = None
+            _set_tx_nVersion(self, 1)
+            _set_tx_vin(self, TrackedList())
+            _set_tx_vout(self, TrackedList())
+            _set_tx_wit(self, CTxWitness())
+            _set_tx_nLockTime(self, 0)
+            _set_tx_sha256(self, None)
+            _set_tx_hash(self, None)
         else:
-            self.nVersion = tx.nVersion
-            self.vin = copy.deepcopy(tx.vin)
-            self.vout = copy.deepcopy(tx.vout)
-            self.nLockTime = tx.nLockTime
-            self.sha256 = tx.sha256
-            self.hash = tx.hash
-            self.wit = copy.deepcopy(tx.wit)
+            _set_tx_nVersion(self, tx.nVersion)
+            _set_tx_vin(self, TrackedList(copy.deepcopy(tx.vin)))
+            _set_tx_vout(self, TrackedList(copy.deepcopy(tx.vout)))
+            _set_tx_nLockTime(self, tx.nLockTime)
+            _set_tx_sha256(self, tx.sha256)
+            _set_tx_hash(self, tx.hash)
+            _set_tx_wit(self, copy.deepcopy(tx.wit))
 
     def deserialize(self, f):
-        self.nVersion = struct.unpack("<i", f.read(4))[0]
+        if f.__class__ is BufferReader:
+            return self._deserialize_buffer(f)
+        self.nVersion = deser_struct(f, _I32)[0]
         self.vin = deser_vector(f, CTxIn)
         flags = 0
         if len(self.vin) == 0:
-            flags = struct.unpack("<B", f.read(1))[0]
+            flags = deser_struct(f, _U8)[0]
             # Not sure why flags can't be zero, but this
             # matches the implementation in bitcoind
             if (flags != 0):
@@ -419,43 +779,139 @@ class CTransaction():
         if flags != 0:
             self.wit.vtxinwit = [CTxInWitness() for i in range(len(self.vin))]
             self.wit.deserialize(f)
-        self.nLockTime = struct.unpack("<I", f.read(4))[0]
+        self.nLockTime = deser_struct(f, _U32)[0]
         self.sha256 = None
         self.hash = None
 
+    def _deserialize_buffer(self, f):
+        """deserialize() from a BufferReader, decoding inputs and outputs in place.
+
+        Invalidates the serialization cache once up front and then fills in
+        the transaction without going through __setattr__."""
+        owners = self._owners
+        if owners is not None:
+            _set_owners(self, None)
+            _invalidate_owners(owners)
+        buf = f.buf
+        pos = f.pos
+        _set_tx_nVersion(self, _I32.unpack_from(buf, pos)[0])
+        vin, pos = _read_txins(buf, pos + 4)
+        flags = 0
+        if len(vin) == 0:
+            flags = _U8.unpack_from(buf, pos)[0]
+            pos += 1
+            # Not sure why flags can't be zero, but this
+            # matches the implementation in bitcoind
+            if (flags != 0):
+                vin, pos = _read_txins(buf, pos)
+                vout, pos = _read_txouts(buf, pos)
+                _set_tx_vout(self, vout)
+        else:
+            vout, pos = _read_txouts(buf, pos)
+            _set_tx_vout(self, vout)
+        _set_tx_vin(self, vin)
+        if flags != 0:
+            vtxinwit = []
+            for i in range(len(vin)):
+                nit, pos = _read_compact_size(buf, pos)
+                stack = []
+                for j in range(nit):
+                    item, pos = _read_string(buf, pos)
+                    stack.append(item)
+                inwit = CTxInWitness()
+                _set_scriptwitness_stack(inwit.scriptWitness, TrackedList(stack))
+                vtxinwit.append(inwit)
+            _set_txwitness_vtxinwit(self.wit, TrackedList(vtxinwit))
+        _set_tx_nLockTime(self, _U32.unpack_from(buf, pos)[0])
+        f.pos = pos + 4
+        _set_tx_sha256(self, None)
+        _set_tx_hash(self, None)
+
+    def __setattr__(self, name, value):
+        if name in self._cache_attrs:
+            object.__setattr__(self, name, value)
+        else:
+            super().__setattr__(name, value)
+
+    def _get_cache(self):
+        """Return the dict of cached serializations and hashes, emptying it
+        first if anything has been modified since it was filled."""
+        token = self._cache_token
+        if token is None or not token.valid:
+            token = _CacheToken()
+            self._add_owner(token)
+            self._cache = {}
+            self._cache_token = token
+        return self._cache
+
+    def _add_owner(self, token):
+        """Give token to the transaction and to everything it's made of."""
+        _add_owner(self, token)
+        _add_owner(self.vin, token)
+        for txin in self.vin:
+            _add_owner(txin, token)
+            _add_owner(txin.prevout, token)
+        _add_owner(self.vout, token)
+        for txout in self.vout:
+            _add_owner(txout, token)
+        _add_owner(self.wit, token)
+        _add_owner(self.wit.vtxinwit, token)
+        for inwit in self.wit.vtxinwit:
+            _add_owner(inwit, token)
+            _add_owner(inwit.scriptWitness, token)
+            _add_owner(inwit.scriptWitness.stack, token)
+
     def serialize_without_witness(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += ser_vector(self.vin)
-        r += ser_vector(self.vout)
-        r += struct.pack("<I", self.nLockTime)
-        return r
+        cache = self._get_cache()
+        if "without_witness" not in cache:
+            w = bytearray()
+            w += _I32.pack(self.nVersion)
+            ser_vector_into(w, self.vin)
+            ser_vector_into(w, self.vout)
+            w += _U32.pack(self.nLockTime)
+            cache["without_witness"] = bytes(w)
+        return cache["without_witness"]
 
     # Only serialize with witness when explicitly called for
     def serialize_with_witness(self):
+        cache = self._get_cache()
+        if "with_witness" not in cache:
+            r = self._serialize_with_witness()
+            # _serialize_with_witness() may have padded vtxinwit, which
+            # empties the cache, so fetch it again before storing.
+            cache = self._get_cache()
+            cache["with_witness"] = r
+        return cache["with_witness"]
+
+    def _serialize_with_witness(self):
         flags = 0
         if not self.wit.is_null():
             flags |= 1
-        r = b""
-        r += struct.pack("<i", self.nVersion)
+        w = bytearray()
+        w += _I32.pack(self.nVersion)
         if flags:
             dummy = []
-            r += ser_vector(dummy)
-            r += struct.pack("<B", flags)
-        r += ser_vector(self.vin)
-        r += ser_vector(self.vout)
+            ser_vector_into(w, dummy)
+            w += _U8.pack(flags)
+        ser_vector_into(w, self.vin)
+        ser_vector_into(w, self.vout)
         if flags & 1:
             if (len(self.wit.vtxinwit) != len(self.vin)):
                 # vtxinwit must have the same length as vin
                 self.wit.vtxinwit = self.wit.vtxinwit[:len(self.vin)]
                 for i in range(len(self.wit.vtxinwit), len(self.vin)):
                     self.wit.vtxinwit.append(CTxInWitness())
-            r += self.wit.serialize()
-        r += struct.pack("<I", self.nLockTime)
-        return r
+            self.wit.serialize_into(w)
+        w += _U32.pack(self.nLockTime)
+        return bytes(w)
 
     # Regular serialization is with witness -- must explicitly
     # call serialize_without_witness to exclude witness data.
+    # The serializations are cached, so serialize_into() appends the
+    # cached bytes.
+    def serialize_into(self, w):
+        w += self.serialize_with_witness()
+
     def serialize(self):
         return self.serialize_with_witness()
 
@@ -464,16 +920,31 @@ class CTransaction():
         self.sha256 = None
         self.calc_sha256()
 
-    # We will only cache the serialization without witness in
-    # self.sha256 and self.hash -- those are expected to be the txid.
+    # Return the double-SHA256 of the serialization without (txid) or with
+    # (wtxid) witness. Both are cached until the transaction is modified.
+    def _get_hash(self, with_witness):
+        key = "wtxid" if with_witness else "txid"
+        cache = self._get_cache()
+        if key not in cache:
+            if with_witness:
+                h = hash256(self.serialize_with_witness())
+            else:
+                h = hash256(self.serialize_without_witness())
+            cache = self._get_cache()
+            cache[key] = h
+        return cache[key]
+
+    # Only the txid (hash without witness) is stored in self.sha256 and
+    # self.hash. self.sha256 is only recomputed by rehash(), while self.hash
+    # always reflects the current transaction.
     def calc_sha256(self, with_witness=False):
         if with_witness:
-            # Don't cache the result, just return it
-            return uint256_from_str(hash256(self.serialize_with_witness()))
+            return uint256_from_str(self._get_hash(True))
 
+        h = self._get_hash(False)
         if self.sha256 is None:
-            self.sha256 = uint256_from_str(hash256(self.serialize_without_witness()))
-        self.hash = encode(hash256(self.serialize_without_witness())[::-1], 'hex_codec').decode('ascii')
+            self.sha256 = uint256_from_str(h)
+        self.hash = encode(h[::-1], 'hex_codec').decode('ascii')
 
     def is_valid(self):
         self.calc_sha256()
@@ -486,8 +957,15 @@ class CTransaction():
         return "CTransaction(nVersion=%i vin=%s vout=%s wit=%s nLockTime=%i)" \
             % (self.nVersion, repr(self.vin), repr(self.vout), repr(self.wit), self.nLockTime)
 
+(_set_tx_nVersion, _set_tx_vin, _set_tx_vout, _set_tx_wit, _set_tx_nLockTime,
+ _set_tx_sha256, _set_tx_hash, _set_tx__cache, _set_tx__cache_token,
+ _set_tx__sighash_cache) = _slot_setters(CTransaction)
+
 
 class CBlockHeader():
+    __slots__ = ("nVersion", "hashPrevBlock", "hashMerkleRoot", "nTime", "nBits", "nNonce",
+                 "sha256", "hash", "_scrypt256", "_pow_header")
+
     def __init__(self, header=None):
         if header is None:
             self.set_null()
@@ -500,7 +978,8 @@ class CBlockHeader():
             self.nNonce = header.nNonce
             self.sha256 = header.sha256
             self.hash = header.hash
-            self.scrypt256 = header.scrypt256
+            self._scrypt256 = header._scrypt256
+            self._pow_header = header._pow_header
             self.calc_sha256()
 
     def set_null(self):
@@ -515,38 +994,64 @@ class CBlockHeader():
         self.scrypt256 = None
 
     def deserialize(self, f):
-        self.nVersion = struct.unpack("<i", f.read(4))[0]
+        self.nVersion = deser_struct(f, _I32)[0]
         self.hashPrevBlock = deser_uint256(f)
         self.hashMerkleRoot = deser_uint256(f)
-        self.nTime = struct.unpack("<I", f.read(4))[0]
-        self.nBits = struct.unpack("<I", f.read(4))[0]
-        self.nNonce = struct.unpack("<I", f.read(4))[0]
+        self.nTime = deser_struct(f, _U32)[0]
+        self.nBits = deser_struct(f, _U32)[0]
+        self.nNonce = deser_struct(f, _U32)[0]
         self.sha256 = None
         self.hash = None
         self.scrypt256 = None
 
+    # The header without nNonce. This is the part that stays fixed while
+    # grinding nonces.
+    def serialize_prefix_into(self, w):
+        w += _I32.pack(self.nVersion)
+        ser_uint256_into(w, self.hashPrevBlock)
+        ser_uint256_into(w, self.hashMerkleRoot)
+        w += _U32.pack(self.nTime)
+        w += _U32.pack(self.nBits)
+
+    def serialize_prefix(self):
+        w = bytearray()
+        self.serialize_prefix_into(w)
+        return bytes(w)
+
+    def serialize_into(self, w):
+        self.serialize_prefix_into(w)
+        w += _U32.pack(self.nNonce)
+
+    # The header alone, also when called on a CBlock (whose serialize_into()
+    # appends the transactions).
     def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += ser_uint256(self.hashPrevBlock)
-        r += ser_uint256(self.hashMerkleRoot)
-        r += struct.pack("<I", self.nTime)
-        r += struct.pack("<I", self.nBits)
-        r += struct.pack("<I", self.nNonce)
-        return r
+        w = bytearray()
+        CBlockHeader.serialize_into(self, w)
+        return bytes(w)
 
     def calc_sha256(self):
         if self.sha256 is None:
-            r = b""
-            r += struct.pack("<i", self.nVersion)
-            r += ser_uint256(self.hashPrevBlock)
-            r += ser_uint256(self.hashMerkleRoot)
-            r += struct.pack("<I", self.nTime)
-            r += struct.pack("<I", self.nBits)
-            r += struct.pack("<I", self.nNonce)
-            self.sha256 = uint256_from_str(hash256(r))
-            self.hash = encode(hash256(r)[::-1], 'hex_codec').decode('ascii')
-            self.scrypt256 = uint256_from_str(cascoin_scrypt.getPoWHash(r))
+            r = CBlockHeader.serialize(self)
+            h = hash256(r)
+            self.sha256 = uint256_from_str(h)
+            self.hash = encode(h[::-1], 'hex_codec').decode('ascii')
+            # The scrypt hash is expensive and rarely needed, so only keep
+            # the serialized header and compute it when scrypt256 is read.
+            self._scrypt256 = None
+            self._pow_header = r
+
+    # The scrypt proof-of-work hash, matching the header as of the last
+    # calc_sha256()/rehash().
+    @property
+    def scrypt256(self):
+        if self._scrypt256 is None and self._pow_header is not None:
+            self._scrypt256 = get_pow_hash(self._pow_header)
+        return self._scrypt256
+
+    @scrypt256.setter
+    def scrypt256(self, value):
+        self._scrypt256 = value
+        self._pow_header = None
 
     def rehash(self):
         self.sha256 = None
@@ -564,37 +1069,44 @@ class CBlock(CBlockHeader):
     def __init__(self, header=None):
         super(CBlock, self).__init__(header)
         self.vtx = []
+        # Trees of the txids and wtxids as of the last calc_merkle_root()
+        # and calc_witness_merkle_root(), updated incrementally by them
+        self.merkle_tree = MerkleTree()
+        self.witness_merkle_tree = MerkleTree()
 
     def deserialize(self, f):
         super(CBlock, self).deserialize(f)
         self.vtx = deser_vector(f, CTransaction)
 
-    def serialize(self, with_witness=False):
-        r = b""
-        r += super(CBlock, self).serialize()
+    def serialize_into(self, w, with_witness=False):
+        super(CBlock, self).serialize_into(w)
         if with_witness:
-            r += ser_vector(self.vtx, "serialize_with_witness")
+            ser_vector_into(w, self.vtx, "serialize_with_witness")
         else:
-            r += ser_vector(self.vtx, "serialize_without_witness")
-        return r
+            ser_vector_into(w, self.vtx, "serialize_without_witness")
+
+    def serialize(self, with_witness=False):
+        w = bytearray()
+        self.serialize_into(w, with_witness)
+        return bytes(w)
 
     # Calculate the merkle root given a vector of transaction hashes
     @classmethod
     def get_merkle_root(cls, hashes):
-        while len(hashes) > 1:
-            newhashes = []
-            for i in range(0, len(hashes), 2):
-                i2 = min(i+1, len(hashes)-1)
-                newhashes.append(hash256(hashes[i] + hashes[i2]))
-            hashes = newhashes
-        return uint256_from_str(hashes[0])
+        return uint256_from_str(MerkleTree(hashes).root())
 
+    # The leaves are the transactions' sha256, which (as for the block's
+    # hash) are only computed if not set yet: rehash() transactions after
+    # modifying them. Only the paths of changed, added or removed
+    # transactions are rehashed.
     def calc_merkle_root(self):
         hashes = []
         for tx in self.vtx:
-            tx.calc_sha256()
+            if tx.sha256 is None:
+                tx.calc_sha256()
             hashes.append(ser_uint256(tx.sha256))
-        return self.get_merkle_root(hashes)
+        self.merkle_tree.update(hashes)
+        return uint256_from_str(self.merkle_tree.root())
 
     def calc_witness_merkle_root(self):
         # For witness root purposes, the hash of the
@@ -605,7 +1117,13 @@ class CBlock(CBlockHeader):
             # Calculate the hashes with witness data
             hashes.append(ser_uint256(tx.calc_sha256(True)))
 
-        return self.get_merkle_root(hashes)
+        self.witness_merkle_tree.update(hashes)
+        return uint256_from_str(self.witness_merkle_tree.root())
+
+    # The merkle branch of the index-th transaction, as a list of hashes
+    # (see merkle.branch_root()), as of the last calc_merkle_root()
+    def get_merkle_branch(self, index):
+        return [uint256_from_str(h) for h in self.merkle_tree.branch(index)]
 
     def is_valid(self):
         self.calc_sha256()
@@ -619,12 +1137,19 @@ class CBlock(CBlockHeader):
             return False
         return True
 
-    def solve(self):
-        self.rehash()
+    # Increment nNonce until the scrypt hash meets the target. Only the
+    # nonce is re-packed for each attempt. If a multiprocessing pool (and
+    # its number of processes) is given, nonces are hashed in batches on its
+    # workers; the resulting nonce is the same either way. Uses the on-disk
+    # nonce cache if enabled (see powsolver.enable_pow_cache()).
+    def solve(self, pool=None, processes=None):
         target = uint256_from_compact(self.nBits)
-        while self.scrypt256 > target:
-            self.nNonce += 1
-            self.rehash()
+        result = solve_header(self.serialize_prefix(), target, self.nNonce, pool, processes)
+        if result is None:
+            raise RuntimeError("No nonce above %d solves block" % self.nNonce)
+        self.nNonce, scrypt256 = result
+        self.rehash()
+        self._scrypt256 = scrypt256
 
     def __repr__(self):
         return "CBlock(nVersion=%i hashPrevBlock=%064x hashMerkleRoot=%064x nTime=%s nBits=%08x nNonce=%08x vtx=%s)" \
@@ -632,6 +1157,262 @@ class CBlock(CBlockHeader):
                time.ctime(self.nTime), self.nBits, self.nNonce, repr(self.vtx))
 
 
+# Where a serialized transaction is in a buffer: it spans [offset, end), and
+# its witness data starts at witness_offset (None if it has no witness).
+TxSpan = namedtuple("TxSpan", ["offset", "end", "witness_offset"])
+
+def _skip_txins(buf, pos, count):
+    for i in range(count):
+        n, pos = _read_compact_size(buf, pos + 36)
+        pos += n + 4
+    return pos
+
+def _skip_strings(buf, pos, count, prefix=0):
+    """Skip count strings, each after prefix bytes of fixed-size fields."""
+    for i in range(count):
+        n, pos = _read_compact_size(buf, pos + prefix)
+        pos += n
+    return pos
+
+def scan_transactions(buf, pos, count):
+    """Yield the TxSpans of count serialized transactions starting at pos.
+
+    Only the lengths needed to find the end of each transaction are read,
+    following CTransaction.deserialize(); nothing is decoded or copied."""
+    for i in range(count):
+        start = pos
+        nin, pos = _read_compact_size(buf, pos + 4)
+        flags = 0
+        witness_offset = None
+        if nin == 0:
+            flags = buf[pos]
+            pos += 1
+            if flags != 0:
+                nin, pos = _read_compact_size(buf, pos)
+                pos = _skip_txins(buf, pos, nin)
+                nout, pos = _read_compact_size(buf, pos)
+                pos = _skip_strings(buf, pos, nout, 8)
+        else:
+            pos = _skip_txins(buf, pos, nin)
+            nout, pos = _read_compact_size(buf, pos)
+            pos = _skip_strings(buf, pos, nout, 8)
+        if flags != 0:
+            witness_offset = pos
+            for j in range(nin):
+                nit, pos = _read_compact_size(buf, pos)
+                pos = _skip_strings(buf, pos, nit)
+        pos += 4
+        if pos > len(buf):
+            raise struct.error("transaction %d runs past end of buffer" % i)
+        yield TxSpan(start, pos, witness_offset)
+
+
+class LazyBlock():
+    """A serialized block whose transactions are only decoded when accessed.
+
+    The header is decoded up front. The transactions are found with
+    scan_transactions() as far as needed, and their txids are hashed from
+    the serialized data, so listing the txids of a block or reading one of
+    its transactions doesn't build a CTransaction for every other one.
+    Indexing returns decoded CTransactions, which are kept."""
+
+    def __init__(self, data):
+        self.buf = memoryview(data)
+        f = BufferReader(data)
+        self.header = CBlockHeader()
+        self.header.deserialize(f)
+        self.header.calc_sha256()
+        self.tx_count = deser_compact_size(f)
+        self.spans = []
+        self._scan = scan_transactions(self.buf, f.pos, self.tx_count)
+        # index -> decoded CTransaction
+        self._txs = {}
+
+    def __len__(self):
+        return self.tx_count
+
+    def _index(self, i):
+        if i < 0:
+            i += self.tx_count
+        if not 0 <= i < self.tx_count:
+            raise IndexError("block has %d transactions" % self.tx_count)
+        return i
+
+    def get_span(self, i):
+        i = self._index(i)
+        while len(self.spans) <= i:
+            self.spans.append(next(self._scan))
+        return self.spans[i]
+
+    def iter_spans(self):
+        for i in range(self.tx_count):
+            yield self.get_span(i)
+
+    def get_raw_transaction(self, i, with_witness=True):
+        """Return the serialization of a transaction (as a memoryview into the block)."""
+        span = self.get_span(i)
+        if with_witness or span.witness_offset is None:
+            return self.buf[span.offset:span.end]
+        buf = self.buf
+        # Leave out the marker and flag bytes and the witnesses
+        return memoryview(b"".join((buf[span.offset:span.offset + 4],
+                                    buf[span.offset + 6:span.witness_offset],
+                                    buf[span.end - 4:span.end])))
+
+    def get_txid(self, i):
+        return uint256_from_str(hash256(self.get_raw_transaction(i, with_witness=False)))
+
+    def get_wtxid(self, i):
+        return uint256_from_str(hash256(self.get_raw_transaction(i)))
+
+    def txids(self):
+        for i in range(self.tx_count):
+            yield self.get_txid(i)
+
+    def __getitem__(self, i):
+        i = self._index(i)
+        tx = self._txs.get(i)
+        if tx is None:
+            span = self.get_span(i)
+            tx = CTransaction()
+            tx.deserialize(BufferReader(self.buf[:span.end], span.offset))
+            self._txs[i] = tx
+        return tx
+
+    def __iter__(self):
+        for i in range(self.tx_count):
+            yield self[i]
+
+    def to_block(self):
+        """Return the block as a CBlock, decoding all its transactions."""
+        block = CBlock(self.header)
+        block.vtx = list(self)
+        return block
+
+    def __repr__(self):
+        return "LazyBlock(header=%s, tx_count=%d)" % (repr(self.header), self.tx_count)
+
+
+class CPartialMerkleTree():
+    """The transactions of a block matching a filter, with the merkle tree
+    hashes needed to check that they're in the block (merkleblock.h).
+
+    vBits has a boolean per node of the traversal, vHash the hashes (as
+    ints) of the nodes that aren't expanded."""
+
+    def __init__(self):
+        self.nTransactions = 0
+        self.vHash = []
+        self.vBits = []
+
+    def initialize_from_tree(self, tree, matches):
+        """Build the partial tree of a MerkleTree, for the leaves matches is true for."""
+        self.nTransactions = len(tree)
+        self.vBits, hashes = tree.partial(matches)
+        self.vHash = [uint256_from_str(h) for h in hashes]
+
+    def deserialize(self, f):
+        self.nTransactions = deser_struct(f, _U32)[0]
+        self.vHash = deser_uint256_vector(f)
+        vBytes = deser_string(f)
+        self.vBits = [vBytes[i // 8] & (1 << (i % 8)) != 0 for i in range(len(vBytes) * 8)]
+
+    def serialize_into(self, w):
+        w += _U32.pack(self.nTransactions)
+        ser_uint256_vector_into(w, self.vHash)
+        vBytes = bytearray((len(self.vBits) + 7) // 8)
+        for i, bit in enumerate(self.vBits):
+            vBytes[i // 8] |= bit << (i % 8)
+        ser_string_into(w, vBytes)
+
+    def serialize(self):
+        w = bytearray()
+        self.serialize_into(w)
+        return bytes(w)
+
+    def extract_matches(self):
+        """Return the merkle root and the list of (index, txid) of the matched transactions.
+
+        Like CPartialMerkleTree::ExtractMatches(), raise ValueError if the
+        tree is malformed: bits or hashes are missing or left over, or two
+        children of a node are identical (CVE-2012-2459)."""
+        if self.nTransactions == 0:
+            raise ValueError("Partial merkle tree has no transactions")
+        if len(self.vHash) > self.nTransactions:
+            raise ValueError("Partial merkle tree has more hashes than transactions")
+        if len(self.vBits) < len(self.vHash):
+            raise ValueError("Partial merkle tree has fewer bits than hashes")
+        height = 0
+        while (self.nTransactions + (1 << height) - 1) >> height > 1:
+            height += 1
+        bits = iter(self.vBits)
+        hashes = iter(self.vHash)
+        matches = []
+        bits_used = 0
+
+        def traverse(k, pos):
+            nonlocal bits_used
+            bit = next(bits, None)
+            if bit is None:
+                raise ValueError("Partial merkle tree has too few bits")
+            bits_used += 1
+            if k == 0 or not bit:
+                h = next(hashes, None)
+                if h is None:
+                    raise ValueError("Partial merkle tree has too few hashes")
+                if k == 0 and bit:
+                    matches.append((pos, h))
+                return ser_uint256(h)
+            left = traverse(k - 1, pos * 2)
+            if pos * 2 + 1 < (self.nTransactions + (1 << (k - 1)) - 1) >> (k - 1):
+                right = traverse(k - 1, pos * 2 + 1)
+                if right == left:
+                    raise ValueError("Partial merkle tree has identical children")
+            else:
+                right = left
+            return hash256(left + right)
+
+        root = traverse(height, 0)
+        if (bits_used + 7) // 8 != (len(self.vBits) + 7) // 8:
+            raise ValueError("Partial merkle tree has unused bits")
+        if next(hashes, None) is not None:
+            raise ValueError("Partial merkle tree has unused hashes")
+        return uint256_from_str(root), matches
+
+    def __repr__(self):
+        return "CPartialMerkleTree(nTransactions=%d, vHash=%s, vBits=%s)" % (self.nTransactions, repr(self.vHash), repr(self.vBits))
+
+
+# A block header with a partial merkle tree, as returned by gettxoutproof
+class CMerkleBlock():
+    def __init__(self):
+        self.header = CBlockHeader()
+        self.txn = CPartialMerkleTree()
+
+    def initialize_from_block(self, block, txids):
+        """Build the merkle block of a CBlock, matching the transactions with the given txids."""
+        txids = set(txids)
+        block.calc_merkle_root()
+        self.header = CBlockHeader(block)
+        self.txn.initialize_from_tree(block.merkle_tree, [tx.sha256 in txids for tx in block.vtx])
+
+    def deserialize(self, f):
+        self.header.deserialize(f)
+        self.txn.deserialize(f)
+
+    def serialize_into(self, w):
+        self.header.serialize_into(w)
+        self.txn.serialize_into(w)
+
+    def serialize(self):
+        w = bytearray()
+        self.serialize_into(w)
+        return bytes(w)
+
+    def __repr__(self):
+        return "CMerkleBlock(header=%s, txn=%s)" % (repr(self.header), repr(self.txn))
+
+
 class PrefilledTransaction():
     def __init__(self, index=0, tx = None):
         self.index = index
@@ -642,14 +1423,17 @@ class PrefilledTransaction():
         self.tx = CTransaction()
         self.tx.deserialize(f)
 
-    def serialize(self, with_witness=True):
-        r = b""
-        r += ser_compact_size(self.index)
+    def serialize_into(self, w, with_witness=True):
+        ser_compact_size_into(w, self.index)
         if with_witness:
-            r += self.tx.serialize_with_witness()
+            w += self.tx.serialize_with_witness()
         else:
-            r += self.tx.serialize_without_witness()
-        return r
+            w += self.tx.serialize_without_witness()
+
+    def serialize(self, with_witness=True):
+        w = bytearray()
+        self.serialize_into(w, with_witness)
+        return bytes(w)
 
     def serialize_without_witness(self):
         return self.serialize(with_witness=False)
@@ -672,29 +1456,30 @@ class P2PHeaderAndShortIDs():
 
     def deserialize(self, f):
         self.header.deserialize(f)
-        self.nonce = struct.unpack("<Q", f.read(8))[0]
+        self.nonce = deser_struct(f, _U64)[0]
         self.shortids_length = deser_compact_size(f)
         for i in range(self.shortids_length):
-            # shortids are defined to be 6 bytes in the spec, so append
-            # two zero bytes and read it in as an 8-byte number
-            self.shortids.append(struct.unpack("<Q", f.read(6) + b'\x00\x00')[0])
+            # shortids are defined to be 6 bytes in the spec
+            self.shortids.append(int.from_bytes(f.read(6), 'little'))
         self.prefilled_txn = deser_vector(f, PrefilledTransaction)
         self.prefilled_txn_length = len(self.prefilled_txn)
 
     # When using version 2 compact blocks, we must serialize with_witness.
-    def serialize(self, with_witness=False):
-        r = b""
-        r += self.header.serialize()
-        r += struct.pack("<Q", self.nonce)
-        r += ser_compact_size(self.shortids_length)
+    def serialize_into(self, w, with_witness=False):
+        self.header.serialize_into(w)
+        w += _U64.pack(self.nonce)
+        ser_compact_size_into(w, self.shortids_length)
         for x in self.shortids:
             # We only want the first 6 bytes
-            r += struct.pack("<Q", x)[0:6]
-        if with_witness:
-            r += ser_vector(self.prefilled_txn, "serialize_with_witness")
-        else:
-            r += ser_vector(self.prefilled_txn, "serialize_without_witness")
-        return r
+            w += _U64.pack(x)[0:6]
+        ser_compact_size_into(w, len(self.prefilled_txn))
+        for x in self.prefilled_txn:
+            x.serialize_into(w, with_witness)
+
+    def serialize(self, with_witness=False):
+        w = bytearray()
+        self.serialize_into(w, with_witness)
+        return bytes(w)
 
     def __repr__(self):
         return "P2PHeaderAndShortIDs(header=%s, nonce=%d, shortids_length=%d, shortids=%s, prefilled_txn_length=%d, prefilledtxn=%s" % (repr(self.header), self.nonce, self.shortids_length, repr(self.shortids), self.prefilled_txn_length, repr(self.prefilled_txn))
@@ -702,6 +1487,9 @@ class P2PHeaderAndShortIDs():
 # P2P version of the above that will use witness serialization (for compact
 # block version 2)
 class P2PHeaderAndShortWitnessIDs(P2PHeaderAndShortIDs):
+    def serialize_into(self, w, with_witness=True):
+        super(P2PHeaderAndShortWitnessIDs, self).serialize_into(w, with_witness=True)
+
     def serialize(self):
         return super(P2PHeaderAndShortWitnessIDs, self).serialize(with_witness=True)
 
@@ -711,6 +1499,10 @@ def calculate_shortid(k0, k1, tx_hash):
     expected_shortid &= 0x0000ffffffffffff
     return expected_shortid
 
+# Calculate the shortids for a list of transaction hashes at once
+def calculate_shortids(k0, k1, tx_hashes):
+    return [h & 0x0000ffffffffffff for h in siphash256_batch(k0, k1, tx_hashes)]
+
 # This version gets rid of the array lengths, and reinterprets the differential
 # encoding into indices that can be used for lookup.
 class HeaderAndShortIDs():
@@ -763,12 +1555,15 @@ class HeaderAndShortIDs():
         self.shortids = []
         self.use_witness = use_witness
         [k0, k1] = self.get_siphash_keys()
+        prefilled = set(prefill_list)
+        tx_hashes = []
         for i in range(len(block.vtx)):
-            if i not in prefill_list:
+            if i not in prefilled:
                 tx_hash = block.vtx[i].sha256
                 if use_witness:
                     tx_hash = block.vtx[i].calc_sha256(with_witness=True)
-                self.shortids.append(calculate_shortid(k0, k1, tx_hash))
+                tx_hashes.append(tx_hash)
+        self.shortids = calculate_shortids(k0, k1, tx_hashes)
 
     def __repr__(self):
         return "HeaderAndShortIDs(header=%s, nonce=%d, shortids=%s, prefilledtxn=%s" % (repr(self.header), self.nonce, repr(self.shortids), repr(self.prefilled_txn))
@@ -786,13 +1581,16 @@ class BlockTransactionsRequest():
         for i in range(indexes_length):
             self.indexes.append(deser_compact_size(f))
 
-    def serialize(self):
-        r = b""
-        r += ser_uint256(self.blockhash)
-        r += ser_compact_size(len(self.indexes))
+    def serialize_into(self, w):
+        ser_uint256_into(w, self.blockhash)
+        ser_compact_size_into(w, len(self.indexes))
         for x in self.indexes:
-            r += ser_compact_size(x)
-        return r
+            ser_compact_size_into(w, x)
+
+    def serialize(self):
+        w = bytearray()
+        self.serialize_into(w)
+        return bytes(w)
 
     # helper to set the differentially encoded indexes from absolute ones
     def from_absolute(self, absolute_indexes):
@@ -824,14 +1622,17 @@ class BlockTransactions():
         self.blockhash = deser_uint256(f)
         self.transactions = deser_vector(f, CTransaction)
 
-    def serialize(self, with_witness=True):
-        r = b""
-        r += ser_uint256(self.blockhash)
+    def serialize_into(self, w, with_witness=True):
+        ser_uint256_into(w, self.blockhash)
         if with_witness:
-            r += ser_vector(self.transactions, "serialize_with_witness")
+            ser_vector_into(w, self.transactions, "serialize_with_witness")
         else:
-            r += ser_vector(self.transactions, "serialize_without_witness")
-        return r
+            ser_vector_into(w, self.transactions, "serialize_without_witness")
+
+    def serialize(self, with_witness=True):
+        w = bytearray()
+        self.serialize_into(w, with_witness)
+        return bytes(w)
 
     def __repr__(self):
         return "BlockTransactions(hash=%064x transactions=%s)" % (self.blockhash, repr(self.transactions))
@@ -853,18 +1654,18 @@ class msg_version():
         self.nRelay = MY_RELAY
 
     def deserialize(self, f):
-        self.nVersion = struct.unpack("<i", f.read(4))[0]
+        self.nVersion = deser_struct(f, _I32)[0]
         if self.nVersion == 10300:
             self.nVersion = 300
-        self.nServices = struct.unpack("<Q", f.read(8))[0]
-        self.nTime = struct.unpack("<q", f.read(8))[0]
+        self.nServices = deser_struct(f, _U64)[0]
+        self.nTime = deser_struct(f, _I64)[0]
         self.addrTo = CAddress()
         self.addrTo.deserialize(f)
 
         if self.nVersion >= 106:
             self.addrFrom = CAddress()
             self.addrFrom.deserialize(f)
-            self.nNonce = struct.unpack("<Q", f.read(8))[0]
+            self.nNonce = deser_struct(f, _U64)[0]
             self.strSubVer = deser_string(f)
         else:
             self.addrFrom = None
@@ -873,31 +1674,34 @@ class msg_version():
             self.nStartingHeight = None
 
         if self.nVersion >= 209:
-            self.nStartingHeight = struct.unpack("<i", f.read(4))[0]
+            self.nStartingHeight = deser_struct(f, _I32)[0]
         else:
             self.nStartingHeight = None
 
         if self.nVersion >= 70001:
             # Relay field is optional for version 70001 onwards
             try:
-                self.nRelay = struct.unpack("<b", f.read(1))[0]
+                self.nRelay = deser_struct(f, _I8)[0]
             except:
                 self.nRelay = 0
         else:
             self.nRelay = 0
 
+    def serialize_into(self, w):
+        w += _I32.pack(self.nVersion)
+        w += _U64.pack(self.nServices)
+        w += _I64.pack(self.nTime)
+        self.addrTo.serialize_into(w)
+        self.addrFrom.serialize_into(w)
+        w += _U64.pack(self.nNonce)
+        ser_string_into(w, self.strSubVer)
+        w += _I32.pack(self.nStartingHeight)
+        w += _I8.pack(self.nRelay)
+
     def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += struct.pack("<Q", self.nServices)
-        r += struct.pack("<q", self.nTime)
-        r += self.addrTo.serialize()
-        r += self.addrFrom.serialize()
-        r += struct.pack("<Q", self.nNonce)
-        r += ser_string(self.strSubVer)
-        r += struct.pack("<i", self.nStartingHeight)
-        r += struct.pack("<b", self.nRelay)
-        return r
+        w = bytearray()
+        self.serialize_into(w)
+        return bytes(w)
 
     def __repr__(self):
         return 'msg_version(nVersion=%i nServices=%i nTime=%s addrTo=%s addrFrom=%s nNonce=0x%016X strSubVer=%s nStartingHeight=%i nRelay=%i)' \
@@ -915,6 +1719,9 @@ class msg_verack():
     def deserialize(self, f):
         pass
 
+    def serialize_into(self, w):
+        pass
+
     def serialize(self):
         return b""
 
@@ -931,6 +1738,9 @@ class msg_addr():
     def deserialize(self, f):
         self.addrs = deser_vector(f, CAddress)
 
+    def serialize_into(self, w):
+        ser_vector_into(w, self.addrs)
+
     def serialize(self):
         return ser_vector(self.addrs)
 
@@ -950,6 +1760,9 @@ class msg_inv():
     def deserialize(self, f):
         self.inv = deser_vector(f, CInv)
 
+    def serialize_into(self, w):
+        ser_vector_into(w, self.inv)
+
     def serialize(self):
         return ser_vector(self.inv)
 
@@ -966,6 +1779,9 @@ class msg_getdata():
     def deserialize(self, f):
         self.inv = deser_vector(f, CInv)
 
+    def serialize_into(self, w):
+        ser_vector_into(w, self.inv)
+
     def serialize(self):
         return ser_vector(self.inv)
 
@@ -985,11 +1801,14 @@ class msg_getblocks():
         self.locator.deserialize(f)
         self.hashstop = deser_uint256(f)
 
+    def serialize_into(self, w):
+        self.locator.serialize_into(w)
+        ser_uint256_into(w, self.hashstop)
+
     def serialize(self):
-        r = b""
-        r += self.locator.serialize()
-        r += ser_uint256(self.hashstop)
-        return r
+        w = bytearray()
+        self.serialize_into(w)
+        return bytes(w)
 
     def __repr__(self):
         return "msg_getblocks(locator=%s hashstop=%064x)" \
@@ -1005,6 +1824,9 @@ class msg_tx():
     def deserialize(self, f):
         self.tx.deserialize(f)
 
+    def serialize_into(self, w):
+        w += self.tx.serialize_without_witness()
+
     def serialize(self):
         return self.tx.serialize_without_witness()
 
@@ -1013,6 +1835,9 @@ class msg_tx():
 
 class msg_witness_tx(msg_tx):
 
+    def serialize_into(self, w):
+        w += self.tx.serialize_with_witness()
+
     def serialize(self):
         return self.tx.serialize_with_witness()
 
@@ -1029,6 +1854,9 @@ class msg_block():
     def deserialize(self, f):
         self.block.deserialize(f)
 
+    def serialize_into(self, w):
+        self.block.serialize_into(w, with_witness=False)
+
     def serialize(self):
         return self.block.serialize(with_witness=False)
 
@@ -1042,6 +1870,9 @@ class msg_generic():
         self.command = command
         self.data = data
 
+    def serialize_into(self, w):
+        w += self.data
+
     def serialize(self):
         return self.data
 
@@ -1050,6 +1881,9 @@ class msg_generic():
 
 class msg_witness_block(msg_block):
 
+    def serialize_into(self, w):
+        self.block.serialize_into(w, with_witness=True)
+
     def serialize(self):
         r = self.block.serialize(with_witness=True)
         return r
@@ -1063,6 +1897,9 @@ class msg_getaddr():
     def deserialize(self, f):
         pass
 
+    def serialize_into(self, w):
+        pass
+
     def serialize(self):
         return b""
 
@@ -1077,12 +1914,15 @@ class msg_ping():
         self.nonce = nonce
 
     def deserialize(self, f):
-        self.nonce = struct.unpack("<Q", f.read(8))[0]
+        self.nonce = deser_struct(f, _U64)[0]
+
+    def serialize_into(self, w):
+        w += _U64.pack(self.nonce)
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<Q", self.nonce)
-        return r
+        w = bytearray()
+        self.serialize_into(w)
+        return bytes(w)
 
     def __repr__(self):
         return "msg_ping(nonce=%08x)" % self.nonce
@@ -1095,12 +1935,15 @@ class msg_pong():
         self.nonce = nonce
 
     def deserialize(self, f):
-        self.nonce = struct.unpack("<Q", f.read(8))[0]
+        self.nonce = deser_struct(f, _U64)[0]
+
+    def serialize_into(self, w):
+        w += _U64.pack(self.nonce)
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<Q", self.nonce)
-        return r
+        w = bytearray()
+        self.serialize_into(w)
+        return bytes(w)
 
     def __repr__(self):
         return "msg_pong(nonce=%08x)" % self.nonce
@@ -1115,6 +1958,9 @@ class msg_mempool():
     def deserialize(self, f):
         pass
 
+    def serialize_into(self, w):
+        pass
+
     def serialize(self):
         return b""
 
@@ -1130,6 +1976,9 @@ class msg_sendheaders():
     def deserialize(self, f):
         pass
 
+    def serialize_into(self, w):
+        pass
+
     def serialize(self):
         return b""
 
@@ -1153,11 +2002,14 @@ class msg_getheaders():
         self.locator.deserialize(f)
         self.hashstop = deser_uint256(f)
 
+    def serialize_into(self, w):
+        self.locator.serialize_into(w)
+        ser_uint256_into(w, self.hashstop)
+
     def serialize(self):
-        r = b""
-        r += self.locator.serialize()
-        r += ser_uint256(self.hashstop)
-        return r
+        w = bytearray()
+        self.serialize_into(w)
+        return bytes(w)
 
     def __repr__(self):
         return "msg_getheaders(locator=%s, stop=%064x)" \
@@ -1178,9 +2030,17 @@ class msg_headers():
         for x in blocks:
             self.headers.append(CBlockHeader(x))
 
+    def serialize_into(self, w):
+        ser_compact_size_into(w, len(self.headers))
+        for x in self.headers:
+            # Each header is followed by the transaction count of an empty block
+            CBlockHeader.serialize_into(x, w)
+            w.append(0)
+
     def serialize(self):
-        blocks = [CBlock(x) for x in self.headers]
-        return ser_vector(blocks)
+        w = bytearray()
+        self.serialize_into(w)
+        return bytes(w)
 
     def __repr__(self):
         return "msg_headers(headers=%s)" % repr(self.headers)
@@ -1198,20 +2058,24 @@ class msg_reject():
 
     def deserialize(self, f):
         self.message = deser_string(f)
-        self.code = struct.unpack("<B", f.read(1))[0]
+        self.code = deser_struct(f, _U8)[0]
         self.reason = deser_string(f)
         if (self.code != self.REJECT_MALFORMED and
                 (self.message == b"block" or self.message == b"tx")):
             self.data = deser_uint256(f)
 
-    def serialize(self):
-        r = ser_string(self.message)
-        r += struct.pack("<B", self.code)
-        r += ser_string(self.reason)
+    def serialize_into(self, w):
+        ser_string_into(w, self.message)
+        w += _U8.pack(self.code)
+        ser_string_into(w, self.reason)
         if (self.code != self.REJECT_MALFORMED and
                 (self.message == b"block" or self.message == b"tx")):
-            r += ser_uint256(self.data)
-        return r
+            ser_uint256_into(w, self.data)
+
+    def serialize(self):
+        w = bytearray()
+        self.serialize_into(w)
+        return bytes(w)
 
     def __repr__(self):
         return "msg_reject: %s %d %s [%064x]" \
@@ -1224,12 +2088,15 @@ class msg_feefilter():
         self.feerate = feerate
 
     def deserialize(self, f):
-        self.feerate = struct.unpack("<Q", f.read(8))[0]
+        self.feerate = deser_struct(f, _U64)[0]
+
+    def serialize_into(self, w):
+        w += _U64.pack(self.feerate)
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<Q", self.feerate)
-        return r
+        w = bytearray()
+        self.serialize_into(w)
+        return bytes(w)
 
     def __repr__(self):
         return "msg_feefilter(feerate=%08x)" % self.feerate
@@ -1242,14 +2109,17 @@ class msg_sendcmpct():
         self.version = 1
 
     def deserialize(self, f):
-        self.announce = struct.unpack("<?", f.read(1))[0]
-        self.version = struct.unpack("<Q", f.read(8))[0]
+        self.announce = deser_struct(f, _BOOL)[0]
+        self.version = deser_struct(f, _U64)[0]
+
+    def serialize_into(self, w):
+        w += _BOOL.pack(self.announce)
+        w += _U64.pack(self.version)
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<?", self.announce)
-        r += struct.pack("<Q", self.version)
-        return r
+        w = bytearray()
+        self.serialize_into(w)
+        return bytes(w)
 
     def __repr__(self):
         return "msg_sendcmpct(announce=%s, version=%lu)" % (self.announce, self.version)
@@ -1264,10 +2134,13 @@ class msg_cmpctblock():
         self.header_and_shortids = P2PHeaderAndShortIDs()
         self.header_and_shortids.deserialize(f)
 
+    def serialize_into(self, w):
+        self.header_and_shortids.serialize_into(w)
+
     def serialize(self):
-        r = b""
-        r += self.header_and_shortids.serialize()
-        return r
+        w = bytearray()
+        self.serialize_into(w)
+        return bytes(w)
 
     def __repr__(self):
         return "msg_cmpctblock(HeaderAndShortIDs=%s)" % repr(self.header_and_shortids)
@@ -1282,10 +2155,13 @@ class msg_getblocktxn():
         self.block_txn_request = BlockTransactionsRequest()
         self.block_txn_request.deserialize(f)
 
+    def serialize_into(self, w):
+        self.block_txn_request.serialize_into(w)
+
     def serialize(self):
-        r = b""
-        r += self.block_txn_request.serialize()
-        return r
+        w = bytearray()
+        self.serialize_into(w)
+        return bytes(w)
 
     def __repr__(self):
         return "msg_getblocktxn(block_txn_request=%s)" % (repr(self.block_txn_request))
@@ -1299,16 +2175,135 @@ class msg_blocktxn():
     def deserialize(self, f):
         self.block_transactions.deserialize(f)
 
+    def serialize_into(self, w):
+        self.block_transactions.serialize_into(w, with_witness=False)
+
     def serialize(self):
-        r = b""
-        r += self.block_transactions.serialize(with_witness=False)
-        return r
+        w = bytearray()
+        self.serialize_into(w)
+        return bytes(w)
 
     def __repr__(self):
         return "msg_blocktxn(block_transactions=%s)" % (repr(self.block_transactions))
 
 class msg_witness_blocktxn(msg_blocktxn):
+    def serialize_into(self, w):
+        self.block_transactions.serialize_into(w, with_witness=True)
+
     def serialize(self):
-        r = b""
-        r += self.block_transactions.serialize(with_witness=True)
-        return r
+        w = bytearray()
+        self.serialize_into(w)
+        return bytes(w)
+
+
+class TestFrameworkMessages(unittest.TestCase):
+    def test_buffer_reader_over_read(self):
+        f = BufferReader(b"\x01\x02\x03")
+        self.assertEqual(f.read(2), b"\x01\x02")
+        # Like BytesIO, read() returns what's left
+        self.assertEqual(f.read(2), b"\x03")
+        self.assertEqual(f.read(2), b"")
+        self.assertEqual(f.tell(), 3)
+        f = BufferReader(b"\x01\x02\x03", 1)
+        self.assertRaises(struct.error, f.read_view, 3)
+        self.assertEqual(f.tell(), 1)
+        self.assertRaises(struct.error, deser_struct, f, _U32)
+        self.assertRaises(struct.error, deser_uint256, f)
+        self.assertRaises(struct.error, deser_string, BufferReader(b"\x05\x00"))
+
+    def test_truncated_tx(self):
+        tx = CTransaction()
+        tx.vin = [CTxIn(COutPoint(n, n), b"\x51" * (n * 150), n) for n in range(3)]
+        tx.vout = [CTxOut(n, b"\x52" * (n * 150)) for n in range(3)]
+        tx.wit.vtxinwit = [CTxInWitness() for i in range(3)]
+        tx.wit.vtxinwit[1].scriptWitness.stack = [b"\x01" * 300, b""]
+        for data in (tx.serialize_with_witness(), tx.serialize_without_witness()):
+            for reader in (BufferReader, BytesIO):
+                parsed = CTransaction()
+                parsed.deserialize(reader(data))
+                self.assertEqual(parsed.serialize(), data)
+                for n in range(len(data)):
+                    self.assertRaises(struct.error, CTransaction().deserialize, reader(data[:n]))
+
+    def test_block(self):
+        block = CBlock()
+        block.vtx = [CTransaction() for i in range(3)]
+        for i, tx in enumerate(block.vtx):
+            tx.vin = [CTxIn(COutPoint(i, 0), b"\x51" * 100)]
+            tx.vout = [CTxOut(i, b"\x51")]
+        block.hashMerkleRoot = block.calc_merkle_root()
+        data = block.serialize()
+        # The BufferReader fast paths parse the same block as the generic ones
+        expected = CBlock()
+        expected.deserialize(BytesIO(data))
+        parsed = CBlock()
+        parsed.deserialize(BufferReader(data))
+        self.assertEqual(parsed.serialize(), data)
+        self.assertEqual(parsed.serialize(), expected.serialize())
+        self.assertEqual(parsed.calc_merkle_root(), block.hashMerkleRoot)
+        for n in range(81, len(data)):
+            self.assertRaises(struct.error, CBlock().deserialize, BufferReader(data[:n]))
+
+    def make_tx(self, n):
+        tx = CTransaction()
+        tx.vin = [CTxIn(COutPoint(n, i), b"\x51", i) for i in range(2)]
+        tx.vout = [CTxOut(i * COIN, b"\x51") for i in range(2)]
+        tx.wit.vtxinwit = [CTxInWitness() for i in range(2)]
+        tx.wit.vtxinwit[0].scriptWitness.stack = [b"\x01"]
+        return tx
+
+    def assert_cache_matches(self, tx):
+        # Compare against a copy that has never been serialized
+        fresh = CTransaction()
+        fresh.deserialize(BufferReader(tx._serialize_with_witness()))
+        self.assertEqual(tx.serialize(), fresh.serialize())
+        self.assertEqual(tx.serialize_without_witness(), fresh.serialize_without_witness())
+        self.assertEqual(tx.calc_sha256(True), fresh.calc_sha256(True))
+
+    def test_tx_cache(self):
+        tx = self.make_tx(1)
+        tx.serialize()
+        modifications = [
+            lambda: setattr(tx, "nLockTime", 1),
+            lambda: setattr(tx.vin[0].prevout, "n", 5),
+            lambda: setattr(tx.vin[1], "scriptSig", b"\x52"),
+            lambda: tx.vin.append(CTxIn(COutPoint(2, 0))),
+            lambda: setattr(tx.vout[0], "nValue", 3),
+            lambda: tx.vout.pop(),
+            lambda: tx.wit.vtxinwit[0].scriptWitness.stack.append(b"\x02"),
+            lambda: setattr(tx.wit.vtxinwit[1].scriptWitness, "stack", [b"\x03"]),
+        ]
+        for modify in modifications:
+            modify()
+            self.assert_cache_matches(tx)
+
+    def test_tx_cache_per_transaction(self):
+        tx1 = self.make_tx(1)
+        tx2 = self.make_tx(2)
+        tx1.serialize()
+        cache = tx1._cache
+        tx2.serialize()
+        tx2.vin[0].nSequence = 7
+        tx2.serialize()
+        # Modifying tx2 left tx1's cache alone
+        tx1.serialize()
+        self.assertIs(tx1._cache, cache)
+
+    def test_tx_cache_shared_components(self):
+        tx1 = self.make_tx(1)
+        tx2 = self.make_tx(2)
+        tx2.vout.append(tx1.vout[0])
+        tx1.serialize()
+        tx2.serialize()
+        tx1.vout[0].nValue = 12345
+        self.assert_cache_matches(tx1)
+        self.assert_cache_matches(tx2)
+
+    def test_tx_list_assignment(self):
+        # Assigned lists are copied, later changes to them don't affect tx
+        tx = self.make_tx(1)
+        vin = []
+        tx.vin = vin
+        vin.append(CTxIn())
+        self.assertEqual(len(tx.vin), 0)
+        self.assertIsInstance(tx.vin, TrackedList)
@@ -11,9 +11,9 @@ found in the mini-node branch of http://github.com/jgarzik/pynode.
 
 P2PConnection: A low-level connection object to a node's P2P interface
 P2PInterface: A high-level interface object for communicating to a node over P2P"""
-import asyncore
-from collections import defaultdict
-from io import BytesIO
+import asyncio
+from collections import defaultdict, deque
+import itertools
 import logging
 import socket
 import struct
@@ -55,7 +55,60 @@ MAGIC_BYTES = {
     "regtest": b"\xfa\xbf\xb5\xda",   # regtest
 }
 
-class P2PConnection(asyncore.dispatcher):
+# P2P message header: magic, command, payload length and checksum
+MSG_HEADER_SIZE = 4 + 12 + 4 + 4
+
+# Maximum number of buffers passed to a single sendmsg() call
+SENDMSG_MAX_BUFFERS = 1024
+
+# Directions of messages recorded to a capture (see p2pcapture.py)
+CAPTURE_SENT = 0
+CAPTURE_RECEIVED = 1
+
+def message_hash(message):
+    """Return the hash of the block or transaction a message carries, or None.
+
+    The hash is computed from the serialization, leaving the block's or
+    transaction's sha256 and hash alone: tests may have left them stale on
+    purpose."""
+    if isinstance(message, msg_generic):
+        if message.command != b"block" or message.data is None or len(message.data) < 80:
+            return None
+        data = message.data[:80]
+    elif getattr(message, "block", None) is not None:
+        data = CBlockHeader.serialize(message.block)
+    elif getattr(message, "tx", None) is not None:
+        data = message.tx.serialize_without_witness()
+    else:
+        return None
+    return encode(hash256(data)[::-1], 'hex_codec').decode('ascii')
+
+def message_header(command, data, net="regtest"):
+    """Return the P2P message header for a command and its serialized payload."""
+    checksum = hash256(data)[:4]
+    return b"".join((MAGIC_BYTES[net], command, b"\x00" * (12 - len(command)),
+                     struct.pack("<I", len(data)), checksum))
+
+def build_message(message, net="regtest"):
+    """Return a P2P message as a list of byte strings to send: its header and its payload."""
+    data = message.serialize()
+    return [message_header(message.command, data, net), data]
+
+def broadcast_message(connections, message, pushbuf=False, frames=None):
+    """Send the same P2P message over several connections.
+
+    The message is serialized and framed once per network, and all
+    connections queue the same (immutable) buffers. frames is a dict of
+    network -> built message, which can be passed in to reuse the buffers
+    across several broadcasts of the same message."""
+    if frames is None:
+        frames = {}
+    for conn in connections:
+        if conn.network not in frames:
+            frames[conn.network] = build_message(message, conn.network)
+        conn.send_message(message, pushbuf, frames[conn.network])
+
+class P2PConnection():
     """A low-level connection object to a node's P2P interface.
 
     This class is responsible for:
@@ -63,77 +116,191 @@ class P2PConnection(asyncore.dispatcher):
     - opening and closing the TCP connection to the node
     - reading bytes from and writing bytes to the socket
     - deserializing and serializing the P2P message header
-    - logging messages as they are sent and received
+    - logging summaries of messages as they are sent and received
 
     This class contains no logic for handing the P2P message payloads. It must be
-    sub-classed and the on_message() callback overridden."""
+    sub-classed and the on_message() callback overridden.
+
+    The connection's non-blocking socket is driven by the NetworkThread's
+    asyncio event loop (with add_reader() and add_writer()), so all socket
+    I/O and the on_* callbacks happen in the network thread. Methods called
+    from the test logic thread hand their work to the event loop with
+    call_soon_threadsafe().
+
+    Received data is read with recv_into() into a reusable bytearray
+    (recvbuf): unparsed data lies between recv_start and recv_end, and
+    messages are framed and deserialized in place. Room for at least
+    recv_chunk_size bytes is made for each socket read, by moving the
+    unparsed data to the front of the buffer or, when that's not enough, by
+    moving it to a larger buffer.
+
+    Messages to send are queued as memoryviews of their header and payload
+    in sendq, and written with sendmsg(), so a partial write only slices the
+    first view. sendq_bytes counts the bytes waiting in sendq (including
+    messages pushed before the connection was open); tests can use it to
+    apply backpressure.
+
+    If capture (a p2pcapture.CaptureWriter) is passed to peer_connect(), the
+    payloads of all messages sent with send_message() and received are
+    recorded to it. The capture is not closed with the connection."""
+
+    # Minimum number of bytes to read from the socket at once
+    recv_chunk_size = 256 * 1024
+
+    # Messages are logged at DEBUG level as their command, payload size and
+    # block or transaction hash. Only one in every n messages with a command
+    # is logged, where n is message_log_intervals[command] (default:
+    # message_log_interval), and none if n is 0.
+    message_log_interval = 1
+    message_log_intervals = {}
 
     def __init__(self):
         # All P2PConnections must be created before starting the NetworkThread.
         # assert that the network thread is not running.
         assert not network_thread_running()
 
-        super().__init__(map=mininode_socket_map)
+        self.socket = None
 
-    def peer_connect(self, dstaddr, dstport, net="regtest"):
+    def peer_connect(self, dstaddr, dstport, net="regtest", capture=None):
         self.dstaddr = dstaddr
         self.dstport = dstport
-        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-        self.sendbuf = b""
-        self.recvbuf = b""
+        self.capture = capture
+        self.sendq = deque()
+        self.sendq_bytes = 0
+        self.flush_scheduled = False
+        self._reset_recvbuf()
         self.state = "connecting"
         self.network = net
         self.disconnect = False
+        self.message_log_counts = defaultdict(int)
 
         logger.info('Connecting to Cascoin Node: %s:%d' % (self.dstaddr, self.dstport))
 
-        try:
-            self.connect((dstaddr, dstport))
-        except:
-            self.handle_close()
+        # The connection is opened when the network thread starts
+        mininode_connections.add(self)
 
     def peer_disconnect(self):
         # Connection could have already been closed by other end.
         if self.state == "connected":
             self.disconnect_node()
 
+    @property
+    def connected(self):
+        return self.state == "connected"
+
     # Connection and disconnection methods
 
-    def handle_connect(self):
-        """asyncore callback when a connection is opened."""
-        if self.state != "connected":
-            logger.debug("Connected & Listening: %s:%d" % (self.dstaddr, self.dstport))
+    def _open_connection(self, loop):
+        """Start connecting to the node. Called in the network thread."""
+        if self.disconnect:
+            self._closed()
+            return
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(False)
+        connect = asyncio.ensure_future(loop.sock_connect(sock, (self.dstaddr, self.dstport)), loop=loop)
+        connect.add_done_callback(lambda f: self._connect_done(f, sock))
+
+    def _connect_done(self, future, sock):
+        if future.cancelled() or future.exception() is not None:
+            logger.debug("Unable to connect to: %s:%d" % (self.dstaddr, self.dstport))
+            sock.close()
+            self._closed()
+            return
+        logger.debug("Connected & Listening: %s:%d" % (self.dstaddr, self.dstport))
+        loop = NetworkThread.network_event_loop
+        with mininode_lock:
+            self.socket = sock
             self.state = "connected"
+            if self.disconnect:
+                self._close()
+                return
+            loop.add_reader(sock.fileno(), self._read_ready)
+            self._flush()
             self.on_open()
 
-    def handle_close(self):
-        """asyncore callback when a connection is closed."""
+    def _close(self):
+        """Close the socket. Called in the network thread."""
+        if self.socket is None:
+            return
+        loop = NetworkThread.network_event_loop
+        loop.remove_reader(self.socket.fileno())
+        loop.remove_writer(self.socket.fileno())
+        self.socket.close()
+        self._closed()
+
+    def _closed(self):
         logger.debug("Closing connection to: %s:%d" % (self.dstaddr, self.dstport))
         self.state = "closed"
-        self.recvbuf = b""
-        self.sendbuf = b""
-        try:
-            self.close()
-        except:
-            pass
+        self.socket = None
+        self._reset_recvbuf()
+        with mininode_lock:
+            self.sendq.clear()
+            self.sendq_bytes = 0
         self.on_close()
+        with mininode_lock:
+            mininode_lock.notify_all()
+        mininode_connections.discard(self)
+        if not mininode_connections:
+            # The network thread exits once all connections are closed
+            NetworkThread.network_event_loop.stop()
 
     def disconnect_node(self):
         """Disconnect the p2p connection.
 
         Called by the test logic thread. Causes the p2p connection
-        to be disconnected on the next iteration of the asyncore loop."""
+        to be disconnected on the next iteration of the event loop."""
         self.disconnect = True
+        loop = NetworkThread.network_event_loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self._close)
 
     # Socket read methods
 
-    def handle_read(self):
-        """asyncore callback when data is read from the socket."""
-        t = self.recv(8192)
-        if len(t) > 0:
-            self.recvbuf += t
+    def _reset_recvbuf(self):
+        self.recvbuf = bytearray()
+        self.recv_start = 0
+        self.recv_end = 0
+        # Bytes still missing from the partially received message, if known
+        self.recv_missing = 0
+
+    def _reserve_recvbuf(self, n):
+        """Make room for at least n more bytes after recv_end."""
+        if len(self.recvbuf) - self.recv_end >= n:
+            return
+        unparsed = self.recv_end - self.recv_start
+        if len(self.recvbuf) >= unparsed + n:
+            # Same-size slice assignment, which is allowed while memoryviews
+            # of the buffer are still around
+            self.recvbuf[:unparsed] = self.recvbuf[self.recv_start:self.recv_end]
+        else:
+            buf = bytearray(max(unparsed + n, 2 * len(self.recvbuf)))
+            buf[:unparsed] = self.recvbuf[self.recv_start:self.recv_end]
+            self.recvbuf = buf
+        self.recv_start = 0
+        self.recv_end = unparsed
+
+    def _read_ready(self):
+        """Event loop callback when the socket is readable."""
+        free = len(self.recvbuf) - self.recv_end
+        if free < self.recv_chunk_size and not (self.recv_missing and free >= self.recv_missing):
+            self._reserve_recvbuf(max(self.recv_chunk_size, self.recv_missing))
+        try:
+            n = self.socket.recv_into(memoryview(self.recvbuf)[self.recv_end:])
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self._close()
+            return
+        if n == 0:
+            # Closed by the other end
+            self._close()
+            return
+        self.recv_end += n
+        try:
             self._on_data()
+        except Exception:
+            self._close()
 
     def _on_data(self):
         """Try to read P2P messages from the recv buffer.
@@ -141,32 +308,45 @@ class P2PConnection(asyncore.dispatcher):
         This method reads data from the buffer in a loop. It deserializes,
         parses and verifies the P2P header, then passes the P2P payload to
         the on_message callback for processing."""
+        magic = MAGIC_BYTES[self.network]
+        self.recv_missing = 0
         try:
             while True:
-                if len(self.recvbuf) < 4:
-                    return
-                if self.recvbuf[:4] != MAGIC_BYTES[self.network]:
-                    raise ValueError("got garbage %s" % repr(self.recvbuf))
-                if len(self.recvbuf) < 4 + 12 + 4 + 4:
-                    return
-                command = self.recvbuf[4:4+12].split(b"\x00", 1)[0]
-                msglen = struct.unpack("<i", self.recvbuf[4+12:4+12+4])[0]
-                checksum = self.recvbuf[4+12+4:4+12+4+4]
-                if len(self.recvbuf) < 4 + 12 + 4 + 4 + msglen:
-                    return
-                msg = self.recvbuf[4+12+4+4:4+12+4+4+msglen]
+                buf = self.recvbuf
+                start = self.recv_start
+                available = self.recv_end - start
+                if available < 4:
+                    break
+                if buf[start:start+4] != magic:
+                    raise ValueError("got garbage %s" % repr(bytes(buf[start:self.recv_end])))
+                if available < MSG_HEADER_SIZE:
+                    break
+                command = bytes(buf[start+4:start+4+12]).split(b"\x00", 1)[0]
+                msglen = struct.unpack_from("<i", buf, start+4+12)[0]
+                checksum = buf[start+4+12+4:start+MSG_HEADER_SIZE]
+                if available < MSG_HEADER_SIZE + msglen:
+                    # Make room for the rest of the message up front, so
+                    # that it's only moved once
+                    self.recv_missing = MSG_HEADER_SIZE + msglen - available
+                    self._reserve_recvbuf(self.recv_missing)
+                    break
+                msg = memoryview(buf)[start+MSG_HEADER_SIZE:start+MSG_HEADER_SIZE+msglen]
                 th = sha256(msg)
                 h = sha256(th)
                 if checksum != h[:4]:
-                    raise ValueError("got bad checksum " + repr(self.recvbuf))
-                self.recvbuf = self.recvbuf[4+12+4+4+msglen:]
+                    raise ValueError("got bad checksum " + repr(bytes(buf[start:self.recv_end])))
+                self.recv_start = start + MSG_HEADER_SIZE + msglen
+                if self.capture is not None:
+                    self.capture.record(CAPTURE_RECEIVED, command, msg)
                 if command not in MESSAGEMAP:
-                    raise ValueError("Received unknown command from %s:%d: '%s' %s" % (self.dstaddr, self.dstport, command, repr(msg)))
-                f = BytesIO(msg)
+                    raise ValueError("Received unknown command from %s:%d: '%s' %s" % (self.dstaddr, self.dstport, command, repr(bytes(msg))))
+                f = BufferReader(msg)
                 t = MESSAGEMAP[command]()
                 t.deserialize(f)
-                self._log_message("receive", t)
+                self._log_message("receive", t, msglen)
                 self.on_message(t)
+            if self.recv_start == self.recv_end:
+                self.recv_start = self.recv_end = 0
         except Exception as e:
             logger.exception('Error reading message:', repr(e))
             raise
@@ -177,70 +357,106 @@ class P2PConnection(asyncore.dispatcher):
 
     # Socket write methods
 
-    def writable(self):
-        """asyncore method to determine whether the handle_write() callback should be called on the next loop."""
-        with mininode_lock:
-            pre_connection = self.state == "connecting"
-            length = len(self.sendbuf)
-        return (length > 0 or pre_connection)
-
-    def handle_write(self):
-        """asyncore callback when data should be written to the socket."""
-        with mininode_lock:
-            # asyncore does not expose socket connection, only the first read/write
-            # event, thus we must check connection manually here to know when we
-            # actually connect
-            if self.state == "connecting":
-                self.handle_connect()
-            if not self.writable():
-                return
+    def build_message(self, message):
+        """Return a P2P message as a list of byte strings to send: its header and its payload."""
+        return build_message(message, self.network)
 
-            try:
-                sent = self.send(self.sendbuf)
-            except:
-                self.handle_close()
-                return
-            self.sendbuf = self.sendbuf[sent:]
-
-    def send_message(self, message, pushbuf=False):
+    def send_message(self, message, pushbuf=False, frames=None):
         """Send a P2P message over the socket.
 
-        This method takes a P2P payload, builds the P2P header and adds
-        the message to the send buffer to be sent over the socket."""
+        This method takes a P2P payload, builds the P2P header and queues
+        the message to be sent over the socket by the event loop. With
+        pushbuf, a message sent before the connection is open is held back
+        until it is. frames can pass in the message as already built by
+        build_message(), to send it without serializing it again."""
         if self.state != "connected" and not pushbuf:
             raise IOError('Not connected, no pushbuf')
-        self._log_message("send", message)
-        command = message.command
-        data = message.serialize()
-        tmsg = MAGIC_BYTES[self.network]
-        tmsg += command
-        tmsg += b"\x00" * (12 - len(command))
-        tmsg += struct.pack("<I", len(data))
-        th = sha256(data)
-        h = sha256(th)
-        tmsg += h[:4]
-        tmsg += data
+        if frames is None:
+            frames = self.build_message(message)
+        self._log_message("send", message, len(frames[1]))
+        if self.capture is not None:
+            self.capture.record(CAPTURE_SENT, message.command, frames[1])
+        self.send_raw_message(frames)
+
+    def send_raw_message(self, frames):
+        """Queue already serialized data (a list of bytes-like objects) to be sent."""
+        with mininode_lock:
+            for frame in frames:
+                if len(frame):
+                    self.sendq.append(memoryview(frame))
+                    self.sendq_bytes += len(frame)
+            if self.socket is None:
+                # Sent once connected
+                return
+            if threading.current_thread() is NetworkThread.network_thread:
+                self._flush()
+            elif not self.flush_scheduled:
+                self.flush_scheduled = True
+                NetworkThread.network_event_loop.call_soon_threadsafe(self._flush)
+
+    def _flush(self):
+        """Write as much of sendq as the socket takes. Called in the network thread."""
         with mininode_lock:
-            if (len(self.sendbuf) == 0 and not pushbuf):
+            self.flush_scheduled = False
+            if self.socket is None:
+                return
+            while self.sendq:
+                buffers = list(itertools.islice(self.sendq, SENDMSG_MAX_BUFFERS))
                 try:
-                    sent = self.send(tmsg)
-                    self.sendbuf = tmsg[sent:]
-                except BlockingIOError:
-                    self.sendbuf = tmsg
+                    if hasattr(self.socket, "sendmsg"):
+                        sent = self.socket.sendmsg(buffers)
+                    else:
+                        sent = self.socket.send(buffers[0])
+                except (BlockingIOError, InterruptedError):
+                    break
+                except OSError:
+                    self._close()
+                    return
+                self.sendq_bytes -= sent
+                # Wake up senders waiting for the queue to drain (eg replay_capture())
+                mininode_lock.notify_all()
+                while sent:
+                    view = self.sendq[0]
+                    if sent < len(view):
+                        self.sendq[0] = view[sent:]
+                        break
+                    sent -= len(view)
+                    self.sendq.popleft()
+            # Have the event loop call back when the socket can take more
+            loop = NetworkThread.network_event_loop
+            if self.sendq:
+                loop.add_writer(self.socket.fileno(), self._flush)
             else:
-                self.sendbuf += tmsg
+                loop.remove_writer(self.socket.fileno())
 
     # Class utility methods
 
-    def _log_message(self, direction, msg):
-        """Logs a message being sent or received over the connection."""
+    def _log_message(self, direction, msg, size):
+        """Logs a summary of a message being sent or received over the connection.
+
+        Only logs one in every message_log_intervals[command] messages. The
+        test framework always logs DEBUG messages to test_framework.log, so
+        under it the sampling is what bounds the cost of logging."""
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
+        command = msg.command
+        interval = self.message_log_intervals.get(command, self.message_log_interval)
+        if not interval:
+            return
+        count = self.message_log_counts[command]
+        self.message_log_counts[command] = count + 1
+        if count % interval:
+            return
         if direction == "send":
             log_message = "Send message to "
         elif direction == "receive":
             log_message = "Received message from "
-        log_message += "%s:%d: %s" % (self.dstaddr, self.dstport, repr(msg)[:500])
-        if len(log_message) > 500:
-            log_message += "... (msg truncated)"
+        log_message += "%s:%d: %s size=%d" % (self.dstaddr, self.dstport, command.decode('ascii'), size)
+        h = message_hash(msg)
+        if h is not None:
+            log_message += " hash=%s" % h
+        if interval > 1:
+            log_message += " (1 in %d logged)" % interval
         logger.debug(log_message)
 
 
@@ -296,6 +512,8 @@ class P2PInterface(P2PConnection):
             except:
                 print("ERROR delivering %s (%s)" % (repr(message), sys.exc_info()[0]))
                 raise
+            finally:
+                mininode_lock.notify_all()
 
     # Callback methods. Can be overridden by subclasses in individual test
     # cases to provide custom message handling behaviour.
@@ -390,10 +608,9 @@ class P2PInterface(P2PConnection):
         self.ping_counter += 1
 
 
-# Keep our own socket map for asyncore, so that we can track disconnects
-# ourselves (to workaround an issue with closing an asyncore socket when
-# using select)
-mininode_socket_map = dict()
+# The P2PConnections that are connecting or connected. The network thread
+# opens them when it starts and exits once they've all been closed.
+mininode_connections = set()
 
 # One lock for synchronizing all data access between the networking thread (see
 # NetworkThread below) and the thread running the test logic.  For simplicity,
@@ -401,23 +618,39 @@ mininode_socket_map = dict()
 # and whenever adding anything to the send buffer (in send_message()).  This
 # lock should be acquired in the thread running the test logic to synchronize
 # access to any data shared with the P2PInterface or P2PConnection.
-mininode_lock = threading.RLock()
+#
+# The lock is a condition variable, notified whenever a message has been
+# delivered or a connection has closed, so that wait_until() wakes up as
+# soon as the state it waits for may have changed.
+mininode_lock = threading.Condition(threading.RLock())
 
 class NetworkThread(threading.Thread):
+    """Thread running the asyncio event loop that drives all P2PConnections.
+
+    The loop only wakes up for socket events and for work handed over by
+    other threads with call_soon_threadsafe()."""
+
+    # The running event loop and the thread running it
+    network_event_loop = None
+    network_thread = None
+
     def __init__(self):
         super().__init__(name="NetworkThread")
 
     def run(self):
-        while mininode_socket_map:
-            # We check for whether to disconnect outside of the asyncore
-            # loop to workaround the behavior of asyncore when using
-            # select
-            disconnected = []
-            for fd, obj in mininode_socket_map.items():
-                if obj.disconnect:
-                    disconnected.append(obj)
-            [obj.handle_close() for obj in disconnected]
-            asyncore.loop(0.1, use_poll=True, map=mininode_socket_map, count=1)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        NetworkThread.network_event_loop = loop
+        NetworkThread.network_thread = self
+        try:
+            if mininode_connections:
+                for conn in list(mininode_connections):
+                    conn._open_connection(loop)
+                loop.run_forever()
+        finally:
+            NetworkThread.network_event_loop = None
+            NetworkThread.network_thread = None
+            loop.close()
         logger.debug("Network thread closing")
 
 def network_thread_start():
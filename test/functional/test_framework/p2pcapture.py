@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# Copyright (c) 2018 The Cascoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Capture of P2P traffic to a file, and replay of captures into a node.
+
+A capture file starts with CAPTURE_MAGIC and holds one record per message:
+the time it was sent or received (a double, in seconds since the epoch),
+its direction, its command (null-padded to 12 bytes), the length of its
+payload as a uint32 and the raw payload. Next to it, an index file
+(<path>.idx) holds the time and file offset of each record, so that a
+capture can be seeked by record number or by time without being scanned.
+If the index is missing or short (e.g. the capture was not closed), it is
+rebuilt when the capture is opened.
+
+To capture a connection, pass a CaptureWriter to peer_connect():
+
+    capture = CaptureWriter(os.path.join(self.options.tmpdir, "p2p.cap"))
+    node.add_p2p_connection(P2PInterface(), capture=capture)
+
+Messages are recorded as they are framed, before they reach the socket (for
+sent messages) and before they are deserialized (for received ones).
+replay_capture() sends the messages of a capture over another connection,
+at full speed or at a multiple of the recorded pace."""
+
+from bisect import bisect_left
+from collections import namedtuple
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+from .mininode import CAPTURE_RECEIVED, CAPTURE_SENT, message_header, mininode_lock
+from .util import wait_until
+
+logger = logging.getLogger("TestFramework.p2pcapture")
+
+CAPTURE_MAGIC = b"CASCAP\x00\x01"
+
+# Directions of captured messages
+SENT = CAPTURE_SENT
+RECEIVED = CAPTURE_RECEIVED
+
+CapturedMessage = namedtuple("CapturedMessage", ["time", "direction", "command", "payload"])
+
+RECORD_HEADER = struct.Struct("<dB12sI")
+INDEX_ENTRY = struct.Struct("<dQ")
+
+class CaptureWriter():
+    """Appends messages to a capture file and its index.
+
+    record() may be called from the network thread and the test logic
+    thread at the same time."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.index_file = open(path + ".idx", 'wb')
+        self.file.write(CAPTURE_MAGIC)
+        self.offset = len(CAPTURE_MAGIC)
+        self.lock = threading.Lock()
+
+    def record(self, direction, command, payload):
+        timestamp = time.time()
+        with self.lock:
+            if self.file is None:
+                return
+            self.index_file.write(INDEX_ENTRY.pack(timestamp, self.offset))
+            self.file.write(RECORD_HEADER.pack(timestamp, direction, command, len(payload)))
+            self.file.write(payload)
+            self.offset += RECORD_HEADER.size + len(payload)
+
+    def close(self):
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.close()
+            self.index_file.close()
+            self.file = None
+            self.index_file = None
+
+class CaptureReader():
+    """Random access to the messages of a capture file.
+
+    The file is mmap'd, and only the records that are read are copied out
+    of it, so payloads stay valid after the reader is closed."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        if size < len(CAPTURE_MAGIC):
+            raise ValueError("%s: not a capture file" % path)
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(CAPTURE_MAGIC)] != CAPTURE_MAGIC:
+            raise ValueError("%s: not a capture file" % path)
+        # Times and file offsets of the records
+        self.times = []
+        self.offsets = []
+        self._load_index()
+
+    def _load_index(self):
+        try:
+            with open(self.path + ".idx", 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b""
+        for timestamp, offset in INDEX_ENTRY.iter_unpack(data[:len(data) - len(data) % INDEX_ENTRY.size]):
+            if not self._complete(offset):
+                break
+            self.times.append(timestamp)
+            self.offsets.append(offset)
+        # Index records written after the index file was last flushed
+        pos = len(CAPTURE_MAGIC)
+        if self.offsets:
+            pos = self.offsets[-1] + RECORD_HEADER.size + self._length(self.offsets[-1])
+        while self._complete(pos):
+            self.times.append(RECORD_HEADER.unpack_from(self.map, pos)[0])
+            self.offsets.append(pos)
+            pos += RECORD_HEADER.size + self._length(pos)
+
+    def _length(self, offset):
+        return RECORD_HEADER.unpack_from(self.map, offset)[3]
+
+    def _complete(self, offset):
+        """Return whether a whole record starts at offset."""
+        if offset + RECORD_HEADER.size > len(self.map):
+            return False
+        return offset + RECORD_HEADER.size + self._length(offset) <= len(self.map)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        offset = self.offsets[i]
+        timestamp, direction, command, length = RECORD_HEADER.unpack_from(self.map, offset)
+        start = offset + RECORD_HEADER.size
+        return CapturedMessage(timestamp, direction, command.rstrip(b"\x00"),
+                               self.map[start:start + length])
+
+    def __iter__(self):
+        return self.messages()
+
+    def messages(self, start=0, stop=None):
+        """Iterate over the messages with record numbers in [start, stop)."""
+        if stop is None:
+            stop = len(self)
+        for i in range(start, stop):
+            yield self[i]
+
+    def find_time(self, timestamp):
+        """Return the number of the first record at or after timestamp."""
+        return bisect_left(self.times, timestamp)
+
+def replay_capture(conn, reader, direction=SENT, speed=None, start=0, stop=None,
+                   skip=(b"version", b"verack"), max_pending=16 * 1024 * 1024):
+    """Send the messages of a capture over a connection.
+
+    By default, the messages the captured connection sent are replayed, so
+    that a node sees the same traffic again. With speed, messages are sent
+    at speed times their recorded pace; otherwise they're sent as fast as
+    the connection takes them. Commands in skip (by default the handshake,
+    which conn has done already) are not sent. The payloads are framed from
+    the capture without being deserialized; no more than max_pending bytes
+    are queued on the connection at once. Return the number of messages
+    sent."""
+    sent = 0
+    first_time = None
+    start_time = time.time()
+    for message in reader.messages(start, stop):
+        if message.direction != direction or message.command in skip:
+            continue
+        if speed is not None:
+            if first_time is None:
+                first_time = message.time
+            delay = start_time + (message.time - first_time) / speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        if conn.sendq_bytes > max_pending:
+            # mininode_lock is notified as the network thread writes out the queue
+            wait_until(lambda: conn.sendq_bytes <= max_pending or not conn.connected, lock=mininode_lock)
+            if not conn.connected:
+                raise IOError('Connection closed during replay')
+        payload = message.payload
+        conn.send_raw_message([message_header(message.command, payload, conn.network), payload])
+        sent += 1
+    logger.debug("Replayed %d messages from %s" % (sent, reader.path))
+    return sent
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+# Copyright (c) 2018 The Cascoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""P2P load generation against a node with many mininode peers.
+
+LoadGenerator sends a mix of messages over a set of LoadPeers, each command
+at a target rate (messages per second, spread round-robin over the peers),
+for a given duration. The commands it knows are:
+
+- tx: the next transaction from a caller-supplied iterator of valid
+  transactions
+- inv: an announcement of a transaction sent earlier (or of a block), which
+  the node has to look up
+- headers: the headers of recent blocks
+- getdata: a request for a recent block, which the node serves
+- cmpctblock: a compact block for a recent block
+- ping: a ping, whose round trip time is measured
+
+Since a node processes the messages of a peer in order, the ping round trip
+times measure how long messages wait to be processed under the load.
+LoadGenerator.run() returns a LoadReport with the counts and achieved rates
+of sent messages, the ping round trip time percentiles, and the messages the
+peers got back (like rejects and requested blocks); node-side acceptance
+(e.g. mempool growth) is left to the caller to measure over RPC."""
+
+import heapq
+import logging
+import time
+import unittest
+
+from .messages import (
+    CBlock,
+    CBlockHeader,
+    CInv,
+    COutPoint,
+    CTransaction,
+    CTxIn,
+    CTxOut,
+    HeaderAndShortIDs,
+    msg_cmpctblock,
+    msg_getdata,
+    msg_headers,
+    msg_inv,
+    msg_ping,
+    msg_pong,
+    msg_tx,
+)
+from .mininode import P2PInterface, build_message, mininode_lock
+
+logger = logging.getLogger("TestFramework.p2pload")
+
+LOAD_COMMANDS = ("tx", "inv", "headers", "getdata", "cmpctblock", "ping")
+
+def percentile(values, p):
+    """Return the p-th percentile (nearest rank) of a sorted list, or None if it's empty."""
+    if not values:
+        return None
+    rank = max(0, min(len(values) - 1, int(round(p / 100 * len(values))) - 1))
+    return values[rank]
+
+class LoadPeer(P2PInterface):
+    """A P2PInterface which times its pings and answers getdata for its transactions."""
+
+    def __init__(self):
+        super().__init__()
+        # nonce -> time the ping was sent
+        self.pings_in_flight = {}
+        # Round trip times of answered pings, in seconds
+        self.ping_times = []
+        # txid -> msg_tx, for the transactions this peer has sent
+        self.txs = {}
+
+    def send_timed_ping(self, nonce):
+        with mininode_lock:
+            self.pings_in_flight[nonce] = time.perf_counter()
+        self.send_message(msg_ping(nonce))
+
+    def on_pong(self, message):
+        sent = self.pings_in_flight.pop(message.nonce, None)
+        if sent is not None:
+            self.ping_times.append(time.perf_counter() - sent)
+
+    def on_getdata(self, message):
+        for i in message.inv:
+            tx = self.txs.get(i.hash)
+            if tx is not None:
+                self.send_message(tx)
+
+class LoadReport():
+    """Results of a LoadGenerator run."""
+
+    def __init__(self, duration, sent, lag, ping_times, received):
+        # Seconds the run took
+        self.duration = duration
+        # command -> number of messages sent
+        self.sent = sent
+        # Largest delay behind schedule of a sent message, in seconds
+        self.lag = lag
+        # Sorted ping round trip times, in seconds
+        self.ping_times = ping_times
+        # command -> number of messages the peers received
+        self.received = received
+
+    def rate(self, command):
+        return self.sent.get(command, 0) / self.duration if self.duration else 0
+
+    def ping_percentile(self, p):
+        return percentile(self.ping_times, p)
+
+    def __str__(self):
+        lines = ["Sent for %.1f s (at most %.3f s behind schedule):" % (self.duration, self.lag)]
+        for command in sorted(self.sent):
+            lines.append("  %-10s %8d (%.1f/s)" % (command, self.sent[command], self.rate(command)))
+        if self.ping_times:
+            lines.append("Ping round trips: %d answered of %d, p50 %.1f ms, p90 %.1f ms, p99 %.1f ms, max %.1f ms" % (
+                len(self.ping_times), self.sent.get("ping", 0),
+                self.ping_percentile(50) * 1000, self.ping_percentile(90) * 1000,
+                self.ping_percentile(99) * 1000, self.ping_times[-1] * 1000))
+        lines.append("Received: " + ", ".join("%s=%d" % (c, n) for c, n in sorted(self.received.items())))
+        return "\n".join(lines)
+
+class LoadGenerator():
+    """Sends a mix of messages over a set of connected LoadPeers at target rates.
+
+    rates maps commands (see LOAD_COMMANDS) to messages per second. txs is
+    an iterator of valid CTransactions for the tx command (once it runs
+    out, no more tx messages are sent), and blocks a list of recent CBlocks
+    for the headers, getdata and cmpctblock commands. Messages are not sent
+    to a peer with more than max_pending bytes queued."""
+
+    def __init__(self, peers, rates, txs=None, blocks=None, max_pending=1024 * 1024):
+        for command in rates:
+            if command not in LOAD_COMMANDS:
+                raise ValueError("Unknown load command %s" % command)
+        self.peers = peers
+        self.rates = {c: r for c, r in rates.items() if r > 0}
+        self.txs = iter(txs or ())
+        self.blocks = blocks or []
+        self.max_pending = max_pending
+        self.sent_txids = []
+        self.ping_nonce = 0
+        # The headers and cmpctblock messages are sent many times, so they
+        # are built once, as (message, frames) pairs
+        self.headers = self._prebuilt(msg_headers([CBlockHeader(b) for b in self.blocks[-2000:]]))
+        self.cmpctblocks = []
+        for b in self.blocks[-10:]:
+            compact = HeaderAndShortIDs()
+            compact.initialize_from_block(b)
+            self.cmpctblocks.append(self._prebuilt(msg_cmpctblock(compact.to_p2p())))
+
+    def _prebuilt(self, message):
+        net = self.peers[0].network if self.peers else "regtest"
+        return (message, build_message(message, net))
+
+    def _send(self, peer, command, count):
+        """Send the count-th message of a command to a peer. Return whether one was sent."""
+        if command == "tx":
+            tx = next(self.txs, None)
+            if tx is None:
+                return False
+            message = msg_tx(tx)
+            with mininode_lock:
+                peer.txs[tx.sha256] = message
+            self.sent_txids.append(tx.sha256)
+            peer.send_message(message)
+        elif command == "inv":
+            if self.sent_txids:
+                inv = CInv(1, self.sent_txids[count % len(self.sent_txids)])
+            elif self.blocks:
+                inv = CInv(2, self.blocks[count % len(self.blocks)].sha256)
+            else:
+                return False
+            peer.send_message(msg_inv([inv]))
+        elif command == "headers":
+            if not self.blocks:
+                return False
+            message, frames = self.headers
+            peer.send_message(message, frames=frames)
+        elif command == "getdata":
+            if not self.blocks:
+                return False
+            peer.send_message(msg_getdata([CInv(2, self.blocks[count % len(self.blocks)].sha256)]))
+        elif command == "cmpctblock":
+            if not self.cmpctblocks:
+                return False
+            message, frames = self.cmpctblocks[count % len(self.cmpctblocks)]
+            peer.send_message(message, frames=frames)
+        elif command == "ping":
+            self.ping_nonce += 1
+            peer.send_timed_ping(self.ping_nonce)
+        return True
+
+    def run(self, duration, drain_timeout=60):
+        """Send load for duration seconds, then wait for outstanding pings. Return a LoadReport."""
+        peers = [p for p in self.peers if p.connected]
+        assert peers, "No connected peers to send load over"
+        sent = {c: 0 for c in self.rates}
+        next_peer = {c: 0 for c in self.rates}
+        lag = 0
+        start = time.perf_counter()
+        # (time a message is due, command, number of the message)
+        schedule = [(start, command, 0) for command in self.rates]
+        heapq.heapify(schedule)
+        while schedule:
+            due, command, n = heapq.heappop(schedule)
+            if n >= self.rates[command] * duration:
+                continue
+            now = time.perf_counter()
+            if due > now:
+                time.sleep(due - now)
+            else:
+                lag = max(lag, now - due)
+            for _ in range(len(peers)):
+                peer = peers[next_peer[command] % len(peers)]
+                next_peer[command] += 1
+                if peer.sendq_bytes <= self.max_pending:
+                    break
+            else:
+                peer = None
+            if peer is not None:
+                if not self._send(peer, command, sent[command]):
+                    continue
+                sent[command] += 1
+            heapq.heappush(schedule, (start + (n + 1) / self.rates[command], command, n + 1))
+        elapsed = time.perf_counter() - start
+
+        deadline = time.time() + drain_timeout
+        while time.time() < deadline:
+            with mininode_lock:
+                if not any(p.pings_in_flight for p in peers if p.connected):
+                    break
+                mininode_lock.wait(0.05)
+
+        with mininode_lock:
+            ping_times = sorted(t for p in peers for t in p.ping_times)
+            received = {}
+            for p in peers:
+                for command, n in p.message_count.items():
+                    received[command] = received.get(command, 0) + n
+        report = LoadReport(elapsed, sent, lag, ping_times, received)
+        logger.debug("Load report:\n%s" % report)
+        return report
+
+
+
+class TestFrameworkP2PLoad(unittest.TestCase):
+    class RecordingPeer(LoadPeer):
+        """A LoadPeer that records the frames it sends instead of sending them, and answers pings itself."""
+
+        def __init__(self):
+            super().__init__()
+            self.state = "connected"
+            self.network = "regtest"
+            self.sendq_bytes = 0
+            self.sent = []
+
+        def send_message(self, message, pushbuf=False, frames=None):
+            if frames is None:
+                frames = build_message(message, self.network)
+            self.sent.append((message.command, b"".join(frames)))
+            if message.command == b"ping":
+                self.message_count["pong"] += 1
+                self.on_pong(msg_pong(message.nonce))
+
+    def make_blocks(self, count):
+        blocks = []
+        prev = 0
+        for i in range(count):
+            block = CBlock()
+            block.hashPrevBlock = prev
+            block.nTime = 1500000000 + i
+            tx = CTransaction()
+            tx.vin = [CTxIn(COutPoint(0, 0xffffffff), bytes([i]))]
+            tx.vout = [CTxOut(50, b"\x51")]
+            block.vtx = [tx]
+            block.hashMerkleRoot = block.calc_merkle_root()
+            block.rehash()
+            blocks.append(block)
+            prev = block.sha256
+        return blocks
+
+    def make_txs(self, count):
+        txs = []
+        for i in range(count):
+            tx = CTransaction()
+            tx.vin = [CTxIn(COutPoint(i + 1, 0))]
+            tx.vout = [CTxOut(i, b"\x51")]
+            tx.rehash()
+            txs.append(tx)
+        return txs
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile(values, 100), 100)
+        self.assertEqual(percentile(values, 0), 1)
+        self.assertIsNone(percentile([], 50))
+
+    def test_run(self):
+        peers = [self.RecordingPeer() for i in range(2)]
+        blocks = self.make_blocks(3)
+        txs = self.make_txs(5)
+        rates = {"tx": 100, "inv": 100, "headers": 50, "getdata": 50, "cmpctblock": 50, "ping": 100}
+        generator = LoadGenerator(peers, rates, txs=txs, blocks=blocks)
+        report = generator.run(0.1)
+        # tx stops once the transactions run out
+        self.assertEqual(report.sent, {"tx": 5, "inv": 10, "headers": 5, "getdata": 5, "cmpctblock": 5, "ping": 10})
+        self.assertEqual(report.received, {"pong": 10})
+        self.assertEqual(len(report.ping_times), 10)
+
+        # Each command goes round-robin over the peers, and prebuilt
+        # messages are sent as they'd be built from scratch
+        sent = {}
+        for command, count in report.sent.items():
+            command = command.encode()
+            self.assertEqual(len([c for c, _ in peers[0].sent if c == command]), (count + 1) // 2)
+            self.assertEqual(len([c for c, _ in peers[1].sent if c == command]), count // 2)
+        for command, data in peers[0].sent + peers[1].sent:
+            sent.setdefault(command, []).append(data)
+        self.assertEqual(sorted(sent[b"tx"]), sorted(b"".join(build_message(msg_tx(tx))) for tx in txs))
+        headers = msg_headers([CBlockHeader(b) for b in blocks])
+        self.assertEqual(set(sent[b"headers"]), {b"".join(build_message(headers))})
+        compact = []
+        for b in blocks:
+            c = HeaderAndShortIDs()
+            c.initialize_from_block(b)
+            compact.append(b"".join(build_message(msg_cmpctblock(c.to_p2p()))))
+        self.assertEqual(set(sent[b"cmpctblock"]), set(compact))
+
+        # Peers serve the transactions they announced
+        tx = txs[0]
+        peer = peers[0] if tx.sha256 in peers[0].txs else peers[1]
+        del peer.sent[:]
+        peer.on_getdata(msg_getdata([CInv(1, tx.sha256)]))
+        self.assertEqual(peer.sent, [(b"tx", b"".join(build_message(msg_tx(tx))))])
+
+    def test_unknown_command(self):
+        self.assertRaises(ValueError, LoadGenerator, [], {"block": 1})
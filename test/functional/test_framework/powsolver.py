@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# Copyright (c) 2018 The Cascoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Scrypt proof-of-work solver for block headers.
+
+A block header is serialized once into its 76-byte prefix (everything but
+nNonce); grinding then only packs the 4-byte nonce for each attempt and hands
+the 80 bytes to the native cascoin_scrypt module.
+
+grind_nonce() searches a nonce range in the calling process.
+grind_nonce_parallel() splits the search into batches and hashes them on a
+multiprocessing pool, returning the same (lowest) nonce as grind_nonce().
+
+Solutions can also be kept in a PowCache file across test runs (see
+enable_pow_cache()), in which case solve_header() only grinds headers it
+hasn't seen before."""
+
+import hashlib
+import mmap
+import multiprocessing
+import os
+import struct
+import tempfile
+import unittest
+
+import cascoin_scrypt
+
+MAX_NONCE = 0xffffffff
+
+# Number of nonces hashed by a pool worker per task
+DEFAULT_BATCH_SIZE = 1024
+
+_U32 = struct.Struct("<I")
+
+def get_pow_hash(header):
+    """Return the scrypt proof-of-work hash of a serialized header as an int."""
+    return int.from_bytes(cascoin_scrypt.getPoWHash(header), 'little')
+
+def grind_nonce(prefix, target, first_nonce=0, last_nonce=MAX_NONCE):
+    """Find the first nonce in [first_nonce, last_nonce] that solves the header.
+
+    prefix is the serialized header without its nNonce field. Returns a
+    (nonce, scrypt hash) tuple, or None if no nonce in the range meets the
+    target."""
+    getPoWHash = cascoin_scrypt.getPoWHash
+    pack = _U32.pack
+    for nonce in range(first_nonce, last_nonce + 1):
+        h = int.from_bytes(getPoWHash(prefix + pack(nonce)), 'little')
+        if h <= target:
+            return (nonce, h)
+    return None
+
+def _grind_batch(args):
+    return grind_nonce(*args)
+
+def grind_nonce_parallel(prefix, target, first_nonce=0, last_nonce=MAX_NONCE, *, pool=None, processes=None, batch_size=DEFAULT_BATCH_SIZE):
+    """Parallel version of grind_nonce().
+
+    The nonce range is cut into batches of batch_size nonces, which are
+    hashed on pool (or on a temporary pool of `processes` workers, one per
+    core by default). processes must be given with pool: it's the number of
+    batches dispatched per round, one per worker. The results of a round
+    are checked in order, so the result is always the lowest solving nonce,
+    exactly as grind_nonce() would return.
+
+    Targets that are expected to be met within one batch (such as regtest's)
+    are ground in the calling process, since dispatching would only add
+    latency."""
+    if processes is None:
+        if pool is not None:
+            raise ValueError("processes must be given with pool")
+        processes = os.cpu_count() or 1
+    if (1 << 256) // (target + 1) < batch_size:
+        return grind_nonce(prefix, target, first_nonce, last_nonce)
+    own_pool = pool is None
+    if own_pool:
+        pool = multiprocessing.Pool(processes)
+    try:
+        start = first_nonce
+        while start <= last_nonce:
+            batches = []
+            for i in range(processes):
+                if start > last_nonce:
+                    break
+                end = min(start + batch_size - 1, last_nonce)
+                batches.append((prefix, target, start, end))
+                start = end + 1
+            for result in pool.map(_grind_batch, batches):
+                if result is not None:
+                    return result
+        return None
+    finally:
+        if own_pool:
+            pool.terminate()
+            pool.join()
+
+class PowCache():
+    """Persistent map from header prefix to solving nonce.
+
+    The file is a flat array of fixed-size records: the sha256 of the 76-byte
+    header prefix (which includes nBits) and the first nonce tried, the
+    solving nonce as a little-endian uint32, its scrypt hash, and a 4-byte
+    checksum (the start of the sha256 of the rest of the record). The whole
+    file is mmap'd and indexed in memory when opened. New records are
+    appended with a single write() to a file opened with O_APPEND, so several
+    test processes can share one cache file; a torn record at the end is
+    ignored. Cache hits aren't rehashed: records with a bad checksum are
+    dropped when the file is read, and the stored hash is checked against
+    the target, so a corrupt record only costs a regrind."""
+
+    RECORD = struct.Struct("<32sI32s4s")
+
+    def __init__(self, path):
+        self.path = path
+        self.index = {}
+        if os.path.isfile(path) and os.path.getsize(path) >= self.RECORD.size:
+            with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                view = memoryview(m)
+                try:
+                    end = len(view) - len(view) % self.RECORD.size
+                    for key, nonce, h, check in self.RECORD.iter_unpack(view[:end]):
+                        if check == self.checksum(key, nonce, h):
+                            self.index[key] = (nonce, int.from_bytes(h, 'little'))
+                finally:
+                    view.release()
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    @staticmethod
+    def key(prefix, first_nonce):
+        return hashlib.sha256(prefix + _U32.pack(first_nonce)).digest()
+
+    @staticmethod
+    def checksum(key, nonce, h):
+        return hashlib.sha256(key + _U32.pack(nonce) + h).digest()[:4]
+
+    def get(self, prefix, first_nonce, target):
+        """Return the cached (nonce, scrypt hash), or None if there's no cached nonce that meets target."""
+        result = self.index.get(self.key(prefix, first_nonce))
+        if result is None or result[1] > target:
+            return None
+        return result
+
+    def add(self, prefix, first_nonce, nonce, h):
+        key = self.key(prefix, first_nonce)
+        if self.index.get(key) != (nonce, h):
+            self.index[key] = (nonce, h)
+            h = h.to_bytes(32, 'little')
+            os.write(self.fd, self.RECORD.pack(key, nonce, h, self.checksum(key, nonce, h)))
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+# The PowCache consulted by solve_header(), if enabled
+pow_cache = None
+
+def enable_pow_cache(path):
+    """Use (and create if needed) the nonce cache file at path."""
+    global pow_cache
+    disable_pow_cache()
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    pow_cache = PowCache(path)
+
+def disable_pow_cache():
+    """Stop using the nonce cache file and close it."""
+    global pow_cache
+    if pow_cache is not None:
+        pow_cache.close()
+        pow_cache = None
+
+def solve_header(prefix, target, first_nonce=0, pool=None, processes=None):
+    """Find the first nonce from first_nonce on that solves the header.
+
+    Returns (nonce, scrypt hash), or None if there's no solution. Grinds on
+    pool, which has processes workers, if one is given."""
+    if pow_cache is not None:
+        result = pow_cache.get(prefix, first_nonce, target)
+        if result is not None:
+            return result
+    if pool is None:
+        result = grind_nonce(prefix, target, first_nonce)
+    else:
+        result = grind_nonce_parallel(prefix, target, first_nonce, pool=pool, processes=processes)
+    if result is not None and pow_cache is not None:
+        pow_cache.add(prefix, first_nonce, *result)
+    return result
+
+
+class TestFrameworkPowSolver(unittest.TestCase):
+    PREFIX = bytes(range(76))
+
+    def test_grind_nonce_parallel(self):
+        # Hard enough a target for the batches to be hashed on the pool
+        batch_size = 16
+        target = (1 << 256) // 1000
+        self.assertGreaterEqual((1 << 256) // (target + 1), batch_size)
+        expected = grind_nonce(self.PREFIX, target)
+        with multiprocessing.Pool(2) as pool:
+            result = grind_nonce_parallel(self.PREFIX, target, pool=pool, processes=2, batch_size=batch_size)
+        self.assertEqual(result, expected)
+        nonce, h = result
+        self.assertEqual(h, get_pow_hash(self.PREFIX + _U32.pack(nonce)))
+        self.assertLessEqual(h, target)
+
+    def test_grind_nonce_parallel_range(self):
+        target = (1 << 256) // 1000
+        nonce = grind_nonce(self.PREFIX, target)[0]
+        # No solution in a range ending before the first one
+        with multiprocessing.Pool(2) as pool:
+            self.assertIsNone(grind_nonce_parallel(self.PREFIX, target, 0, nonce - 1, pool=pool, processes=2, batch_size=16))
+        with self.assertRaises(ValueError):
+            grind_nonce_parallel(self.PREFIX, target, pool=pool)
+
+    def test_pow_cache(self):
+        target = (1 << 256) // 1000
+        nonce, h = grind_nonce(self.PREFIX, target)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "powcache.dat")
+            cache = PowCache(path)
+            self.assertIsNone(cache.get(self.PREFIX, 0, target))
+            cache.add(self.PREFIX, 0, nonce, h)
+            cache.close()
+            # A torn record at the end is ignored
+            with open(path, 'ab') as f:
+                f.write(b"\xff" * (PowCache.RECORD.size // 2))
+            cache = PowCache(path)
+            self.assertEqual(cache.get(self.PREFIX, 0, target), (nonce, h))
+            self.assertIsNone(cache.get(self.PREFIX, 0, h - 1))
+            self.assertIsNone(cache.get(self.PREFIX, 1, target))
+            cache.close()
+            # So is a record with a bad checksum
+            with open(path, 'r+b') as f:
+                f.seek(32)
+                f.write(_U32.pack(nonce + 1))
+            cache = PowCache(path)
+            self.assertIsNone(cache.get(self.PREFIX, 0, target))
+            cache.close()
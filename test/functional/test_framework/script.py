@@ -7,7 +7,7 @@
 This file is modified from python-bitcoinlib.
 """
 
-from .mininode import CTransaction, CTxOut, sha256, hash256, uint256_from_str, ser_uint256, ser_string
+from .mininode import COutPoint, CTransaction, CTxIn, CTxInWitness, CTxOut, FromHex, sha256, hash256, uint256_from_str, ser_uint256, ser_string, ser_compact_size, ser_vector
 from binascii import hexlify
 import hashlib
 
@@ -20,6 +20,7 @@ if sys.version > '3':
     bord = lambda x: x
 
 import struct
+import unittest
 
 from .bignum import bn2vch
 
@@ -598,83 +599,124 @@ def FindAndDelete(script, sig):
     return CScript(r)
 
 
+# The serialization of CTxOut(-1), which replaces the outputs before the
+# signed one with SIGHASH_SINGLE
+BLANK_TXOUT = CTxOut(-1).serialize()
+
+def _sighash_inputs(txTo, zero_sequences):
+    """Return the inputs of txTo serialized with empty scriptSigs, and the offset of each.
+
+    With zero_sequences, the nSequences are serialized as 0. The result is
+    cached on the transaction, and recomputed only if an outpoint or
+    nSequence has changed (so not when scriptSigs are filled in)."""
+    key = [(i.prevout.hash, i.prevout.n, i.nSequence) for i in txTo.vin]
+    cached = txTo._sighash_cache.get(("inputs", zero_sequences))
+    if cached is not None and cached[0] == key:
+        return cached[1], cached[2]
+    parts = []
+    offsets = [0]
+    for i in txTo.vin:
+        parts.append(i.prevout.serialize() + b"\x00" + struct.pack("<I", 0 if zero_sequences else i.nSequence))
+        offsets.append(offsets[-1] + len(parts[-1]))
+    serialized = b"".join(parts)
+    txTo._sighash_cache[("inputs", zero_sequences)] = (key, serialized, offsets)
+    return serialized, offsets
+
+def _sighash_outputs(txTo):
+    """Return the serialized outputs of txTo, cached like _sighash_inputs()."""
+    key = [(o.nValue, o.scriptPubKey) for o in txTo.vout]
+    cached = txTo._sighash_cache.get("outputs")
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    serialized = ser_vector(txTo.vout)
+    txTo._sighash_cache["outputs"] = (key, serialized)
+    return serialized
+
 def SignatureHash(script, txTo, inIdx, hashtype):
     """Consensus-correct SignatureHash
 
     Returns (hash, err) to precisely match the consensus-critical behavior of
     the SIGHASH_SINGLE bug. (inIdx is *not* checked for validity)
+
+    The modified transaction is serialized straight from txTo, without
+    copying it: the inputs with blanked scriptSigs and the outputs are
+    cached on txTo, so signing all inputs of a transaction only serializes
+    them once.
     """
     HASH_ONE = b'\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
 
     if inIdx >= len(txTo.vin):
         return (HASH_ONE, "inIdx %d out of range (%d)" % (inIdx, len(txTo.vin)))
-    txtmp = CTransaction(txTo)
 
-    for txin in txtmp.vin:
-        txin.scriptSig = b''
-    txtmp.vin[inIdx].scriptSig = FindAndDelete(script, CScript([OP_CODESEPARATOR]))
+    txin = txTo.vin[inIdx]
+    signed_input = (txin.prevout.serialize() +
+                    ser_string(FindAndDelete(script, CScript([OP_CODESEPARATOR]))) +
+                    struct.pack("<I", txin.nSequence))
 
+    zero_sequences = False
     if (hashtype & 0x1f) == SIGHASH_NONE:
-        txtmp.vout = []
-
-        for i in range(len(txtmp.vin)):
-            if i != inIdx:
-                txtmp.vin[i].nSequence = 0
+        outputs = ser_compact_size(0)
+        zero_sequences = True
 
     elif (hashtype & 0x1f) == SIGHASH_SINGLE:
         outIdx = inIdx
-        if outIdx >= len(txtmp.vout):
-            return (HASH_ONE, "outIdx %d out of range (%d)" % (outIdx, len(txtmp.vout)))
+        if outIdx >= len(txTo.vout):
+            return (HASH_ONE, "outIdx %d out of range (%d)" % (outIdx, len(txTo.vout)))
 
-        tmp = txtmp.vout[outIdx]
-        txtmp.vout = []
-        for i in range(outIdx):
-            txtmp.vout.append(CTxOut(-1))
-        txtmp.vout.append(tmp)
+        outputs = ser_compact_size(outIdx + 1) + BLANK_TXOUT * outIdx + txTo.vout[outIdx].serialize()
+        zero_sequences = True
 
-        for i in range(len(txtmp.vin)):
-            if i != inIdx:
-                txtmp.vin[i].nSequence = 0
+    else:
+        outputs = _sighash_outputs(txTo)
 
     if hashtype & SIGHASH_ANYONECANPAY:
-        tmp = txtmp.vin[inIdx]
-        txtmp.vin = []
-        txtmp.vin.append(tmp)
+        inputs = ser_compact_size(1) + signed_input
+    else:
+        blank_inputs, offsets = _sighash_inputs(txTo, zero_sequences)
+        inputs = b"".join((ser_compact_size(len(txTo.vin)), blank_inputs[:offsets[inIdx]],
+                           signed_input, blank_inputs[offsets[inIdx + 1]:]))
 
-    s = txtmp.serialize_without_witness()
-    s += struct.pack(b"<I", hashtype)
+    s = b"".join((struct.pack("<i", txTo.nVersion), inputs, outputs,
+                  struct.pack("<I", txTo.nLockTime), struct.pack(b"<I", hashtype)))
 
     hash = hash256(s)
 
     return (hash, None)
 
-# TODO: Allow cached hashPrevouts/hashSequence/hashOutputs to be provided.
-# Performance optimization probably not necessary for python tests, however.
+class PrecomputedTransactionData():
+    """The hashes shared by the BIP143 signature hashes of a transaction's inputs.
+
+    Like PrecomputedTransactionData in interpreter.h: compute it once, when
+    the inputs and outputs of txTo are final, and pass it to
+    SegwitVersion1SignatureHash() for each input and hashtype. Witnesses and
+    scriptSigs don't affect it, so inputs can be signed in turn."""
+
+    def __init__(self, txTo):
+        self.hashPrevouts = uint256_from_str(hash256(b"".join(i.prevout.serialize() for i in txTo.vin)))
+        self.hashSequence = uint256_from_str(hash256(b"".join(struct.pack("<I", i.nSequence) for i in txTo.vin)))
+        self.hashOutputs = uint256_from_str(hash256(b"".join(o.serialize() for o in txTo.vout)))
+
 # Note that this corresponds to sigversion == 1 in EvalScript, which is used
-# for version 0 witnesses.
-def SegwitVersion1SignatureHash(script, txTo, inIdx, hashtype, amount):
+# for version 0 witnesses. If txdata (a PrecomputedTransactionData for txTo)
+# isn't given, the hashes over all inputs and outputs are computed again.
+def SegwitVersion1SignatureHash(script, txTo, inIdx, hashtype, amount, txdata=None):
 
     hashPrevouts = 0
     hashSequence = 0
     hashOutputs = 0
 
     if not (hashtype & SIGHASH_ANYONECANPAY):
-        serialize_prevouts = bytes()
-        for i in txTo.vin:
-            serialize_prevouts += i.prevout.serialize()
-        hashPrevouts = uint256_from_str(hash256(serialize_prevouts))
+        if txdata is None:
+            txdata = PrecomputedTransactionData(txTo)
+        hashPrevouts = txdata.hashPrevouts
 
     if (not (hashtype & SIGHASH_ANYONECANPAY) and (hashtype & 0x1f) != SIGHASH_SINGLE and (hashtype & 0x1f) != SIGHASH_NONE):
-        serialize_sequence = bytes()
-        for i in txTo.vin:
-            serialize_sequence += struct.pack("<I", i.nSequence)
-        hashSequence = uint256_from_str(hash256(serialize_sequence))
+        hashSequence = txdata.hashSequence
 
     if ((hashtype & 0x1f) != SIGHASH_SINGLE and (hashtype & 0x1f) != SIGHASH_NONE):
-        serialize_outputs = bytes()
-        for o in txTo.vout:
-            serialize_outputs += o.serialize()
-        hashOutputs = uint256_from_str(hash256(serialize_outputs))
+        if txdata is None:
+            txdata = PrecomputedTransactionData(txTo)
+        hashOutputs = txdata.hashOutputs
     elif ((hashtype & 0x1f) == SIGHASH_SINGLE and inIdx < len(txTo.vout)):
         serialize_outputs = txTo.vout[inIdx].serialize()
         hashOutputs = uint256_from_str(hash256(serialize_outputs))
@@ -692,3 +734,49 @@ def SegwitVersion1SignatureHash(script, txTo, inIdx, hashtype, amount):
     ss += struct.pack("<I", hashtype)
 
     return hash256(ss)
+
+def SegwitVersion1SignatureHashes(txTo, spent):
+    """Return the BIP143 signature hashes of all inputs of txTo.
+
+    spent has a (script, hashtype, amount) tuple for each input, in order.
+    The hashes over all inputs and outputs are only computed once."""
+    assert len(spent) == len(txTo.vin)
+    txdata = PrecomputedTransactionData(txTo)
+    return [SegwitVersion1SignatureHash(script, txTo, inIdx, hashtype, amount, txdata)
+            for inIdx, (script, hashtype, amount) in enumerate(spent)]
+
+
+class TestFrameworkScript(unittest.TestCase):
+    # The native P2WPKH example from BIP 143
+    BIP143_TX = ("0100000002fff7f7881a8099afa6940d42d1e7f6362bec38171ea3edf433541db4e4ad969f0000000000eeffffff"
+                 "ef51e1b804cc89d182d279655c3aa89e815b1b309fe287d9b2b55d57b90ec68a0100000000ffffffff02202cb206"
+                 "000000001976a9148280b37df378db99f66f85c95a783a76ac7a6d5988ac9093510d000000001976a9143bde42db"
+                 "ee7e4dbe6a21b2d50ce2f0167faa815988ac11000000")
+
+    def test_segwit_signature_hash(self):
+        tx = FromHex(CTransaction(), self.BIP143_TX)
+        script = bytes.fromhex("76a9141d0f172a0ecb48aee1be1f2687d2963ae33f71a188ac")
+        self.assertEqual(SegwitVersion1SignatureHash(script, tx, 1, SIGHASH_ALL, 600000000),
+                         bytes.fromhex("c37af31116d1b27caf68aae9e3ac82f1477929014d5b917657d0eb49478cb670"))
+
+    def test_precomputed_transaction_data(self):
+        tx = FromHex(CTransaction(), self.BIP143_TX)
+        # A third input, for SIGHASH_SINGLE without a matching output
+        tx.vin.append(CTxIn(COutPoint(3, 1), b"", 7))
+        script = CScript([OP_TRUE])
+        txdata = PrecomputedTransactionData(tx)
+        hashtypes = [base | anyonecanpay for base in (SIGHASH_ALL, SIGHASH_NONE, SIGHASH_SINGLE)
+                     for anyonecanpay in (0, SIGHASH_ANYONECANPAY)]
+        for hashtype in hashtypes:
+            for inIdx in range(len(tx.vin)):
+                self.assertEqual(SegwitVersion1SignatureHash(script, tx, inIdx, hashtype, 1000, txdata),
+                                 SegwitVersion1SignatureHash(script, tx, inIdx, hashtype, 1000))
+        spent = [(script, hashtypes[i], 1000 + i) for i in range(len(tx.vin))]
+        self.assertEqual(SegwitVersion1SignatureHashes(tx, spent),
+                         [SegwitVersion1SignatureHash(s, tx, i, h, a) for i, (s, h, a) in enumerate(spent)])
+        # Filling in scriptSigs and witnesses doesn't change the hashes
+        tx.vin[0].scriptSig = b"\x51"
+        tx.wit.vtxinwit = [CTxInWitness() for i in range(len(tx.vin))]
+        tx.wit.vtxinwit[1].scriptWitness.stack = [b"\x01"]
+        self.assertEqual(SegwitVersion1SignatureHash(script, tx, 2, SIGHASH_ALL, 1000, txdata),
+                         SegwitVersion1SignatureHash(script, tx, 2, SIGHASH_ALL, 1000))
@@ -4,9 +4,24 @@
 # file COPYING or http://www.opensource.org/licenses/mit-license.php.
 """Specialized SipHash-2-4 implementations.
 
-This implements SipHash-2-4 for 256-bit integers.
+This implements SipHash-2-4 for 256-bit integers, one at a time
+(siphash256) or for a batch of them with the same key (siphash256_batch).
+The batch version works on NumPy arrays of uint64 lanes if NumPy is
+installed, and falls back to siphash256 otherwise.
 """
 
+import random
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Batches smaller than this are hashed one at a time, which is faster than
+# setting up the NumPy arrays
+BATCH_MIN_SIZE = 16
+
 def rotl64(n, b):
     return n >> (64 - b) | (n & ((1 << (64 - b)) - 1)) << b
 
@@ -61,3 +76,84 @@ def siphash256(k0, k1, h):
     v0, v1, v2, v3 = siphash_round(v0, v1, v2, v3)
     v0, v1, v2, v3 = siphash_round(v0, v1, v2, v3)
     return v0 ^ v1 ^ v2 ^ v3
+
+def rotl64_lanes(n, b):
+    return (n << numpy.uint64(b)) | (n >> numpy.uint64(64 - b))
+
+def siphash_round_lanes(v0, v1, v2, v3):
+    # Same as siphash_round, on arrays of uint64 (where additions wrap)
+    v0 += v1
+    v1 = rotl64_lanes(v1, 13)
+    v1 ^= v0
+    v0 = rotl64_lanes(v0, 32)
+    v2 += v3
+    v3 = rotl64_lanes(v3, 16)
+    v3 ^= v2
+    v0 += v3
+    v3 = rotl64_lanes(v3, 21)
+    v3 ^= v0
+    v2 += v1
+    v1 = rotl64_lanes(v1, 17)
+    v1 ^= v2
+    v2 = rotl64_lanes(v2, 32)
+    return (v0, v1, v2, v3)
+
+def siphash256_batch(k0, k1, hashes):
+    """Return [siphash256(k0, k1, h) for h in hashes]."""
+    if numpy is None or len(hashes) < BATCH_MIN_SIZE:
+        return [siphash256(k0, k1, h) for h in hashes]
+    words = numpy.frombuffer(b"".join(h.to_bytes(32, 'little') for h in hashes), dtype='<u8').reshape(-1, 4)
+    n0, n1, n2, n3 = (words[:, i].astype(numpy.uint64) for i in range(4))
+    count = len(hashes)
+    v0 = numpy.full(count, 0x736f6d6570736575 ^ k0, dtype=numpy.uint64)
+    v1 = numpy.full(count, 0x646f72616e646f6d ^ k1, dtype=numpy.uint64)
+    v2 = numpy.full(count, 0x6c7967656e657261 ^ k0, dtype=numpy.uint64)
+    v3 = numpy.full(count, 0x7465646279746573 ^ k1, dtype=numpy.uint64) ^ n0
+    v0, v1, v2, v3 = siphash_round_lanes(v0, v1, v2, v3)
+    v0, v1, v2, v3 = siphash_round_lanes(v0, v1, v2, v3)
+    v0 ^= n0
+    v3 ^= n1
+    v0, v1, v2, v3 = siphash_round_lanes(v0, v1, v2, v3)
+    v0, v1, v2, v3 = siphash_round_lanes(v0, v1, v2, v3)
+    v0 ^= n1
+    v3 ^= n2
+    v0, v1, v2, v3 = siphash_round_lanes(v0, v1, v2, v3)
+    v0, v1, v2, v3 = siphash_round_lanes(v0, v1, v2, v3)
+    v0 ^= n2
+    v3 ^= n3
+    v0, v1, v2, v3 = siphash_round_lanes(v0, v1, v2, v3)
+    v0, v1, v2, v3 = siphash_round_lanes(v0, v1, v2, v3)
+    v0 ^= n3
+    v3 ^= numpy.uint64(0x2000000000000000)
+    v0, v1, v2, v3 = siphash_round_lanes(v0, v1, v2, v3)
+    v0, v1, v2, v3 = siphash_round_lanes(v0, v1, v2, v3)
+    v0 ^= numpy.uint64(0x2000000000000000)
+    v2 ^= numpy.uint64(0xFF)
+    v0, v1, v2, v3 = siphash_round_lanes(v0, v1, v2, v3)
+    v0, v1, v2, v3 = siphash_round_lanes(v0, v1, v2, v3)
+    v0, v1, v2, v3 = siphash_round_lanes(v0, v1, v2, v3)
+    v0, v1, v2, v3 = siphash_round_lanes(v0, v1, v2, v3)
+    return (v0 ^ v1 ^ v2 ^ v3).tolist()
+
+
+class TestFrameworkSipHash(unittest.TestCase):
+    def test_siphash256(self):
+        # From src/test/hash_tests.cpp
+        self.assertEqual(siphash256(0x0706050403020100, 0x0F0E0D0C0B0A0908,
+                                    0x1f1e1d1c1b1a191817161514131211100f0e0d0c0b0a09080706050403020100),
+                         0x7127512f72f27cce)
+
+    def test_siphash256_batch(self):
+        rng = random.Random(1)
+        k0 = rng.getrandbits(64)
+        k1 = rng.getrandbits(64)
+        for count in (0, 1, BATCH_MIN_SIZE - 1, BATCH_MIN_SIZE, 1000):
+            hashes = [rng.getrandbits(256) for i in range(count)]
+            if count:
+                hashes[0] = 0
+                hashes[-1] = (1 << 256) - 1
+            self.assertEqual(siphash256_batch(k0, k1, hashes), [siphash256(k0, k1, h) for h in hashes])
+        # Keys with the top bits set
+        hashes = [rng.getrandbits(256) for i in range(100)]
+        k0 = k1 = (1 << 64) - 1
+        self.assertEqual(siphash256_batch(k0, k1, hashes), [siphash256(k0, k1, h) for h in hashes])
@@ -22,6 +22,7 @@ from .util import (
     PortSeed,
     assert_equal,
     check_json_precision,
+    close_rpc_clients,
     connect_nodes_bi,
     disconnect_nodes,
     initialize_datadir,
@@ -80,6 +81,8 @@ class BitcoinTestFramework():
         parser.add_option("--cachedir", dest="cachedir", default=os.path.normpath(os.path.dirname(os.path.realpath(__file__)) + "/../../cache"),
                           help="Directory for caching pregenerated datadirs")
         parser.add_option("--tmpdir", dest="tmpdir", help="Root directory for datadirs")
+        parser.add_option("--powcache", dest="powcache", default=False, action="store_true",
+                          help="Keep solved block nonces in powcache.dat next to the cache directory and reuse them in later runs")
         parser.add_option("-l", "--loglevel", dest="loglevel", default="INFO",
                           help="log events at this level and higher to the console. Can be set to DEBUG, INFO, WARNING, ERROR or CRITICAL. Passing --loglevel DEBUG will output all logs to console. Note that logs at all levels are always written to the test_framework.log file in the temporary test directory.")
         parser.add_option("--tracerpc", dest="trace_rpc", default=False, action="store_true",
@@ -104,6 +107,11 @@ class BitcoinTestFramework():
         check_json_precision()
 
         self.options.cachedir = os.path.abspath(self.options.cachedir)
+        if self.options.powcache:
+            # Imported here since powsolver needs the cascoin_scrypt module,
+            # which tests without P2P code don't otherwise require
+            from .powsolver import enable_pow_cache
+            enable_pow_cache(os.path.join(os.path.dirname(self.options.cachedir), "powcache.dat"))
 
         # Set up temp directory and start logging
         if self.options.tmpdir:
@@ -146,6 +154,10 @@ class BitcoinTestFramework():
                 self.stop_nodes()
         else:
             self.log.info("Note: cascoinds were not stopped and may still be running")
+        close_rpc_clients()
+        if self.options.powcache:
+            from .powsolver import disable_pow_cache
+            disable_pow_cache()
 
         if not self.options.nocleanup and not self.options.noshutdown and success != TestStatus.FAILED:
             self.log.info("Cleaning up")
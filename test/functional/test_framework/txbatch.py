@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# Copyright (c) 2018 The Cascoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Columnar batches of transactions, for generating many of them at once.
+
+TxBatch keeps the fields of its transactions in one typed array per field
+(prevout hashes, prevout indexes, values, sequence numbers...) instead of in
+CTransaction, CTxIn and CTxOut objects. The whole batch is serialized into a
+single buffer, and the txids are hashed over it in one pass, without
+building any objects:
+
+    batch = TxBatch()
+    for i, out in enumerate(split.vout):
+        batch.add_spend(split.sha256, i, out.nValue - fee, CScript([OP_TRUE]))
+    for raw in batch.raw_transactions():
+        node.sendrawtransaction(bytes_to_hex_str(raw), True)
+
+Transactions are serialized when first needed (e.g. when a txid is read to
+spend an output of a transaction in the same batch), and are not
+serialized again: add transactions rather than changing the arrays of
+already serialized ones. The transactions have no witnesses. Scripts are
+kept once per distinct script, so the usual batch of spends of the same kind
+of output takes little memory."""
+
+from array import array
+import hashlib
+import random
+import struct
+import unittest
+
+from .messages import BufferReader, COutPoint, CTransaction, CTxIn, CTxOut, ser_compact_size, ser_uint256
+
+_U32 = struct.Struct("<I")
+_I32 = struct.Struct("<i")
+_I64 = struct.Struct("<q")
+
+class TxBatch():
+    """Transactions stored column-wise.
+
+    Transaction t has inputs input_start[t] to input_start[t + 1] - 1 and
+    outputs output_start[t] to output_start[t + 1] - 1. Input i spends output
+    prevout_n[i] of the transaction whose txid is in prevout_hashes at
+    32 * i (in serialization order)."""
+
+    def __init__(self):
+        # Per transaction
+        self.version = array('i')
+        self.lock_time = array('I')
+        self.input_start = array('I', [0])
+        self.output_start = array('I', [0])
+        # Per input
+        self.prevout_hashes = bytearray()
+        self.prevout_n = array('I')
+        self.script_sigs = []
+        self.sequences = array('I')
+        # Per output
+        self.values = array('q')
+        self.script_pubkeys = []
+        # script -> the script serialized with its length, shared by all
+        # inputs and outputs with that script
+        self._scripts = {}
+        # The serialized transactions, their offsets in it (one more than
+        # there are serialized transactions) and their txids (32 bytes each)
+        self.buf = bytearray()
+        self.offsets = array('Q', [0])
+        self.txid_bytes = bytearray()
+
+    def __len__(self):
+        return len(self.version)
+
+    def _script(self, script):
+        s = self._scripts.get(script)
+        if s is None:
+            s = self._scripts[script] = ser_compact_size(len(script)) + bytes(script)
+        return s
+
+    def add(self, inputs, outputs, version=1, lock_time=0):
+        """Add a transaction. Return its index in the batch.
+
+        inputs is a list of (txid, n, scriptSig, nSequence) and outputs a list
+        of (nValue, scriptPubKey)."""
+        for txid, n, script_sig, sequence in inputs:
+            self.prevout_hashes += ser_uint256(txid)
+            self.prevout_n.append(n)
+            self.script_sigs.append(self._script(script_sig))
+            self.sequences.append(sequence)
+        for value, script_pubkey in outputs:
+            self.values.append(value)
+            self.script_pubkeys.append(self._script(script_pubkey))
+        self.input_start.append(len(self.prevout_n))
+        self.output_start.append(len(self.values))
+        self.version.append(version)
+        self.lock_time.append(lock_time)
+        return len(self.version) - 1
+
+    def add_spend(self, txid, n, value, script_pubkey, script_sig=b"", sequence=0, version=1, lock_time=0):
+        """Add a transaction with one input and one output. Return its index in the batch."""
+        self.prevout_hashes += ser_uint256(txid)
+        self.prevout_n.append(n)
+        self.script_sigs.append(self._script(script_sig))
+        self.sequences.append(sequence)
+        self.values.append(value)
+        self.script_pubkeys.append(self._script(script_pubkey))
+        self.input_start.append(len(self.prevout_n))
+        self.output_start.append(len(self.values))
+        self.version.append(version)
+        self.lock_time.append(lock_time)
+        return len(self.version) - 1
+
+    def serialize(self):
+        """Serialize the transactions added since the last call, and compute their txids."""
+        first = len(self.offsets) - 1
+        if first == len(self):
+            return
+        w = self.buf
+        offsets = self.offsets
+        prevout_hashes = self.prevout_hashes
+        prevout_n = self.prevout_n
+        script_sigs = self.script_sigs
+        sequences = self.sequences
+        values = self.values
+        script_pubkeys = self.script_pubkeys
+        input_start = self.input_start
+        output_start = self.output_start
+        for t in range(first, len(self)):
+            w += _I32.pack(self.version[t])
+            i0 = input_start[t]
+            i1 = input_start[t + 1]
+            w += ser_compact_size(i1 - i0)
+            for i in range(i0, i1):
+                w += prevout_hashes[32 * i:32 * i + 32]
+                w += _U32.pack(prevout_n[i])
+                w += script_sigs[i]
+                w += _U32.pack(sequences[i])
+            o0 = output_start[t]
+            o1 = output_start[t + 1]
+            w += ser_compact_size(o1 - o0)
+            for o in range(o0, o1):
+                w += _I64.pack(values[o])
+                w += script_pubkeys[o]
+            w += _U32.pack(self.lock_time[t])
+            offsets.append(len(w))
+        # The buffer can't grow while views of it exist, so hash it at the end
+        sha256 = hashlib.sha256
+        with memoryview(w) as view:
+            for t in range(first, len(self)):
+                self.txid_bytes += sha256(sha256(view[offsets[t]:offsets[t + 1]]).digest()).digest()
+
+    def get_raw_transaction(self, t):
+        self.serialize()
+        return bytes(self.buf[self.offsets[t]:self.offsets[t + 1]])
+
+    def raw_transactions(self):
+        self.serialize()
+        for t in range(len(self)):
+            yield bytes(self.buf[self.offsets[t]:self.offsets[t + 1]])
+
+    def get_txid(self, t):
+        self.serialize()
+        return int.from_bytes(self.txid_bytes[32 * t:32 * t + 32], 'little')
+
+    def txids(self):
+        self.serialize()
+        txid_bytes = self.txid_bytes
+        return [int.from_bytes(txid_bytes[i:i + 32], 'little') for i in range(0, len(txid_bytes), 32)]
+
+    def get_transaction(self, t):
+        """Return a transaction of the batch as a CTransaction, with its sha256 and hash set."""
+        tx = CTransaction()
+        tx.deserialize(BufferReader(self.get_raw_transaction(t)))
+        tx.sha256 = self.get_txid(t)
+        tx.hash = "%064x" % tx.sha256
+        return tx
+
+    def transactions(self):
+        """Iterate over the transactions of the batch as CTransactions, decoding each as it's reached."""
+        for t in range(len(self)):
+            yield self.get_transaction(t)
+
+
+class TestFrameworkTxBatch(unittest.TestCase):
+    def make_tx(self, inputs, outputs, version, lock_time):
+        tx = CTransaction()
+        tx.nVersion = version
+        tx.vin = [CTxIn(COutPoint(txid, n), script_sig, sequence) for txid, n, script_sig, sequence in inputs]
+        tx.vout = [CTxOut(value, script_pubkey) for value, script_pubkey in outputs]
+        tx.nLockTime = lock_time
+        tx.rehash()
+        return tx
+
+    def test_serialize(self):
+        rng = random.Random(1)
+        # Including scripts too long for a one-byte length
+        scripts = [b"", b"\x51", bytes(range(100)), b"\x6a" * 300, b"\x00" * 70000]
+        batch = TxBatch()
+        expected = []
+        for t in range(50):
+            inputs = [(rng.getrandbits(256), rng.getrandbits(32), rng.choice(scripts), rng.getrandbits(32))
+                      for i in range(rng.randrange(1, 4))]
+            outputs = [(rng.randrange(-1, 1 << 62), rng.choice(scripts)) for i in range(rng.randrange(4))]
+            version = rng.randrange(-2, 3)
+            lock_time = rng.getrandbits(32)
+            self.assertEqual(batch.add(inputs, outputs, version, lock_time), t)
+            expected.append(self.make_tx(inputs, outputs, version, lock_time))
+            if t == 20:
+                # Serialize part of the batch, then keep adding
+                self.assertEqual(batch.get_txid(t), expected[t].sha256)
+        for t in range(50, 60):
+            txid = batch.get_txid(t - 1)
+            self.assertEqual(batch.add_spend(txid, t, 1000 + t, b"\x51", b"\x52", t, 2, t), t)
+            expected.append(self.make_tx([(txid, t, b"\x52", t)], [(1000 + t, b"\x51")], 2, t))
+
+        self.assertEqual(len(batch), len(expected))
+        self.assertEqual(list(batch.raw_transactions()), [tx.serialize_without_witness() for tx in expected])
+        self.assertEqual(batch.txids(), [tx.sha256 for tx in expected])
+        for t, tx in enumerate(batch.transactions()):
+            self.assertEqual(tx.serialize(), expected[t].serialize())
+            self.assertEqual(tx.sha256, expected[t].sha256)
+            self.assertEqual(tx.hash, expected[t].hash)
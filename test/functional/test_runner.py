@@ -27,6 +27,7 @@ import subprocess
 import tempfile
 import re
 import logging
+import unittest
 
 # Formatting. Default colors to empty strings.
 BOLD, BLUE, RED, GREY = ("", ""), ("", ""), ("", ""), ("", "")
@@ -129,6 +130,7 @@ BASE_SCRIPTS= [
     'wallet_resendwallettransactions.py',
     'feature_minchainwork.py',
     'p2p_fingerprint.py',
+    'p2p_capture.py',
     'feature_uacomment.py',
     'p2p_unrequested_blocks.py',
     'feature_logging.py',
@@ -169,10 +171,27 @@ EXTENDED_SCRIPTS = [
 # Place EXTENDED_SCRIPTS first since it has the 3 longest running tests
 ALL_SCRIPTS = EXTENDED_SCRIPTS + BASE_SCRIPTS
 
+# Modules of the test framework with unit tests, run before the test scripts
+TEST_FRAMEWORK_MODULES = [
+    "blockstore",
+    "compactblocks",
+    "merkle",
+    "messages",
+    "p2pload",
+    "powsolver",
+    "script",
+    "siphash",
+    "txbatch",
+    "util",
+]
+
 NON_SCRIPTS = [
     # These are python files that live in the functional tests directory, but are not test scripts.
+    "bench_messages.py",
     "combine_logs.py",
     "create_cache.py",
+    # Benchmarks with timing-dependent rates, run by hand
+    "p2p_load.py",
     "test_runner.py",
 ]
 
@@ -299,6 +318,17 @@ def run_tests(test_list, src_dir, build_dir, exeext, tmpdir, jobs=1, enable_cove
         os.environ["cascoinCLI"] = build_dir + '/src/cascoin-cli' + exeext
 
     tests_dir = src_dir + '/test/functional/'
+    sys.path.append(tests_dir)
+
+    # Test framework unit tests
+    print("Running unit tests for test framework modules")
+    test_framework_tests = unittest.TestSuite()
+    for module in TEST_FRAMEWORK_MODULES:
+        test_framework_tests.addTest(unittest.TestLoader().loadTestsFromName("test_framework.%s" % module))
+    result = unittest.TextTestRunner(verbosity=1, failfast=True).run(test_framework_tests)
+    if not result.wasSuccessful():
+        logging.debug("Early exiting after failure in test framework unit tests")
+        sys.exit(False)
 
     flags = ["--srcdir={}/src".format(build_dir)] + args
     flags.append("--cachedir=%s" % cache_dir)